@@ -0,0 +1,334 @@
+"""
+Error detector - Phát hiện string/MPPT bất thường theo luồng dữ liệu
+- Dòng string cả nhà máy giữ trong mảng NumPy (inverter × string), mỗi lần poll chỉ ghi một hàng,
+  đọc thẳng từ mảng cột của sample cache (không dựng list/dict)
+- Mỗi chu kỳ realtime đánh giá cả nhà máy trong một lần tính vector (không lặp dict trong Python)
+- Dòng được chuẩn hóa theo Max_I rồi so với string cùng MPPT và cùng inverter
+- Giới hạn Max_I/Max_V/Max_P lấy từ strings.yaml/mppt.yaml
+- Trung bình trượt (EWMA) tỷ lệ so với peer của từng string để phát hiện suy giảm kéo dài
+- Alert phát ngay trong chu kỳ đầu tiên vượt ngưỡng, tự xóa khi trở lại bình thường
+"""
+import asyncio
+import time
+import warnings
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+from alerts.subscriptions import Topic
+from storage.cache import Sample
+
+# Loại alert -> đối tượng ("string" / "mppt")
+STRING_ALERTS = ("string_dead", "string_low", "string_degraded", "string_over_current", "string_over_power")
+MPPT_ALERTS = ("mppt_low", "mppt_over_current", "mppt_over_voltage", "mppt_over_power")
+
+
+@dataclass
+class Alert:
+    """Một thay đổi trạng thái alert (raised=False: đã trở lại bình thường)"""
+    kind: str
+    inverter_id: int
+    index: int            # string_index / mppt_index (bắt đầu từ 1)
+    value: float
+    reference: float      # Giới hạn hoặc giá trị peer dùng để so sánh
+    raised: bool
+    ts: float
+
+    def __str__(self):
+        state = "🚨" if self.raised else "✅"
+        target = "string" if self.kind.startswith("string") else "MPPT"
+        return (f"{state} Inverter {self.inverter_id} {target} {self.index}: {self.kind} "
+                f"({self.value:.2f} / {self.reference:.2f})")
+
+
+# Khóa gộp: mỗi string/MPPT chỉ giữ thay đổi trạng thái mới nhất
+TOPIC_ALERT = Topic("alert", Alert, key=lambda alert: (alert.inverter_id, alert.kind, alert.index))
+
+
+def _read_column(sample: Sample, group: str, key: str, out) -> None:
+    """Giá trị một trường của nhóm lặp vào hàng `out` (sentinel -> NaN)"""
+    column = sample.schema.column(group, key)
+    if column is None:
+        return
+    n = min(column.count, out.shape[0])
+    raw = np.frombuffer(sample.raw(group, key), dtype=column.typecode)[:n]
+    out[:n] = column.scale_values(raw)
+    if column.sentinel is not None:
+        out[:n][raw == column.sentinel] = np.nan
+
+
+def _mppt_index(entry: Dict[str, Any]) -> int:
+    """mppt_index của một string trong strings.yaml (mppt_id = "<inverter_id><mppt_index>")"""
+    if "mppt_index" in entry:
+        return int(entry["mppt_index"])
+    return int(str(entry["mppt_id"])[len(str(entry["inverter_id"])):])
+
+
+class PlantLayout:
+    """Ma trận giới hạn của nhà máy: hàng = inverter, cột = string / MPPT"""
+
+    def __init__(self, inverter_configs: List[Dict[str, Any]], strings: List[Dict[str, Any]],
+                 mppts: List[Dict[str, Any]]):
+        self.inverter_ids = [inv["id"] for inv in inverter_configs]
+        self.row = {inverter_id: r for r, inverter_id in enumerate(self.inverter_ids)}
+        rows = len(self.inverter_ids)
+        cols = max((inv.get("string_count", 18) for inv in inverter_configs), default=0)
+        mppt_cols = max((inv.get("mppt_count", 9) for inv in inverter_configs), default=0)
+
+        self.string_max_i = np.full((rows, cols), np.nan)
+        self.string_max_p = np.full((rows, cols), np.nan)
+        self.string_valid = np.zeros((rows, cols), dtype=bool)
+        self.string_mppt = np.zeros((rows, cols), dtype=np.intp)  # Cột MPPT của string
+        self.mppt_max_i = np.full((rows, mppt_cols), np.nan)
+        self.mppt_max_v = np.full((rows, mppt_cols), np.nan)
+        self.mppt_max_p = np.full((rows, mppt_cols), np.nan)
+        self.mppt_valid = np.zeros((rows, mppt_cols), dtype=bool)
+
+        # Mặc định theo số string/MPPT của inverter: string chia đều liên tiếp cho các MPPT
+        for inv in inverter_configs:
+            r = self.row[inv["id"]]
+            string_count, mppt_count = inv.get("string_count", 18), inv.get("mppt_count", 9)
+            per_mppt = max(1, string_count // max(1, mppt_count))
+            self.string_valid[r, :string_count] = True
+            self.string_mppt[r, :string_count] = np.minimum(np.arange(string_count) // per_mppt, mppt_count - 1)
+            self.mppt_valid[r, :mppt_count] = True
+
+        for entry in mppts:
+            r = self.row.get(entry.get("inverter_id"))
+            c = int(entry.get("mppt_index", 0)) - 1
+            if r is None or not 0 <= c < mppt_cols:
+                continue
+            self.mppt_max_i[r, c] = entry.get("Max_I", np.nan)
+            self.mppt_max_v[r, c] = entry.get("Max_V", np.nan)
+            self.mppt_max_p[r, c] = entry.get("Max_P", np.nan)
+
+        for entry in strings:
+            r = self.row.get(entry.get("inverter_id"))
+            if r is None:
+                continue
+            mppt = _mppt_index(entry) - 1
+            c = mppt * entry.get("string_on_mppt", 2) + int(entry.get("string_index", 1)) - 1
+            if not 0 <= c < cols:
+                continue
+            self.string_max_i[r, c] = entry.get("Max_I", np.nan)
+            self.string_max_p[r, c] = entry.get("Max_P_string", entry.get("Max_P", np.nan))
+            self.string_mppt[r, c] = mppt
+
+        # String không có Max_I: dùng Max_I của MPPT chia đều cho số string
+        strings_per_mppt = np.zeros((rows, mppt_cols))
+        np.add.at(strings_per_mppt, (np.nonzero(self.string_valid)[0], self.string_mppt[self.string_valid]), 1)
+        fallback = (self.mppt_max_i / np.maximum(strings_per_mppt, 1))[np.arange(rows)[:, None], self.string_mppt]
+        self.string_max_i = np.where(np.isnan(self.string_max_i), fallback, self.string_max_i)
+
+    @property
+    def shape(self):
+        return self.string_valid.shape
+
+
+class StringDetector:
+    """Detector streaming cho string và MPPT của cả nhà máy"""
+
+    def __init__(self, layout: PlantLayout, low_ratio: float = 0.5, degraded_ratio: float = 0.85,
+                 dead_current: float = 0.1, min_reference_current: float = 1.0, ewma_window: int = 60,
+                 min_samples: int = 10, interval: float = 5,
+                 on_alert: Optional[Callable[[Alert], None]] = None, latency_window: int = 1000):
+        self.layout = layout
+        self.low_ratio = low_ratio                          # Thấp hơn peer quá mức này -> alert ngay
+        self.degraded_ratio = degraded_ratio                # EWMA thấp hơn mức này -> suy giảm kéo dài
+        self.dead_current = dead_current                    # Dòng (A) coi như string chết
+        self.min_reference_current = min_reference_current  # Peer phải phát ít nhất dòng này mới so sánh
+        self.alpha = 2 / (ewma_window + 1)
+        self.min_samples = min_samples
+        self.interval = interval                            # Chu kỳ đánh giá (= chu kỳ realtime)
+        self.on_alert = on_alert
+
+        rows, cols = layout.shape
+        mppt_cols = layout.mppt_valid.shape[1]
+        self.current = np.full((rows, cols), np.nan)
+        self.mppt_voltage = np.full((rows, mppt_cols), np.nan)
+        self.mppt_current = np.full((rows, mppt_cols), np.nan)
+        self.ratio_ewma = np.full((rows, cols), np.nan)
+        self.samples = np.zeros((rows, cols), dtype=np.int64)
+        self.dirty = np.zeros((rows, 1), dtype=bool)  # Hàng có dữ liệu mới từ lần đánh giá trước
+        self.active = {kind: np.zeros((rows, cols), dtype=bool) for kind in STRING_ALERTS}
+        self.active.update({kind: np.zeros((rows, mppt_cols), dtype=bool) for kind in MPPT_ALERTS})
+
+        # Thống kê
+        self.updates = 0
+        self.evaluations = 0
+        self.alerts_raised = 0
+        self._latencies: deque = deque(maxlen=latency_window)  # micro giây
+
+    # ------------------------------------------------------------------
+    # Cập nhật
+    # ------------------------------------------------------------------
+    def update(self, inverter_id: int, sample: Sample) -> bool:
+        """Ghi hàng của một inverter từ mẫu realtime (đánh giá ở lần evaluate kế tiếp)"""
+        r = self.layout.row.get(inverter_id)
+        if r is None or ("strings" not in sample and "mppt" not in sample):
+            return False
+
+        if sample.has("strings"):
+            _read_column(sample, "strings", "current", self.current[r])
+        if sample.has("mppt"):
+            _read_column(sample, "mppt", "voltage", self.mppt_voltage[r])
+            _read_column(sample, "mppt", "current", self.mppt_current[r])
+        self.dirty[r] = True
+        self.updates += 1
+        return True
+
+    async def on_sample(self, inverter_id: int, ts: float, sample: Sample):
+        """Callback cho collector"""
+        self.update(inverter_id, sample)
+
+    async def run(self):
+        """Đánh giá cả nhà máy mỗi chu kỳ realtime"""
+        while True:
+            await asyncio.sleep(self.interval)
+            if self.dirty.any():
+                self.evaluate()
+
+    # ------------------------------------------------------------------
+    # Tính toán (vector hóa trên toàn bộ nhà máy)
+    # ------------------------------------------------------------------
+    def evaluate(self, ts: Optional[float] = None) -> List[Alert]:
+        """Đánh giá mọi string/MPPT, trả về các alert đổi trạng thái"""
+        start = time.perf_counter_ns()
+        alerts = self._evaluate(ts if ts is not None else time.time())
+        self.dirty[:] = False
+        self.evaluations += 1
+        self._latencies.append((time.perf_counter_ns() - start) / 1000)
+        return alerts
+
+    def _evaluate(self, ts: float) -> List[Alert]:
+        layout = self.layout
+        current = self.current
+        valid = layout.string_valid & ~np.isnan(current)
+        max_i = layout.string_max_i
+        string_mppt = layout.string_mppt
+        height, mppt_cols = self.mppt_voltage.shape
+        row_index = np.arange(height)[:, None]
+
+        # Chuẩn hóa theo Max_I để so sánh string khác loại; peer = median inverter và max cùng MPPT
+        norm = np.where(valid, current / max_i, np.nan)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)  # Hàng toàn NaN (chưa có dữ liệu)
+            inverter_ref = np.nanmedian(norm, axis=1, keepdims=True)
+        mppt_best = np.zeros((height, mppt_cols))
+        np.maximum.at(mppt_best, (np.nonzero(valid)[0], string_mppt[valid]), norm[valid])
+        mppt_ref = mppt_best[row_index, string_mppt]
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ratio = np.fmin(norm / inverter_ref, norm / mppt_ref)
+        producing = valid & (inverter_ref * max_i >= self.min_reference_current)
+
+        # Thống kê trượt: mỗi mẫu mới một lần, chỉ khi peer đang phát điện
+        fresh = producing & self.dirty
+        ewma = self.ratio_ewma
+        ewma[:] = np.where(fresh, np.where(np.isnan(ewma), ratio, ewma + self.alpha * (ratio - ewma)), ewma)
+        samples = self.samples
+        samples += fresh
+
+        dead = producing & (current <= self.dead_current)
+        low = producing & ~dead & (ratio < self.low_ratio)
+        degraded = producing & ~dead & ~low & (samples >= self.min_samples) & (ewma < self.degraded_ratio)
+
+        # Điện áp string = điện áp MPPT của nó
+        voltage = self.mppt_voltage[row_index, string_mppt]
+        with np.errstate(invalid="ignore"):
+            conditions = {
+                # Alert so sánh peer giữ nguyên trạng thái khi không phát điện (đêm, sáng sớm)
+                "string_dead": np.where(producing, dead, self.active["string_dead"]),
+                "string_low": np.where(producing, low, self.active["string_low"]),
+                "string_degraded": np.where(producing, degraded, self.active["string_degraded"]),
+                "string_over_current": valid & (current > max_i),
+                "string_over_power": valid & (current * voltage > layout.string_max_p),
+            }
+            references = {
+                "string_dead": inverter_ref * max_i,
+                "string_low": inverter_ref * max_i,
+                "string_degraded": np.broadcast_to(self.degraded_ratio, current.shape),
+                "string_over_current": max_i,
+                "string_over_power": layout.string_max_p,
+            }
+            values = {
+                "string_dead": current, "string_low": current, "string_degraded": ewma,
+                "string_over_current": current, "string_over_power": current * voltage,
+            }
+
+            mppt_v, mppt_i = self.mppt_voltage, self.mppt_current
+            mppt_valid = layout.mppt_valid & ~np.isnan(mppt_i)
+            mppt_norm = np.where(mppt_valid, mppt_i / layout.mppt_max_i, np.nan)
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", RuntimeWarning)
+                mppt_median = np.nanmedian(mppt_norm, axis=1, keepdims=True)
+            mppt_producing = mppt_valid & (mppt_median * layout.mppt_max_i >= self.min_reference_current)
+            mppt_low = mppt_norm < mppt_median * self.low_ratio
+            conditions.update({
+                "mppt_low": np.where(mppt_producing, mppt_low, self.active["mppt_low"]),
+                "mppt_over_current": mppt_valid & (mppt_i > layout.mppt_max_i),
+                "mppt_over_voltage": layout.mppt_valid & (mppt_v > layout.mppt_max_v),
+                "mppt_over_power": mppt_valid & (mppt_v * mppt_i > layout.mppt_max_p),
+            })
+            references.update({
+                "mppt_low": mppt_median * layout.mppt_max_i,
+                "mppt_over_current": layout.mppt_max_i,
+                "mppt_over_voltage": layout.mppt_max_v,
+                "mppt_over_power": layout.mppt_max_p,
+            })
+            values.update({
+                "mppt_low": mppt_i, "mppt_over_current": mppt_i,
+                "mppt_over_voltage": mppt_v, "mppt_over_power": mppt_v * mppt_i,
+            })
+
+        # Chỉ tạo Alert cho phần tử đổi trạng thái (thường là không có)
+        alerts = []
+        for kind, condition in conditions.items():
+            active = self.active[kind]
+            changed = condition != active
+            if not changed.any():
+                continue
+            reference = np.broadcast_to(references[kind], condition.shape)
+            value = np.broadcast_to(values[kind], condition.shape)
+            for r, c in zip(*np.nonzero(changed)):
+                alert = Alert(kind, self.layout.inverter_ids[r], int(c) + 1,
+                              float(value[r, c]), float(reference[r, c]), bool(condition[r, c]), ts)
+                alerts.append(alert)
+                if alert.raised:
+                    self.alerts_raised += 1
+                print(f"[Alert] {alert}")
+                if self.on_alert:
+                    self.on_alert(alert)
+            active[:] = condition
+        return alerts
+
+    # ------------------------------------------------------------------
+    # Truy vấn
+    # ------------------------------------------------------------------
+    def active_alerts(self) -> List[Dict[str, Any]]:
+        """Các alert đang active"""
+        result = []
+        for kind, active in self.active.items():
+            for r, c in zip(*np.nonzero(active)):
+                result.append({"kind": kind, "inverter_id": self.layout.inverter_ids[r], "index": int(c) + 1})
+        return result
+
+    def get_stats(self) -> Dict:
+        """Thống kê detector và thời gian mỗi lần đánh giá cả nhà máy (µs)"""
+        latencies = sorted(self._latencies)
+        stats = {
+            "strings": int(self.layout.string_valid.sum()),
+            "mppts": int(self.layout.mppt_valid.sum()),
+            "updates": self.updates,
+            "evaluations": self.evaluations,
+            "alerts_raised": self.alerts_raised,
+            "active": {kind: int(active.sum()) for kind, active in self.active.items() if active.any()},
+        }
+        if latencies:
+            stats.update({
+                "evaluate_p50_us": round(latencies[len(latencies) // 2], 1),
+                "evaluate_max_us": round(latencies[-1], 1),
+            })
+        return stats
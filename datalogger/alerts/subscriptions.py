@@ -0,0 +1,279 @@
+"""
+Subscriptions - Event bus trong process giữa poll loop và các consumer
+- Topic có kiểu: mỗi topic khai báo kiểu message, publish sai kiểu báo lỗi ngay ở nơi publish
+- Publish đồng bộ, không bao giờ await consumer: mỗi subscriber có hàng đợi giới hạn
+  và task giao riêng, consumer chậm chỉ làm chậm chính nó
+- Khi hàng đợi đầy: drop_oldest (bỏ message cũ nhất, cho sink cần mọi mẫu: DB, rollup)
+  hoặc coalesce (mỗi khóa chỉ giữ message mới nhất, vd mỗi inverter: TCP image, MQTT, detector)
+- Giao theo lô: mỗi lần thức dậy lấy tối đa batch_size message; handler nhận cả lô (batch=True)
+  hoặc từng message (NamedTuple được trải thành tham số: on_sample(inverter_id, ts, sample))
+- Sample là view vào ring buffer: message đã bị ghi đè trước khi kịp giao được bỏ (expired)
+- Thống kê từng subscriber: độ sâu hàng đợi, bỏ / gộp / hết hạn, độ trễ giao (p50/p99/max)
+"""
+import asyncio
+import inspect
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from typing import Any, Callable, Deque, Dict, Hashable, List, NamedTuple, Optional, Tuple
+
+from storage.cache import Sample
+
+DROP_OLDEST = "drop_oldest"
+COALESCE = "coalesce"
+POLICIES = (DROP_OLDEST, COALESCE)
+
+
+@dataclass(frozen=True)
+class Topic:
+    """Một loại sự kiện: tên, kiểu message, khóa gộp cho subscriber coalesce
+    và điều kiện message hết hạn (không còn giao được)"""
+    name: str
+    type: type
+    key: Optional[Callable[[Any], Hashable]] = None
+    expired: Optional[Callable[[Any], bool]] = None
+
+
+class SampleEvent(NamedTuple):
+    """Mẫu của một lần poll (view vào sample cache, không sao chép)"""
+    inverter_id: int
+    ts: float
+    sample: Sample
+
+
+class DataEvent(NamedTuple):
+    """Dữ liệu dạng dict của một nhóm (consumer cũ dùng storage callback)"""
+    inverter_id: int
+    data_type: str
+    data: Any
+
+
+# Mẫu realtime và mẫu chỉ có sản lượng không gộp với nhau; slot ring đã bị ghi đè thì bỏ
+TOPIC_SAMPLE = Topic("sample", SampleEvent, key=lambda e: (e.inverter_id, "ac" in e.sample or "mppt" in e.sample),
+                     expired=lambda e: e.sample.stale)
+TOPIC_DATA = Topic("data", DataEvent, key=lambda e: (e.inverter_id, e.data_type))
+
+
+class Subscription:
+    """Hàng đợi giới hạn + task giao message cho một handler"""
+
+    def __init__(self, topic: Topic, handler: Callable, name: str, policy: str = DROP_OLDEST,
+                 queue_size: int = 1000, batch_size: int = 100, batch: bool = False,
+                 lag_window: int = 1000):
+        if policy not in POLICIES:
+            raise ValueError(f"Chính sách hàng đợi không hợp lệ: {policy} (chọn {', '.join(POLICIES)})")
+        if policy == COALESCE and topic.key is None:
+            raise ValueError(f"Topic {topic.name} không có khóa để coalesce")
+        self.topic = topic
+        self.handler = handler
+        self.name = name
+        self.policy = policy
+        self.queue_size = max(1, queue_size)
+        self.batch_size = max(1, batch_size)
+        self.batch = batch                     # True: handler(list message)
+
+        # (thời điểm vào hàng đợi, message); coalesce: khóa -> (thời điểm, message mới nhất)
+        self._queue: Deque[Tuple[float, Any]] = deque()
+        self._latest: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._ready: Optional[asyncio.Event] = None
+        self.task: Optional[asyncio.Task] = None
+
+        # Thống kê
+        self.published = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.expired = 0
+        self.errors = 0
+        self.batches = 0
+        self._lags: Deque[float] = deque(maxlen=lag_window)  # giây
+
+    def __len__(self) -> int:
+        return len(self._latest) if self.policy == COALESCE else len(self._queue)
+
+    def offer(self, message: Any):
+        """Đưa message vào hàng đợi (đồng bộ, O(1)); đầy thì bỏ message cũ nhất"""
+        self.published += 1
+        now = time.monotonic()
+        if self.policy == COALESCE:
+            key = self.topic.key(message)
+            entry = self._latest.get(key)
+            if entry is not None:
+                # Giữ vị trí và thời điểm chờ của khóa: độ trễ phản ánh thời gian khóa chưa được giao
+                self._latest[key] = (entry[0], message)
+                self.coalesced += 1
+                return
+            if len(self._latest) >= self.queue_size:
+                self._latest.popitem(last=False)
+                self.dropped += 1
+            self._latest[key] = (now, message)
+        else:
+            if len(self._queue) >= self.queue_size:
+                self._queue.popleft()
+                self.dropped += 1
+            self._queue.append((now, message))
+        if self._ready is not None:
+            self._ready.set()
+
+    def _take(self) -> List[Tuple[float, Any]]:
+        if self.policy == COALESCE:
+            count = min(self.batch_size, len(self._latest))
+            return [self._latest.popitem(last=False)[1] for _ in range(count)]
+        count = min(self.batch_size, len(self._queue))
+        return [self._queue.popleft() for _ in range(count)]
+
+    async def _call(self, *args):
+        result = self.handler(*args)
+        if inspect.isawaitable(result):
+            await result
+
+    async def run(self):
+        """Giao message theo lô đến khi bị hủy"""
+        self._ready = asyncio.Event()
+        while True:
+            if not len(self):
+                self._ready.clear()
+                await self._ready.wait()
+            entries = self._take()
+            now = time.monotonic()
+            expired = self.topic.expired
+            messages = []
+            for queued_at, message in entries:
+                if expired is not None and expired(message):
+                    self.expired += 1
+                    continue
+                self._lags.append(now - queued_at)
+                messages.append(message)
+            self.batches += 1
+
+            if self.batch:
+                try:
+                    await self._call(messages)
+                    self.delivered += len(messages)
+                except Exception as e:
+                    self.errors += 1
+                    print(f"[Events] ❌ Lỗi subscriber {self.name}: {e}")
+            else:
+                for message in messages:
+                    try:
+                        if isinstance(message, tuple):
+                            await self._call(*message)
+                        else:
+                            await self._call(message)
+                        self.delivered += 1
+                    except Exception as e:
+                        self.errors += 1
+                        print(f"[Events] ❌ Lỗi subscriber {self.name}: {e}")
+            # Nhường event loop giữa các lô: handler không await vẫn không giữ loop quá một lô
+            await asyncio.sleep(0)
+
+    def lag(self, pct: float) -> Optional[float]:
+        """Phân vị độ trễ giao (giây) trên cửa sổ gần nhất"""
+        if not self._lags:
+            return None
+        lags = sorted(self._lags)
+        return lags[min(len(lags) - 1, int(len(lags) * pct / 100))]
+
+    def get_stats(self) -> Dict:
+        stats = {
+            "topic": self.topic.name,
+            "policy": self.policy,
+            "queued": len(self),
+            "queue_size": self.queue_size,
+            "published": self.published,
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+            "expired": self.expired,
+            "errors": self.errors,
+            "batches": self.batches,
+        }
+        if self._lags:
+            stats.update({
+                "lag_p50_ms": round(self.lag(50) * 1000, 2),
+                "lag_p99_ms": round(self.lag(99) * 1000, 2),
+                "lag_max_ms": round(max(self._lags) * 1000, 2),
+            })
+        return stats
+
+
+class EventBus:
+    """Danh sách subscriber theo topic; publish chỉ đưa message vào hàng đợi của từng subscriber"""
+
+    def __init__(self):
+        self.subscriptions: Dict[str, List[Subscription]] = {}
+        self._running = False
+        self.unrouted = 0
+
+    def subscribe(self, topic: Topic, handler: Callable, name: Optional[str] = None,
+                  **options) -> Subscription:
+        """Đăng ký handler (async hoặc thường) cho topic; options: policy, queue_size, batch_size, batch"""
+        subscription = Subscription(topic, handler, name or getattr(handler, "__qualname__", topic.name),
+                                    **options)
+        self.subscriptions.setdefault(topic.name, []).append(subscription)
+        if self._running:
+            subscription.task = asyncio.create_task(subscription.run())
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        subscriptions = self.subscriptions.get(subscription.topic.name, [])
+        if subscription in subscriptions:
+            subscriptions.remove(subscription)
+        if subscription.task:
+            subscription.task.cancel()
+
+    def has_subscribers(self, topic: Topic) -> bool:
+        return bool(self.subscriptions.get(topic.name))
+
+    def publish(self, topic: Topic, message: Any) -> int:
+        """Đưa message cho mọi subscriber của topic, trả về số subscriber (không chờ consumer)"""
+        if not isinstance(message, topic.type):
+            raise TypeError(f"Topic {topic.name} nhận {topic.type.__name__}, không phải {type(message).__name__}")
+        subscriptions = self.subscriptions.get(topic.name)
+        if not subscriptions:
+            self.unrouted += 1
+            return 0
+        for subscription in subscriptions:
+            subscription.offer(message)
+        return len(subscriptions)
+
+    async def run(self):
+        """Chạy task giao của mọi subscriber đến khi bị hủy"""
+        self._running = True
+        for subscriptions in self.subscriptions.values():
+            for subscription in subscriptions:
+                if subscription.task is None:
+                    subscription.task = asyncio.create_task(subscription.run())
+        try:
+            await asyncio.Event().wait()
+        finally:
+            self._running = False
+            tasks = [s.task for subs in self.subscriptions.values() for s in subs if s.task]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for subs in self.subscriptions.values():
+                for subscription in subs:
+                    subscription.task = None
+
+    def all(self) -> List[Subscription]:
+        return [s for subs in self.subscriptions.values() for s in subs]
+
+    def get_stats(self) -> Dict:
+        """Thống kê từng subscriber theo topic và tên"""
+        return {
+            "topics": {topic: {s.name: s.get_stats() for s in subs}
+                       for topic, subs in self.subscriptions.items()},
+            "unrouted": self.unrouted
+        }
+
+
+# Singleton instance
+_event_bus_instance: Optional[EventBus] = None
+
+def get_event_bus() -> EventBus:
+    """Lấy singleton event bus"""
+    global _event_bus_instance
+    if _event_bus_instance is None:
+        _event_bus_instance = EventBus()
+    return _event_bus_instance
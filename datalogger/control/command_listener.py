@@ -0,0 +1,100 @@
+"""
+Command listener - Nhận lệnh điều khiển và chuyển cho ModbusWriter
+- Lệnh dạng JSON: {"point", "value", "priority", đích: "inverter_id" | "project_id" | "all"}
+  vd {"project_id": 1, "point": "power_limit", "value": 60, "priority": "grid"}
+- Một lệnh cho project / toàn nhà máy được fan-out tới từng inverter
+- Nhận qua MQTT <prefix>/cmd, trả kết quả trên <prefix>/cmd/ack
+"""
+import asyncio
+import json
+from typing import Any, Callable, Dict, List, Optional
+
+from control.modbus_writer import (PRIORITIES, PRIORITY_NORMAL, STATUS_REJECTED, CommandResult,
+                                   ModbusWriter, get_modbus_writer)
+
+CMD_TOPIC = "cmd"
+ACK_TOPIC = "cmd/ack"
+
+
+class CommandListener:
+    """Giải mã lệnh, xác định inverter đích và gửi cho writer"""
+
+    def __init__(self, inverter_ids: List[int], projects: Optional[Dict[int, List[int]]] = None,
+                 writer: Optional[ModbusWriter] = None,
+                 on_result: Optional[Callable[[Dict[str, Any], List[CommandResult]], None]] = None):
+        self.inverter_ids = list(inverter_ids)
+        self.projects = projects or {}     # project_id -> danh sách inverter_id
+        self.writer = writer or get_modbus_writer()
+        self.on_result = on_result
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+        # Thống kê
+        self.received = 0
+        self.invalid = 0
+
+    def targets(self, message: Dict[str, Any]) -> List[int]:
+        """Danh sách inverter đích của lệnh"""
+        if "inverter_id" in message:
+            ids = message["inverter_id"]
+            return [int(i) for i in (ids if isinstance(ids, list) else [ids])]
+        if "project_id" in message:
+            project_id = int(message["project_id"])
+            if project_id not in self.projects:
+                raise ValueError(f"Project {project_id} không tồn tại")
+            return list(self.projects[project_id])
+        if message.get("all"):
+            return list(self.inverter_ids)
+        raise ValueError("Thiếu đích lệnh (inverter_id / project_id / all)")
+
+    async def handle(self, message: Dict[str, Any]) -> List[CommandResult]:
+        """Thực thi một lệnh, trả về kết quả của từng inverter"""
+        self.received += 1
+        try:
+            point = message["point"]
+            value = float(message["value"])
+            priority = message.get("priority", PRIORITY_NORMAL)
+            priority = PRIORITIES[priority] if isinstance(priority, str) else int(priority)
+            targets = self.targets(message)
+        except (KeyError, TypeError, ValueError) as e:
+            self.invalid += 1
+            print(f"[Control] ❌ Lệnh không hợp lệ {message}: {e}")
+            results = [CommandResult(0, 0, str(message.get("point")), 0, STATUS_REJECTED, error=str(e))]
+        else:
+            results = await self.writer.submit_many(targets, point, value, priority, message.get("source", ""))
+
+        if self.on_result:
+            self.on_result(message, results)
+        return results
+
+    # ------------------------------------------------------------------
+    # MQTT
+    # ------------------------------------------------------------------
+    def attach_mqtt(self, publisher):
+        """Nhận lệnh từ <prefix>/cmd, trả kết quả lên <prefix>/cmd/ack"""
+        self._loop = asyncio.get_running_loop()
+
+        def on_result(message: Dict[str, Any], results: List[CommandResult]):
+            publisher.publish(ACK_TOPIC, {"request": message, "results": [r.to_dict() for r in results]})
+
+        self.on_result = on_result
+        publisher.subscribe(f"{publisher.topic_prefix}/{CMD_TOPIC}", self._on_mqtt_message)
+
+    def _on_mqtt_message(self, topic: str, payload: bytes):
+        # Chạy trên thread của paho: chuyển sang event loop
+        try:
+            message = json.loads(payload)
+            if not isinstance(message, dict):
+                raise ValueError("lệnh phải là JSON object")
+        except ValueError as e:
+            self.invalid += 1
+            print(f"[Control] ❌ Payload không hợp lệ trên {topic}: {e}")
+            return
+        asyncio.run_coroutine_threadsafe(self.handle(message), self._loop)
+
+    def get_stats(self) -> Dict:
+        """Thống kê lệnh nhận được và của writer"""
+        return {
+            "received": self.received,
+            "invalid": self.invalid,
+            "writer": self.writer.get_stats()
+        }
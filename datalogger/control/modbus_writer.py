@@ -0,0 +1,223 @@
+"""
+Modbus writer - Hàng đợi lệnh điều khiển có ưu tiên, chen trước polling
+- Lệnh ghi đi qua hàng đợi ưu tiên của bus: chạy ở ranh giới frame kế tiếp,
+  không chờ hết các chu kỳ đọc đang xếp hàng
+- Mỗi bus chỉ một lệnh trên dây; lệnh chờ được chọn theo (priority, thứ tự đến)
+- Lệnh mới cho cùng inverter + điểm thay thế lệnh cũ chưa chạy (setpoint bị ghi đè)
+- Chỉ ghi các điểm trong danh sách cho phép (points), điểm khác bị từ chối
+- Ghi xong đọc lại để xác nhận, thử lại khi lỗi
+- Fan-out một setpoint tới nhiều inverter, các bus khác nhau chạy song song
+- Đo độ trễ từ lúc nhận lệnh đến khi xác nhận (command-to-ack)
+"""
+import asyncio
+import itertools
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from drivers.base import MappedDriver
+from engine.collector import get_inverter
+from modbus.bus import BusWorker
+
+# Mức ưu tiên (nhỏ hơn = ưu tiên hơn)
+PRIORITY_GRID = 0       # Lệnh điều độ lưới: cắt giảm / giới hạn công suất
+PRIORITY_OPERATOR = 1   # Lệnh vận hành thủ công
+PRIORITY_NORMAL = 2
+PRIORITIES = {"grid": PRIORITY_GRID, "operator": PRIORITY_OPERATOR, "normal": PRIORITY_NORMAL}
+
+# Kết quả lệnh
+STATUS_OK = "ok"
+STATUS_FAILED = "failed"              # Slave từ chối / không trả lời sau khi thử lại
+STATUS_MISMATCH = "verify_failed"     # Đọc lại khác giá trị đã ghi
+STATUS_SUPERSEDED = "superseded"      # Bị lệnh mới hơn cho cùng điểm thay thế trước khi chạy
+STATUS_REJECTED = "rejected"          # Inverter/điểm không tồn tại, không được phép hoặc giá trị ngoài phạm vi
+
+
+@dataclass
+class CommandResult:
+    """Kết quả một lệnh ghi"""
+    command_id: int
+    inverter_id: int
+    point: str
+    value: float
+    status: str
+    attempts: int = 0
+    latency: Optional[float] = None   # Giây, từ lúc nhận lệnh đến khi có kết quả
+    error: Optional[str] = None
+
+    def to_dict(self) -> Dict:
+        return {
+            "command_id": self.command_id,
+            "inverter_id": self.inverter_id,
+            "point": self.point,
+            "value": self.value,
+            "status": self.status,
+            "attempts": self.attempts,
+            "latency_ms": round(self.latency * 1000, 1) if self.latency is not None else None,
+            "error": self.error
+        }
+
+
+@dataclass
+class Command:
+    """Một lệnh ghi đang chờ"""
+    id: int
+    inverter_id: int
+    point: str
+    value: float
+    priority: int
+    future: asyncio.Future
+    source: str = ""
+    created_at: float = field(default_factory=time.monotonic)
+
+
+class ModbusWriter:
+    """Thực thi lệnh ghi trên bus của từng inverter"""
+
+    def __init__(self, verify: bool = True, retries: int = 2,
+                 resolve: Callable[[int], Optional[Tuple[BusWorker, MappedDriver]]] = get_inverter,
+                 latency_window: int = 1000, points: Optional[Iterable[str]] = None):
+        self.verify = verify
+        self.retries = retries
+        self.resolve = resolve          # inverter_id -> (bus, driver)
+        self.points = set(points) if points is not None else None  # None: mọi điểm writable của map
+        self._ids = itertools.count(1)
+
+        # Lệnh chờ theo bus, key (inverter_id, point) để lệnh mới thay lệnh cũ
+        self._pending: Dict[BusWorker, Dict[Tuple[int, str], Command]] = {}
+        self._draining: Dict[BusWorker, asyncio.Task] = {}
+
+        # Thống kê
+        self.submitted = 0
+        self.results: Dict[str, int] = {}
+        self._latencies: deque = deque(maxlen=latency_window)  # giây
+        self._waits: deque = deque(maxlen=latency_window)      # Thời gian chờ đến lượt (giây)
+
+    # ------------------------------------------------------------------
+    # Nhận lệnh
+    # ------------------------------------------------------------------
+    def _finish(self, command: Command, status: str, attempts: int = 0, error: Optional[str] = None):
+        latency = time.monotonic() - command.created_at
+        self.results[status] = self.results.get(status, 0) + 1
+        if status == STATUS_OK:
+            self._latencies.append(latency)
+        if not command.future.done():
+            command.future.set_result(CommandResult(command.id, command.inverter_id, command.point,
+                                                    command.value, status, attempts, latency, error))
+
+    def submit(self, inverter_id: int, point: str, value: float, priority: int = PRIORITY_NORMAL,
+               source: str = "") -> asyncio.Future:
+        """Xếp một lệnh ghi; future trả về CommandResult"""
+        future = asyncio.get_running_loop().create_future()
+        command = Command(next(self._ids), inverter_id, point, value, priority, future, source)
+        self.submitted += 1
+
+        if self.points is not None and point not in self.points:
+            self._finish(command, STATUS_REJECTED, error=f"Điểm '{point}' không nằm trong control.points")
+            return future
+        target = self.resolve(inverter_id)
+        if target is None:
+            self._finish(command, STATUS_REJECTED, error="Inverter chưa được polling")
+            return future
+        bus, driver = target
+        try:
+            driver.map.write_block(point, value)  # Kiểm tra điểm và phạm vi ngay khi nhận
+        except ValueError as e:
+            self._finish(command, STATUS_REJECTED, error=str(e))
+            return future
+
+        pending = self._pending.setdefault(bus, {})
+        old = pending.get((inverter_id, point))
+        if old is not None:
+            # Setpoint cũ chưa chạy: không cần ghi nữa. Giữ ưu tiên cao nhất của hai lệnh
+            command.priority = min(command.priority, old.priority)
+            self._finish(old, STATUS_SUPERSEDED)
+        pending[(inverter_id, point)] = command
+
+        if bus not in self._draining:
+            self._draining[bus] = asyncio.create_task(self._drain(bus))
+        return future
+
+    async def submit_many(self, inverter_ids: Iterable[int], point: str, value: float,
+                          priority: int = PRIORITY_NORMAL, source: str = "") -> List[CommandResult]:
+        """Fan-out một setpoint tới nhiều inverter và chờ tất cả kết quả"""
+        futures = [self.submit(inverter_id, point, value, priority, source) for inverter_id in inverter_ids]
+        return list(await asyncio.gather(*futures))
+
+    # ------------------------------------------------------------------
+    # Thực thi
+    # ------------------------------------------------------------------
+    async def _drain(self, bus: BusWorker):
+        """Chạy lần lượt các lệnh chờ của một bus, lệnh ưu tiên cao nhất trước"""
+        pending = self._pending[bus]
+        try:
+            while pending:
+                key = min(pending, key=lambda k: (pending[k].priority, pending[k].id))
+                command = pending.pop(key)
+                self._waits.append(time.monotonic() - command.created_at)
+                await self._execute(bus, command)
+        finally:
+            del self._draining[bus]
+
+    async def _execute(self, bus: BusWorker, command: Command):
+        target = self.resolve(command.inverter_id)
+        if target is None:
+            # Inverter bị gỡ khỏi polling (nạp lại cấu hình) trong lúc lệnh chờ
+            self._finish(command, STATUS_REJECTED, error="Inverter chưa được polling")
+            return
+        _, driver = target
+        status, error = STATUS_FAILED, None
+        attempts = 0
+        for attempts in range(1, self.retries + 2):
+            try:
+                result = await bus.run_urgent(driver.slave_id, driver.write_point, command.point,
+                                              command.value, self.verify)
+            except Exception as e:
+                result, error = "error", str(e)
+            if result == "ok":
+                status, error = STATUS_OK, None
+                break
+            status = STATUS_MISMATCH if result == "mismatch" else STATUS_FAILED
+
+        self._finish(command, status, attempts, error)
+        icon = "✅" if status == STATUS_OK else "❌"
+        print(f"[Control] {icon} Inverter {command.inverter_id} {command.point}={command.value} → {status} "
+              f"({(time.monotonic() - command.created_at) * 1000:.0f} ms, {attempts} lần)")
+
+    # ------------------------------------------------------------------
+    # Thống kê
+    # ------------------------------------------------------------------
+    def get_stats(self) -> Dict:
+        """Số lệnh theo kết quả và độ trễ command-to-ack (ms)"""
+        stats = {
+            "submitted": self.submitted,
+            "pending": sum(len(p) for p in self._pending.values()),
+            "results": dict(self.results),
+        }
+        for name, samples in (("ack", self._latencies), ("wait", self._waits)):
+            values = sorted(samples)
+            if values:
+                stats.update({
+                    f"{name}_p50_ms": round(values[len(values) // 2] * 1000, 1),
+                    f"{name}_p99_ms": round(values[min(len(values) - 1, int(len(values) * 0.99))] * 1000, 1),
+                    f"{name}_max_ms": round(values[-1] * 1000, 1),
+                })
+        return stats
+
+
+# Singleton instance
+_writer_instance: Optional[ModbusWriter] = None
+
+def get_modbus_writer() -> ModbusWriter:
+    """Lấy singleton modbus writer"""
+    global _writer_instance
+    if _writer_instance is None:
+        _writer_instance = ModbusWriter()
+    return _writer_instance
+
+def configure_writer(**options) -> ModbusWriter:
+    """Tạo lại writer với tham số từ cấu hình"""
+    global _writer_instance
+    _writer_instance = ModbusWriter(**options)
+    return _writer_instance
@@ -0,0 +1,77 @@
+from typing import Any, Dict, List, Optional
+
+from engine.mapper import BlockDecoder, get_register_map
+from modbus.bus import BusWorker
+from modbus.planner import DEFAULT_MAX_GAP
+
+
+class MappedDriver:
+    """Driver chung dựa trên register map YAML - thêm hãng mới chỉ cần file map"""
+
+    def __init__(self, bus: BusWorker, slave_id: int, map_name: str,
+                 max_gap: int = DEFAULT_MAX_GAP, **params):
+        # Client thuộc về bus, dùng chung cho mọi slave trên cùng cổng
+        self.bus = bus
+        self.slave_id = slave_id
+        self.max_gap = max_gap
+        self.map = get_register_map(map_name).compile(**params)
+
+        # Decoder (kế hoạch đọc gộp + struct) tính một lần
+        self.realtime_decoder = self.map.decoder(self.map.realtime_groups, max_gap)
+        self.energy_decoder = self.map.decoder(self.map.energy_groups, max_gap)
+        self.realtime_plan = self.realtime_decoder.plan
+
+    def read_block(self, address: int, count: int):
+        if self.map.register_type == "holding":
+            request = lambda client: client.read_holding_registers(
+                address + self.map.address_offset, count=count, slave=self.slave_id)
+        else:
+            request = lambda client: client.read_input_registers(
+                address + self.map.address_offset, count=count, slave=self.slave_id)
+
+        # Block lỗi được đọc lại ngay trên bus (retry budget), không đọc lại cả chu kỳ
+        result = self.bus.transaction(request, count, retry=True)
+        if result is None or result.isError():
+            return None
+        return result.registers
+
+    def read_groups(self, *groups: str) -> Dict[str, Any]:
+        """Đọc và decode các nhóm thanh ghi"""
+        return self.map.decoder(groups, self.max_gap).read(self.read_block)
+
+    def read_frames(self, decoder: BlockDecoder) -> List[Optional[List[int]]]:
+        """Đọc các frame của decoder, chưa decode (decode vào sample cache trên event loop)"""
+        return decoder.read_frames(self.read_block)
+
+    def read_all_realtime(self) -> Dict[str, Any]:
+        return self.realtime_decoder.read(self.read_block)
+
+    def read_energy(self) -> Optional[Dict[str, Any]]:
+        data = self.energy_decoder.read(self.read_block)
+        return data.get("energy")
+
+    def write_point(self, name: str, value: float, verify: bool = True) -> str:
+        """
+        Ghi một điểm điều khiển (FC16, gồm cả các điểm ghi kèm) rồi đọc lại để xác nhận.
+        Trả về "ok", "error" (slave từ chối / không trả lời) hoặc "mismatch" (đọc lại khác).
+        ValueError nếu điểm không tồn tại hoặc giá trị ngoài phạm vi.
+        """
+        address, values = self.map.write_block(name, value)
+        address += self.map.address_offset
+
+        result = self.bus.transaction(lambda client: client.write_registers(
+            address, values, slave=self.slave_id), len(values))
+        if result is None or result.isError():
+            return "error"
+        if not verify:
+            return "ok"
+
+        result = self.bus.transaction(lambda client: client.read_holding_registers(
+            address, count=len(values), slave=self.slave_id), len(values))
+        if result is None or result.isError():
+            return "error"
+        return "ok" if list(result.registers) == values else "mismatch"
+
+    def close(self):
+        # Client được đóng khi bus dừng (dùng chung với các slave khác)
+        pass
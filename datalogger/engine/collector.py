@@ -1,77 +1,160 @@
-import asyncio
-from typing import Dict, Any, Optional
+import time
+from typing import Dict, Any, Optional, Tuple
+from drivers.base import MappedDriver
 from drivers.sungrow import SungrowDriver
+from alerts.subscriptions import TOPIC_DATA, DataEvent, get_event_bus
 from engine.scheduler import get_scheduler, PollingType, PollingTask
+from engine.policy import get_policy
+from modbus.bus import BusWorker, get_bus_manager
+from modbus.planner import DEFAULT_MAX_GAP
+from storage.cache import Sample, get_sample_cache
+from storage.journal import KIND_ENERGY, KIND_REALTIME, get_journal
+from utils.logger import is_debug
 
-# Storage callback - sẽ được gán từ bên ngoài (cache, DB, TCP server)
-storage_callback: Optional[callable] = None
+# Bus + driver của từng inverter đang được polling (dùng chung cho lệnh điều khiển)
+inverters: Dict[int, Tuple[BusWorker, MappedDriver]] = {}
 
-def set_storage_callback(callback: callable):
-    """Đăng ký callback để lưu dữ liệu"""
-    global storage_callback
-    storage_callback = None # Reset callback trước khi đăng ký mới                                                                      
-    storage_callback = callback
+def get_inverter(inverter_id: int) -> Optional[Tuple[BusWorker, MappedDriver]]:
+    """Bus và driver của một inverter, None nếu chưa đăng ký polling"""
+    return inverters.get(inverter_id)
+
+# Storage callback dạng dict - đăng ký vào topic "data" của event bus (hàng đợi riêng, không chặn poll)
+storage_subscription = None
+
+def set_storage_callback(callback: callable, **options):
+    """Đăng ký callback (inverter_id, data_type, data) để lưu dữ liệu; options: chính sách hàng đợi"""
+    global storage_subscription
+    events = get_event_bus()
+    if storage_subscription is not None:
+        events.unsubscribe(storage_subscription) # Bỏ callback cũ trước khi đăng ký mới
+    storage_subscription = events.subscribe(TOPIC_DATA, callback, name="storage_callback", **options)
+
+# Sample callback - nhận cả mẫu của một lần poll (một lần gọi mỗi chu kỳ), vd local DB
+sample_callback: Optional[callable] = None
+
+def set_sample_callback(callback: callable):
+    """Đăng ký callback nhận nguyên mẫu (inverter_id, ts, sample) mỗi lần poll"""
+    global sample_callback
+    sample_callback = callback
+
+async def handle_sample(inverter_id: int, ts: float, sample: Sample):
+    """Chuyển nguyên mẫu (view vào sample cache, không sao chép) của một lần poll cho sample callback"""
+    if sample_callback:
+        try:
+            await sample_callback(inverter_id, ts, sample)
+        except Exception as e:
+            print(f"[Collector] ❌ Lỗi lưu mẫu: {e}")
+
+async def dispatch_sample(inverter_id: int, sample: Sample):
+    """Chuyển một mẫu cho sample callback và (nếu có subscriber) topic "data" dạng dict từng nhóm"""
+    await handle_sample(inverter_id, sample.ts, sample)
+    if get_event_bus().has_subscribers(TOPIC_DATA) or is_debug():
+        # Dạng dict chỉ dựng khi có consumer cũ cần
+        data = sample.to_dict()
+        if "ac" in data or "mppt" in data:
+            await handle_data(inverter_id, "ac", data.get("ac", {}))
+            await handle_data(inverter_id, "mppt", data.get("mppt", []))
+            await handle_data(inverter_id, "strings", data.get("strings", []))
+            await handle_data(inverter_id, "error", data.get("error", {}))
+            await handle_data(inverter_id, "energy", data.get("energy", {}))
+        else:
+            await handle_data(inverter_id, "energy", data.get("energy"))
 
 async def handle_data(inverter_id: int, data_type: str, data: Dict[str, Any]):
     """Xử lý dữ liệu từ inverter"""
-    # In ra console
-    print(f"[{inverter_id}] {data_type}: {data}")
+    # In ra console (chỉ ở mức debug: format cả payload mỗi chu kỳ rất tốn)
+    if is_debug():
+        print(f"[{inverter_id}] {data_type}: {data}")
     
-    # Gọi storage callback nếu có
-    if storage_callback:
-        try:
-            await storage_callback(inverter_id, data_type, data)
-        except Exception as e:
-            print(f"[Collector] ❌ Lỗi lưu dữ liệu: {e}")
-
-async def poll_realtime(driver: SungrowDriver, inverter_id: int):
-    """Polling dữ liệu realtime từ driver"""
-    data = driver.read_all_realtime()
-    if data:
-        await handle_data(inverter_id, "ac", data.get("ac", {}))
-        await handle_data(inverter_id, "mppt", data.get("mppt", []))
-        await handle_data(inverter_id, "strings", data.get("strings", []))
-        await handle_data(inverter_id, "error", data.get("error", {}))
-        await handle_data(inverter_id, "energy", data.get("energy", {}))
+    # Chỉ đưa vào hàng đợi của subscriber, không chờ consumer
+    get_event_bus().publish(TOPIC_DATA, DataEvent(inverter_id, data_type, data))
+
+async def poll_realtime(bus: BusWorker, driver: MappedDriver, inverter_id: int):
+    """Polling dữ liệu realtime từ driver (I/O chạy trên thread của bus, decode vào sample cache)"""
+    policy = get_policy()
+    try:
+        frames = await bus.run(driver.slave_id, driver.read_frames, driver.realtime_decoder)
+    except Exception:
+        # Lỗi ngoài frame (mất cổng, lỗi client...): vẫn tính là một lần poll thất bại
+        policy.on_failure(inverter_id)
+        raise
+    ts = time.time()
+    journal = get_journal()
+    if journal:
+        # Frame thô trước khi decode: giải lại được nếu decoder sau này được sửa
+        journal.record(inverter_id, driver.slave_id, ts, KIND_REALTIME, driver.map.address_offset,
+                       driver.realtime_decoder.layouts, frames)
+    ring = get_sample_cache().ring(inverter_id, driver.map)
+    sample = ring.append(ts, driver.realtime_decoder, frames)
+    # None: tất cả nhóm đều lỗi = slave không trả lời
+    if sample is not None:
+        policy.observe(inverter_id, sample)
+        await dispatch_sample(inverter_id, sample)
     else:
+        policy.on_failure(inverter_id)
         raise Exception("Không đọc được dữ liệu realtime")
 
-async def poll_energy(driver: SungrowDriver, inverter_id: int):
-    """Polling dữ liệu sản lượng từ driver"""
-    energy = driver.read_energy()
-    if energy:
-        await handle_data(inverter_id, "energy", energy)
+async def poll_energy(bus: BusWorker, driver: MappedDriver, inverter_id: int):
+    """Polling dữ liệu sản lượng từ driver (I/O chạy trên thread của bus)"""
+    policy = get_policy()
+    if not policy.should_read_energy(inverter_id):
+        return  # Sản lượng không thể thay đổi hoặc vừa được đọc trong poll realtime
+
+    frames = await bus.run(driver.slave_id, driver.read_frames, driver.energy_decoder)
+    ts = time.time()
+    journal = get_journal()
+    if journal:
+        journal.record(inverter_id, driver.slave_id, ts, KIND_ENERGY, driver.map.address_offset,
+                       driver.energy_decoder.layouts, frames)
+    ring = get_sample_cache().ring(inverter_id, driver.map)
+    sample = ring.append(ts, driver.energy_decoder, frames)
+    if sample is not None and sample.has("energy"):
+        policy.on_energy(inverter_id)
+        await dispatch_sample(inverter_id, sample)
     else:
         raise Exception("Không đọc được dữ liệu sản lượng")
 
-async def start_inverter_polling(config: dict, realtime_interval: int = 5, energy_interval: int = 900):
-    """Khởi động polling cho một inverter với scheduler"""
-    inverter_id = config["id"]
-    port = config["port"]
+def build_driver(bus, config: dict) -> MappedDriver:
+    """Driver của một inverter theo config (register map riêng hoặc Sungrow mặc định)"""
     slave_id = config["slave_id"]
     mppt_count = config.get("mppt_count", 9)
     string_count = config.get("string_count", 18)
+    max_gap = config.get("max_gap", DEFAULT_MAX_GAP)
+    if config.get("register_map"):
+        # Hãng/model khác: driver chung theo file register map
+        return MappedDriver(bus, slave_id, config["register_map"], max_gap,
+                            mppt_count=mppt_count, string_count=string_count)
+    return SungrowDriver(bus, slave_id, mppt_count, string_count, max_gap)
 
-    # Tạo driver
-    driver = SungrowDriver(port, slave_id, mppt_count, string_count)
+async def start_inverter_polling(config: dict, realtime_interval: int = 5, energy_interval: int = 900):
+    """Khởi động polling cho một inverter với scheduler"""
+    inverter_id = config["id"]
+    phase = config.get("phase", 0.0)
+
+    # Các inverter cùng cổng dùng chung một bus (một client, một hàng đợi)
+    bus = get_bus_manager().get(config["port"], baudrate=config.get("baudrate", 9600))
+    driver = build_driver(bus, config)
+    print(f"[Collector] 📦 Inverter {inverter_id}: {driver.realtime_plan}")
+    inverters[inverter_id] = (bus, driver)
 
     # Lấy scheduler
     scheduler = get_scheduler()
     
     # Tạo handler functions
     async def realtime_handler():
-        return await poll_realtime(driver, inverter_id)
+        return await poll_realtime(bus, driver, inverter_id)
     
     async def energy_handler():
-        return await poll_energy(driver, inverter_id)
+        return await poll_energy(bus, driver, inverter_id)
     
-    # Đăng ký tasks với scheduler
+    # Đăng ký tasks với scheduler (không retry cả handler: block lỗi được đọc lại trên bus)
     scheduler.add_task(inverter_id, PollingTask(
         type=PollingType.REALTIME,
         interval=realtime_interval,
         inverter_id=inverter_id,
         handler=realtime_handler,
-        max_retries=3
+        max_retries=0,
+        phase=phase
     ))
     
     scheduler.add_task(inverter_id, PollingTask(
@@ -79,14 +162,31 @@ async def start_inverter_polling(config: dict, realtime_interval: int = 5, energ
         interval=energy_interval,
         inverter_id=inverter_id,
         handler=energy_handler,
-        max_retries=2
+        max_retries=0,
+        phase=phase
     ))
     
     print(f"[Collector] ✅ Đã đăng ký polling cho inverter {inverter_id}")
 
-async def start_all_polling(inverter_configs: list, realtime_interval: int = 5, energy_interval: int = 900):
+def assign_phases(inverter_configs: list, realtime_interval: int, stagger: Optional[float] = None):
+    """
+    Gán lệch pha cho các inverter trên cùng một cổng để không cùng lúc chiếm bus.
+    Mặc định chia đều realtime_interval cho số inverter trên cổng; config "phase" được ưu tiên.
+    """
+    by_port: Dict[str, list] = {}
+    for config in inverter_configs:
+        by_port.setdefault(config["port"], []).append(config)
+
+    for configs in by_port.values():
+        step = stagger if stagger is not None else realtime_interval / len(configs)
+        for index, config in enumerate(configs):
+            config.setdefault("phase", (index * step) % realtime_interval)
+
+async def start_all_polling(inverter_configs: list, realtime_interval: int = 5, energy_interval: int = 900,
+                            stagger: Optional[float] = None):
     """Khởi động polling cho tất cả inverters"""
     scheduler = get_scheduler()
+    assign_phases(inverter_configs, realtime_interval, stagger)
     
     # Đăng ký tất cả inverters
     for config in inverter_configs:
@@ -0,0 +1,367 @@
+"""
+Mapper - Register map khai báo bằng YAML, compile thành decoder theo frame
+- Mỗi model có một file map trong config/register_maps/ (address, type, scale, wordorder, sentinel)
+- Map được compile một lần theo tham số (số MPPT, số string...) và nhóm cần đọc
+- Mỗi frame đọc về được decode bằng struct đã compile sẵn trong một lần unpack,
+  sau đó chỉ áp sentinel/scale - không tạo decoder cho từng giá trị
+- Hoặc decode thẳng giá trị thô vào hàng của mảng cột (mẫu compact, xem storage/cache.py)
+- Thanh ghi điều khiển (writable) khai báo cùng map, encode thành một block ghi FC16
+"""
+import os
+import struct
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from modbus.planner import DEFAULT_MAX_GAP, ReadPlan
+from utils.config_loader import load_yaml_file
+
+MAPS_DIR = "register_maps"
+
+# type -> (số thanh ghi, mã struct, sentinel mặc định)
+TYPES = {
+    "u16": (1, "H", 0xFFFF),
+    "s16": (1, "h", 0x7FFF),
+    "u32": (2, "I", 0xFFFFFFFF),
+    "s32": (2, "i", 0x7FFFFFFF),
+}
+
+# wordorder -> ký tự endian của struct.
+# pymodbus trả về từng thanh ghi dạng int nên byteorder trong thanh ghi đã được giải quyết;
+# chỉ còn thứ tự word của giá trị 32 bit. Pack các thanh ghi theo cùng endian với word
+# order thì unpack 'I'/'i' cho ra đúng giá trị.
+WORDORDER = {"big": ">", "little": "<"}
+
+# Mã struct không dấu theo số thanh ghi: giá trị thô lưu trong mảng cột 'H' / 'I'
+RAW_CODES = {1: "H", 2: "I"}
+
+
+@dataclass(frozen=True)
+class FieldSpec:
+    """Một trường đã được mở rộng (địa chỉ tuyệt đối)"""
+    group: str
+    index: Optional[int]       # Vị trí trong nhóm lặp (MPPT/string), None nếu là record
+    path: Tuple[str, ...]      # Đường dẫn key, vd ("fault_time", "year")
+    address: int
+    type: str
+    scale: float
+    wordorder: str
+    sentinel: Optional[int]
+
+    @property
+    def width(self) -> int:
+        return TYPES[self.type][0]
+
+
+def make_scaler(scale: float) -> Callable[[int], Any]:
+    """Tạo hàm áp scale; chia cho số nguyên khi có thể để giữ giá trị thập phân gọn"""
+    if scale == 1:
+        return lambda raw: raw
+    divisor = 1 / scale
+    if abs(divisor - round(divisor)) < 1e-9:
+        divisor = round(divisor)
+        return lambda raw: raw / divisor
+    return lambda raw: raw * scale
+
+
+class FrameLayout:
+    """Layout đã compile của một frame: struct pack + các lớp struct unpack"""
+
+    def __init__(self, start: int, count: int, fields: List[FieldSpec],
+                 columns: Dict[FieldSpec, Tuple[int, int]]):
+        self.start = start
+        self.count = count
+        self.groups = {f.group for f in fields}
+        self.packers: Dict[str, struct.Struct] = {}
+        self.layers: List[Tuple[str, struct.Struct, List[Tuple]]] = []
+        # Cùng các lớp nhưng unpack không dấu, kèm (độ rộng, cột) để ghi vào mảng cột
+        self.raw_layers: List[Tuple[str, struct.Struct, List[Tuple[int, int]]]] = []
+
+        for wordorder in sorted({f.wordorder for f in fields}):
+            endian = WORDORDER[wordorder]
+            self.packers[wordorder] = struct.Struct(f"{endian}{count}H")
+
+            # Các trường chồng lấn nhau được tách ra nhiều lớp không chồng lấn
+            layers: List[List[FieldSpec]] = []
+            for f in sorted((f for f in fields if f.wordorder == wordorder), key=lambda f: f.address):
+                for layer in layers:
+                    last = layer[-1]
+                    if last.address + last.width <= f.address:
+                        layer.append(f)
+                        break
+                else:
+                    layers.append([f])
+
+            for layer in layers:
+                fmt, raw_fmt, pos = endian, endian, start
+                for f in layer:
+                    if f.address > pos:
+                        fmt += f"{(f.address - pos) * 2}x"
+                        raw_fmt += f"{(f.address - pos) * 2}x"
+                    fmt += TYPES[f.type][1]
+                    raw_fmt += RAW_CODES[f.width]
+                    pos = f.address + f.width
+                slots = [(f.group, f.index, f.path[:-1], f.path[-1], f.sentinel, make_scaler(f.scale))
+                         for f in layer]
+                self.layers.append((wordorder, struct.Struct(fmt), slots))
+                self.raw_layers.append((wordorder, struct.Struct(raw_fmt), [columns[f] for f in layer]))
+
+
+class BlockDecoder:
+    """Decoder cho một tập nhóm: kế hoạch đọc gộp + layout từng frame"""
+
+    def __init__(self, cmap: "CompiledMap", groups: Iterable[str], max_gap: int = DEFAULT_MAX_GAP):
+        self.map = cmap
+        self.groups = list(groups)
+        fields = [f for f in cmap.fields if f.group in self.groups]
+        self.plan = ReadPlan([(f.address, f.width) for f in fields], max_gap=max_gap)
+
+        self.layouts: List[FrameLayout] = []
+        for frame in self.plan.frames:
+            frame_fields = [f for f in fields if frame.start <= f.address < frame.end]
+            self.layouts.append(FrameLayout(frame.start, frame.count, frame_fields, cmap.columns))
+
+    def read_frames(self, read_block: Callable[[int, int], Optional[List[int]]]) -> List[Optional[List[int]]]:
+        """Đọc tất cả frame bằng read_block(start, count), chưa decode"""
+        return [read_block(layout.start, layout.count) for layout in self.layouts]
+
+    def read(self, read_block: Callable[[int, int], Optional[List[int]]]) -> Dict[str, Any]:
+        """Đọc tất cả frame bằng read_block(start, count) và decode"""
+        return self.decode(self.read_frames(read_block))
+
+    def _failed_groups(self, frames: List[Optional[List[int]]]) -> set:
+        failed = set()
+        for layout, regs in zip(self.layouts, frames):
+            if not regs or len(regs) < layout.count:
+                failed |= layout.groups
+        return failed
+
+    def decode_into(self, frames: List[Optional[List[int]]], words, dwords,
+                    word_base: int, dword_base: int) -> List[str]:
+        """
+        Decode giá trị thô (chưa scale/sentinel) vào một hàng của mảng cột:
+        trường 16 bit -> words[word_base + cột], 32 bit -> dwords[dword_base + cột].
+        Trả về các nhóm đọc được; cột của nhóm lỗi không còn ý nghĩa (người đọc kiểm tra nhóm).
+        """
+        failed = self._failed_groups(frames)
+        for layout, regs in zip(self.layouts, frames):
+            if not regs or len(regs) < layout.count:
+                continue
+            buffers = {wo: packer.pack(*regs[:layout.count]) for wo, packer in layout.packers.items()}
+            for wordorder, layer, columns in layout.raw_layers:
+                for (width, column), raw in zip(columns, layer.unpack_from(buffers[wordorder])):
+                    if width == 1:
+                        words[word_base + column] = raw
+                    else:
+                        dwords[dword_base + column] = raw
+        return [g for g in self.groups if g not in failed]
+
+    def decode(self, frames: List[Optional[List[int]]]) -> Dict[str, Any]:
+        """Decode các frame đã đọc (cùng thứ tự với plan). Nhóm có frame lỗi trả về None"""
+        failed = self._failed_groups(frames)
+
+        out = {g: (None if g in failed else self.map.new_container(g)) for g in self.groups}
+
+        for layout, regs in zip(self.layouts, frames):
+            if not regs or len(regs) < layout.count:
+                continue
+            # Frame đọc được nhưng chứa một phần của nhóm lỗi ở frame khác: vẫn decode các nhóm còn lại
+            partial = layout.groups & failed
+            buffers = {wo: packer.pack(*regs[:layout.count]) for wo, packer in layout.packers.items()}
+            for wordorder, layer, slots in layout.layers:
+                values = layer.unpack_from(buffers[wordorder])
+                for (group, index, parents, key, sentinel, scale), raw in zip(slots, values):
+                    if partial and group in failed:
+                        continue
+                    target = out[group]
+                    if index is not None:
+                        target = target[index]
+                    for p in parents:
+                        target = target[p]
+                    target[key] = None if raw == sentinel else scale(raw)
+        return out
+
+
+class WritePoint:
+    """Một điểm điều khiển (holding register) có thể ghi"""
+
+    def __init__(self, name: str, spec: Dict[str, Any], default_wordorder: str):
+        self.name = name
+        self.address = spec["address"]
+        self.type = spec.get("type", "u16")
+        if self.type not in TYPES:
+            raise ValueError(f"[Mapper] Kiểu không hỗ trợ '{self.type}' (writable.{name})")
+        self.scale = spec.get("scale", 1)
+        self.min = spec.get("min")
+        self.max = spec.get("max")
+        self.wordorder = spec.get("wordorder", default_wordorder)
+        self.with_ = spec.get("with", {})  # Điểm khác ghi kèm trong cùng frame, vd bật công tắc giới hạn
+        width, code, _ = TYPES[self.type]
+        endian = WORDORDER[self.wordorder]
+        self.width = width
+        self._value = struct.Struct(f"{endian}{code}")
+        self._words = struct.Struct(f"{endian}{width}H")
+
+    def encode(self, value: float) -> List[int]:
+        """Giá trị vật lý -> thanh ghi; ValueError nếu ngoài [min, max]"""
+        if (self.min is not None and value < self.min) or (self.max is not None and value > self.max):
+            raise ValueError(f"{self.name}={value} ngoài phạm vi [{self.min}, {self.max}]")
+        try:
+            return list(self._words.unpack(self._value.pack(round(value / self.scale))))
+        except struct.error as e:
+            raise ValueError(f"{self.name}={value}: {e}") from e
+
+    def decode(self, registers: List[int]) -> float:
+        return make_scaler(self.scale)(self._value.unpack(self._words.pack(*registers[:self.width]))[0])
+
+
+class CompiledMap:
+    """Register map đã mở rộng theo tham số (số MPPT, số string...)"""
+
+    def __init__(self, spec: Dict[str, Any], params: Dict[str, int]):
+        self.name = spec["model"]
+        self.register_type = spec.get("register_type", "input")
+        self.address_offset = spec.get("address_offset", 0)
+        self.realtime_groups = spec.get("realtime_groups", list(spec["groups"]))
+        self.energy_groups = spec.get("energy_groups", [])
+        default_wordorder = spec.get("wordorder", "big")
+
+        self.fields: List[FieldSpec] = []
+        self._templates: Dict[str, Tuple] = {}
+        for group, gspec in spec["groups"].items():
+            repeat = gspec.get("repeat")
+            count = params[repeat] if isinstance(repeat, str) else repeat
+            keys = [tuple(fs["name"].split(".")) for fs in gspec["fields"]]
+            self._templates[group] = (count, gspec.get("index_key", "index"), keys)
+
+            for i in range(count if count is not None else 1):
+                for fs in gspec["fields"]:
+                    if count is None:
+                        address = fs["address"]
+                    else:
+                        address = gspec["address"] + i * gspec.get("stride", 1) + fs.get("offset", 0)
+                    ftype = fs.get("type", "u16")
+                    if ftype not in TYPES:
+                        raise ValueError(f"[Mapper] Kiểu không hỗ trợ '{ftype}' ({self.name}.{fs['name']})")
+                    self.fields.append(FieldSpec(
+                        group=group,
+                        index=i if count is not None else None,
+                        path=tuple(fs["name"].split(".")),
+                        address=address,
+                        type=ftype,
+                        scale=fs.get("scale", 1),
+                        wordorder=fs.get("wordorder", default_wordorder),
+                        sentinel=fs.get("sentinel", TYPES[ftype][2])
+                    ))
+
+        # Cột của mẫu compact: trường 16 bit vào mảng words, 32 bit vào mảng dwords.
+        # Sắp theo (nhóm, trường, index) để một trường của nhóm lặp là một dải cột liền nhau
+        group_rank = {group: i for i, group in enumerate(self._templates)}
+        path_rank = {(group, path): i for group, (_, _, keys) in self._templates.items()
+                     for i, path in enumerate(keys)}
+        self.columns: Dict[FieldSpec, Tuple[int, int]] = {}  # field -> (độ rộng, cột)
+        widths = {1: 0, 2: 0}
+        for f in sorted(self.fields, key=lambda f: (group_rank[f.group], path_rank[(f.group, f.path)],
+                                                    f.index or 0)):
+            self.columns[f] = (f.width, widths[f.width])
+            widths[f.width] += 1
+        self.word_count, self.dword_count = widths[1], widths[2]
+
+        self.writable: Dict[str, WritePoint] = {
+            name: WritePoint(name, wspec, default_wordorder) for name, wspec in spec.get("writable", {}).items()
+        }
+        self._decoders: Dict[Tuple, BlockDecoder] = {}
+
+    @property
+    def groups(self) -> List[str]:
+        """Tên các nhóm theo thứ tự khai báo"""
+        return list(self._templates)
+
+    def template(self, group: str) -> Tuple[Optional[int], str, List[Tuple[str, ...]]]:
+        """(số phần tử nếu là nhóm lặp, key chỉ số, đường dẫn các trường) của một nhóm"""
+        return self._templates[group]
+
+    def new_container(self, group: str):
+        """Tạo cấu trúc rỗng của một nhóm, giữ đúng thứ tự key khai báo"""
+        count, index_key, keys = self._templates[group]
+
+        def record():
+            rec: Dict[str, Any] = {}
+            for path in keys:
+                target = rec
+                for p in path[:-1]:
+                    target = target.setdefault(p, {})
+                target[path[-1]] = None
+            return rec
+
+        if count is None:
+            return record()
+        items = []
+        for i in range(count):
+            item = {index_key: i + 1}
+            item.update(record())
+            items.append(item)
+        return items
+
+    def write_block(self, name: str, value: float) -> Tuple[int, List[int]]:
+        """
+        Block ghi cho một điểm điều khiển: (địa chỉ đầu, thanh ghi).
+        Các điểm trong "with" được ghép vào cùng frame, phải liền kề nhau.
+        """
+        point = self.writable.get(name)
+        if point is None:
+            raise ValueError(f"[Mapper] {self.name} không có điểm điều khiển '{name}'")
+        parts = [(point.address, point.encode(value))]
+        for other, other_value in point.with_.items():
+            parts.append((self.writable[other].address, self.writable[other].encode(other_value)))
+        parts.sort()
+
+        start, registers = parts[0][0], []
+        for address, words in parts:
+            if address != start + len(registers):
+                raise ValueError(f"[Mapper] {self.name}.{name}: các điểm ghi kèm không liền kề")
+            registers.extend(words)
+        return start, registers
+
+    def decoder(self, groups: Iterable[str], max_gap: int = DEFAULT_MAX_GAP) -> BlockDecoder:
+        """Lấy decoder (cache) cho một tập nhóm"""
+        key = (tuple(groups), max_gap)
+        if key not in self._decoders:
+            self._decoders[key] = BlockDecoder(self, key[0], max_gap)
+        return self._decoders[key]
+
+
+class RegisterMap:
+    """Register map thô đọc từ YAML; compile theo tham số khi cần"""
+
+    def __init__(self, spec: Dict[str, Any]):
+        self.spec = spec
+        self.name = spec["model"]
+        self._compiled: Dict[Tuple, CompiledMap] = {}
+
+    def deadbands(self) -> Dict[str, Dict[str, float]]:
+        """Deadband khai báo trong map, key dạng "ac.power" (dùng cho report-by-exception);
+        deadband của nhóm áp cho các trường không khai báo riêng"""
+        result = {}
+        for group, gspec in self.spec["groups"].items():
+            for fs in gspec["fields"]:
+                band = fs.get("deadband", gspec.get("deadband"))
+                if band is not None:
+                    result[f"{group}.{fs['name']}"] = band
+        return result
+
+    def compile(self, **params) -> CompiledMap:
+        """Compile (cache) map cho một bộ tham số"""
+        key = tuple(sorted(params.items()))
+        if key not in self._compiled:
+            self._compiled[key] = CompiledMap(self.spec, params)
+        return self._compiled[key]
+
+
+# Cache: tên map -> RegisterMap
+_maps: Dict[str, RegisterMap] = {}
+
+def get_register_map(name: str) -> RegisterMap:
+    """Load register map theo tên file (không có .yaml), chỉ đọc file một lần"""
+    if name not in _maps:
+        _maps[name] = RegisterMap(load_yaml_file(os.path.join(MAPS_DIR, f"{name}.yaml")))
+    return _maps[name]
@@ -0,0 +1,357 @@
+"""
+Plant - Gộp mẫu của các inverter trong một project thành snapshot nhà máy căn theo thời gian
+- Mỗi inverter giữ phần đóng góp mới nhất (công suất, sản lượng ngày, tổng sản lượng);
+  tổng nhà máy cập nhật tăng dần khi mẫu đến (trừ phần cũ, cộng phần mới)
+- Snapshot phát tại mốc wall-clock bội số chu kỳ realtime: mọi inverter được đánh giá
+  tại cùng một thời điểm, consumer không phải tự ghép các timestamp lệch pha
+- Inverter không gửi mẫu trong chu kỳ: dùng lại giá trị cũ (stale) đến stale_after giây,
+  sau đó coi là mất (missing), bỏ công suất khỏi tổng; sản lượng đã phát trong ngày vẫn giữ
+- Sản lượng giữa hai lần đọc bộ đếm (chu kỳ energy 15 phút) ước tính bằng tích phân công suất
+- Availability: tỷ lệ inverter có dữ liệu và không fault; specific yield / capacity factor
+  theo capacity_kwp / ac_capacity_kw; performance ratio khi có bức xạ từ cảm biến
+  (MQTT <prefix>/irradiance/<project_id>, W/m²)
+- Snapshot là record riêng trên topic "plant" của event bus: lưu local DB, publish MQTT,
+  unit riêng trên Modbus TCP server
+"""
+import asyncio
+import json
+import math
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, List, Optional
+
+from alerts.subscriptions import Topic, get_event_bus
+from storage.cache import Sample
+
+STATUS_OK = "ok"
+STATUS_STALE = "stale"
+STATUS_MISSING = "missing"
+
+# Vị trí trong mảng tổng của project
+POWER, ENERGY_DAY, ENERGY_TOTAL = range(3)
+
+MIN_IRRADIANCE = 50  # W/m²: dưới ngưỡng này performance ratio không có ý nghĩa
+IRRADIANCE_TOPIC = "irradiance"  # <prefix>/irradiance/<project_id>: số hoặc {"irradiance": W/m², "ts": epoch}
+
+# Nguồn "nhóm.trường" của inverter -> trường snapshot (để register image dùng chung tên)
+SOURCES = {
+    ("ac", "power"): "power_w",
+    ("energy", "energy_day_kwh"): "energy_day_kwh",
+    ("energy", "energy_total_kwh"): "energy_total_kwh",
+}
+
+
+def local_day(ts: float) -> int:
+    """Số thứ tự ngày theo giờ địa phương"""
+    return int((ts + time.localtime(ts).tm_gmtoff) // 86400)
+
+
+@dataclass
+class Project:
+    """Một nhà máy trong projects.yaml"""
+    id: int
+    name: str
+    inverters: List[int]
+    capacity_kwp: float = 0
+    ac_capacity_kw: float = 0
+
+
+@dataclass
+class PlantSnapshot:
+    """Trạng thái nhà máy tại một mốc thời gian"""
+    project_id: int
+    ts: float
+    power_w: float
+    energy_day_kwh: float
+    energy_total_kwh: float
+    reporting: int                      # Có mẫu trong chu kỳ vừa qua
+    stale: int                          # Dùng lại giá trị cũ
+    missing: int                        # Không có dữ liệu / quá stale_after
+    faulted: int
+    availability: float
+    specific_yield: Optional[float]     # kWh/kWp trong ngày
+    capacity_factor: Optional[float]    # Công suất / công suất AC định mức
+    performance_ratio: Optional[float]
+    max_age: Optional[float]            # Tuổi mẫu cũ nhất được dùng (giây)
+    inverters: Dict[int, str] = field(default_factory=dict)
+
+    def __contains__(self, group) -> bool:
+        return group in ("ac", "energy", "plant")
+
+    def value(self, group: str, key: str, index: int = 0):
+        """Cùng giao diện với Sample để register image đọc được snapshot"""
+        if group == "plant":
+            return getattr(self, key, None)
+        name = SOURCES.get((group, key))
+        return getattr(self, name) if name else None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+
+# Coalesce theo project: consumer chậm chỉ nhận snapshot mới nhất của mỗi nhà máy
+TOPIC_PLANT = Topic("plant", PlantSnapshot, key=lambda snapshot: snapshot.project_id)
+
+
+class InverterShare:
+    """Phần đóng góp của một inverter vào tổng nhà máy"""
+    __slots__ = ("ts", "power", "faulted", "day", "energy_day", "energy_total", "extra_day", "extra_total",
+                 "status", "counted")
+
+    def __init__(self):
+        self.ts: Optional[float] = None     # Mẫu AC gần nhất
+        self.power = 0.0
+        self.faulted = False
+        self.day: Optional[int] = None      # Ngày của số liệu sản lượng
+        self.energy_day = 0.0               # Bộ đếm đọc từ inverter
+        self.energy_total: Optional[float] = None
+        self.extra_day = 0.0                # Tích phân công suất từ lần đọc bộ đếm cuối
+        self.extra_total = 0.0
+        self.status = STATUS_MISSING
+        self.counted = [0.0, 0.0, 0.0]      # Giá trị đang cộng trong tổng project
+
+
+class PlantState:
+    """Tổng đang chạy và phần đóng góp của các inverter trong một project"""
+
+    def __init__(self, project: Project):
+        self.project = project
+        self.shares = {inverter_id: InverterShare() for inverter_id in project.inverters}
+        self.totals = [0.0, 0.0, 0.0]
+        self.pending = False                # Có mẫu mới từ snapshot trước
+        self.irradiance: Optional[float] = None
+        self.irradiance_ts = 0.0
+        self.latest: Optional[PlantSnapshot] = None
+
+    def set(self, share: InverterShare, index: int, value: float):
+        """Thay phần đóng góp của inverter vào tổng"""
+        self.totals[index] += value - share.counted[index]
+        share.counted[index] = value
+
+
+class PlantAggregator:
+    """Consumer gộp mẫu theo project và phát snapshot nhà máy mỗi chu kỳ"""
+
+    def __init__(self, projects: List[Project], interval: float = 5, stale_after: float = 180):
+        self.interval = interval
+        self.stale_after = stale_after
+        self.plants = {project.id: PlantState(project) for project in projects}
+        self._by_inverter: Dict[int, PlantState] = {}
+        for state in self.plants.values():
+            for inverter_id in state.project.inverters:
+                self._by_inverter[inverter_id] = state
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+        # Thống kê
+        self.samples = 0
+        self.snapshots = 0
+        self.irradiance_invalid = 0
+
+    # ------------------------------------------------------------------
+    # Mẫu đến
+    # ------------------------------------------------------------------
+    def add(self, inverter_id: int, ts: float, sample: Sample):
+        """Cập nhật phần đóng góp của inverter và tổng project"""
+        state = self._by_inverter.get(inverter_id)
+        if state is None:
+            return
+        share = state.shares[inverter_id]
+        day = local_day(ts)
+        if day != share.day:
+            # Qua ngày: bộ đếm ngày của lần đọc trước không còn thuộc ngày hiện tại
+            share.day = day
+            share.energy_day = share.extra_day = 0.0
+
+        power = sample.value("ac", "power") if "ac" in sample else None
+        if power is not None:
+            if share.ts is not None and 0 < ts - share.ts <= self.stale_after:
+                kwh = (share.power + power) * (ts - share.ts) / 7.2e6
+                share.extra_day += kwh
+                share.extra_total += kwh
+            share.ts = ts
+            share.power = power
+            share.status = STATUS_OK
+            state.set(share, POWER, power)
+        if "error" in sample:
+            share.faulted = bool(sample.value("error", "fault_code"))
+        if "energy" in sample:
+            energy_day = sample.value("energy", "energy_day_kwh")
+            energy_total = sample.value("energy", "energy_total_kwh")
+            if energy_day is not None:
+                share.energy_day, share.extra_day = energy_day, 0.0
+            if energy_total is not None:
+                share.energy_total, share.extra_total = energy_total, 0.0
+
+        state.set(share, ENERGY_DAY, share.energy_day + share.extra_day)
+        if share.energy_total is not None:
+            state.set(share, ENERGY_TOTAL, share.energy_total + share.extra_total)
+        state.pending = True
+        self.samples += 1
+
+    async def on_sample(self, inverter_id: int, ts: float, sample: Sample):
+        """Callback cho collector"""
+        self.add(inverter_id, ts, sample)
+
+    def reload(self, projects: List[Project]):
+        """Đổi danh sách project khi đang chạy; inverter giữ nguyên phần đóng góp đã có"""
+        shares = {inverter_id: share for state in self.plants.values() for inverter_id, share in state.shares.items()}
+        plants = {}
+        for project in projects:
+            state = PlantState(project)
+            old = self.plants.get(project.id)
+            if old:
+                state.irradiance, state.irradiance_ts, state.latest = old.irradiance, old.irradiance_ts, old.latest
+            for inverter_id in project.inverters:
+                if inverter_id in shares:
+                    share = state.shares[inverter_id] = shares[inverter_id]
+                    state.totals = [total + counted for total, counted in zip(state.totals, share.counted)]
+            state.pending = True
+            plants[project.id] = state
+        self._by_inverter = {inverter_id: state for state in plants.values() for inverter_id in state.shares}
+        self.plants = plants
+
+    def set_irradiance(self, project_id: int, irradiance: float, ts: Optional[float] = None):
+        """Bức xạ mặt phẳng tấm pin (W/m²) từ cảm biến của nhà máy, dùng cho performance ratio"""
+        state = self.plants.get(project_id)
+        if state:
+            state.irradiance = irradiance
+            state.irradiance_ts = time.time() if ts is None else ts
+
+    def attach_mqtt(self, publisher):
+        """Nhận bức xạ của cảm biến nhà máy từ <prefix>/irradiance/<project_id>"""
+        self._loop = asyncio.get_running_loop()
+        publisher.subscribe(f"{publisher.topic_prefix}/{IRRADIANCE_TOPIC}/+", self._on_mqtt_irradiance, qos=0)
+
+    def _on_mqtt_irradiance(self, topic: str, payload: bytes):
+        # Chạy trên thread của paho: chuyển sang event loop
+        try:
+            project_id = int(topic.rsplit("/", 1)[1])
+            message = json.loads(payload)
+            if not isinstance(message, dict):
+                message = {"irradiance": message}
+            irradiance = float(message["irradiance"])
+            ts = float(message["ts"]) if message.get("ts") is not None else None
+        except (ValueError, TypeError, KeyError) as e:
+            self.irradiance_invalid += 1
+            print(f"[Plant] ❌ Bức xạ không hợp lệ trên {topic}: {e}")
+            return
+        self._loop.call_soon_threadsafe(self.set_irradiance, project_id, irradiance, ts)
+
+    # ------------------------------------------------------------------
+    # Snapshot
+    # ------------------------------------------------------------------
+    def snapshot(self, state: PlantState, now: float) -> Optional[PlantSnapshot]:
+        """Đánh giá mọi inverter tại `now`; None nếu không có gì mới từ snapshot trước"""
+        project = state.project
+        today = local_day(now)
+        changed = state.pending
+        counts = {STATUS_OK: 0, STATUS_STALE: 0, STATUS_MISSING: 0}
+        faulted = 0
+        max_age = None
+        statuses = {}
+
+        for inverter_id, share in state.shares.items():
+            age = None if share.ts is None else now - share.ts
+            if age is None or age > self.stale_after:
+                status = STATUS_MISSING
+            elif age > self.interval:
+                status = STATUS_STALE
+            else:
+                status = STATUS_OK
+            if status != share.status:
+                share.status = status
+                changed = True
+            if status != STATUS_MISSING:
+                max_age = age if max_age is None else max(max_age, age)
+                faulted += share.faulted
+            counts[status] += 1
+            statuses[inverter_id] = status
+
+            state.set(share, POWER, share.power if status != STATUS_MISSING else 0.0)
+            if share.day != today:
+                state.set(share, ENERGY_DAY, 0.0)
+
+        if not changed:
+            return None
+        state.pending = False
+
+        power, energy_day, energy_total = state.totals
+        count = len(state.shares)
+        available = count - counts[STATUS_MISSING] - faulted
+        performance_ratio = None
+        if (project.capacity_kwp and state.irradiance is not None and state.irradiance >= MIN_IRRADIANCE
+                and now - state.irradiance_ts <= self.stale_after):
+            performance_ratio = round(power / 1000 / project.capacity_kwp / (state.irradiance / 1000), 4)
+
+        snapshot = PlantSnapshot(
+            project_id=project.id,
+            ts=now,
+            power_w=round(power, 1),
+            energy_day_kwh=round(energy_day, 3),
+            energy_total_kwh=round(energy_total, 3),
+            reporting=counts[STATUS_OK],
+            stale=counts[STATUS_STALE],
+            missing=counts[STATUS_MISSING],
+            faulted=faulted,
+            availability=round(available / count, 4) if count else 0.0,
+            specific_yield=round(energy_day / project.capacity_kwp, 4) if project.capacity_kwp else None,
+            capacity_factor=round(power / 1000 / project.ac_capacity_kw, 4) if project.ac_capacity_kw else None,
+            performance_ratio=performance_ratio,
+            max_age=None if max_age is None else round(max_age, 2),
+            inverters=statuses
+        )
+        state.latest = snapshot
+        return snapshot
+
+    async def emit(self, now: float) -> int:
+        """Dựng snapshot của mọi project tại `now` và publish lên TOPIC_PLANT"""
+        events = get_event_bus()
+        emitted = 0
+        for state in self.plants.values():
+            snapshot = self.snapshot(state, now)
+            if snapshot is None:
+                continue
+            emitted += 1
+            events.publish(TOPIC_PLANT, snapshot)
+        self.snapshots += emitted
+        return emitted
+
+    async def run(self):
+        """Phát snapshot tại mỗi mốc wall-clock bội số của chu kỳ realtime"""
+        while True:
+            now = time.time()
+            boundary = (math.floor(now / self.interval) + 1) * self.interval
+            await asyncio.sleep(boundary - now)
+            await self.emit(boundary)
+
+    def get_stats(self) -> Dict:
+        """Snapshot mới nhất của từng project"""
+        return {
+            "projects": {
+                project_id: {
+                    "inverters": len(state.shares),
+                    "power_w": state.latest.power_w if state.latest else None,
+                    "availability": state.latest.availability if state.latest else None,
+                    "missing": state.latest.missing if state.latest else None,
+                }
+                for project_id, state in self.plants.items()
+            },
+            "samples": self.samples,
+            "snapshots": self.snapshots,
+            "irradiance_invalid": self.irradiance_invalid
+        }
+
+
+def load_projects(projects_config: List[Dict[str, Any]]) -> List[Project]:
+    """Dựng danh sách project từ projects.yaml"""
+    return [
+        Project(
+            id=p["id"],
+            name=p.get("name", str(p["id"])),
+            inverters=list(p.get("inverters", [])),
+            capacity_kwp=p.get("capacity_kwp") or 0,
+            ac_capacity_kw=p.get("ac_capacity_kw") or 0
+        )
+        for p in projects_config
+    ]
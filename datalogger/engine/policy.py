@@ -0,0 +1,197 @@
+"""
+Polling policy - Điều chỉnh chu kỳ polling theo chính dữ liệu đọc được
+- Night mode: inverter standby / không phát điện -> poll chậm
+- Fault burst: xuất hiện fault_code mới -> poll nhanh trong một khoảng thời gian
+- Offline: slave không trả lời -> giãn chu kỳ dần để nhường bus cho inverter khác
+- Bỏ qua đọc sản lượng khi energy_day_kwh không thể thay đổi
+"""
+import time
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import Dict, Iterable, List, Optional
+
+from engine.scheduler import PollingType, Scheduler, get_scheduler
+from storage.cache import Sample
+
+# work_state Sungrow: dừng / standby (không phát điện)
+DEFAULT_STANDBY_STATES = (0x1200, 0x1300, 0x1400, 0x1500, 0x8000)
+
+
+class PollingMode(Enum):
+    """Chế độ polling của một inverter"""
+    NORMAL = "normal"
+    NIGHT = "night"
+    FAULT = "fault"
+    OFFLINE = "offline"
+
+
+@dataclass
+class InverterState:
+    """Trạng thái policy của một inverter"""
+    mode: PollingMode = PollingMode.NORMAL
+    interval: float = 0
+    idle_samples: int = 0                  # Số mẫu liên tiếp không phát điện
+    last_fault_code: Optional[int] = None
+    fault_until: float = 0.0
+    failures: int = 0
+    idle_since: Optional[float] = None     # Thời điểm bắt đầu không phát điện
+    last_energy_at: Optional[float] = None # Lần gần nhất có giá trị sản lượng (từ bất kỳ poll nào)
+    energy_skipped: int = 0
+    history: Dict[str, int] = field(default_factory=dict)  # Số lần vào mỗi mode
+
+
+class PollingPolicy:
+    """Quyết định chu kỳ realtime và việc đọc sản lượng cho từng inverter"""
+
+    def __init__(self, scheduler: Optional[Scheduler] = None, realtime_interval: float = 5,
+                 energy_interval: float = 900, night_interval: float = 60, fault_interval: float = 2,
+                 fault_burst: float = 120, offline_after: int = 3, offline_max_interval: float = 300,
+                 idle_power: float = 0, idle_samples: int = 3,
+                 standby_states: Iterable[int] = DEFAULT_STANDBY_STATES):
+        self.scheduler = scheduler or get_scheduler()
+        self.realtime_interval = realtime_interval
+        self.energy_interval = energy_interval
+        self.night_interval = night_interval
+        self.fault_interval = fault_interval
+        self.fault_burst = fault_burst                   # Thời gian giữ fault mode (giây)
+        self.offline_after = offline_after               # Số lần lỗi liên tiếp -> offline
+        self.offline_max_interval = offline_max_interval
+        self.idle_power = idle_power                     # Công suất (W) coi như không phát
+        self.idle_samples = idle_samples                 # Số mẫu idle liên tiếp -> night
+        self.standby_states = set(standby_states)
+        self.states: Dict[int, InverterState] = {}
+
+    # Tham số đổi được khi đang chạy (realtime/energy interval gắn với lịch của scheduler)
+    TUNABLES = ("night_interval", "fault_interval", "fault_burst", "offline_after", "offline_max_interval",
+                "idle_power", "idle_samples")
+
+    def update(self, **options) -> List[str]:
+        """Áp dụng tham số mới (nạp lại cấu hình nóng); trả về tên tham số không đổi được khi đang chạy"""
+        rejected = []
+        for name, value in options.items():
+            if name in self.TUNABLES:
+                setattr(self, name, value)
+            elif name == "standby_states":
+                self.standby_states = set(value)
+            elif getattr(self, name, None) != value:
+                rejected.append(name)
+        return rejected
+
+    def _state(self, inverter_id: int) -> InverterState:
+        state = self.states.get(inverter_id)
+        if state is None:
+            state = InverterState(interval=self.realtime_interval)
+            self.states[inverter_id] = state
+        return state
+
+    def _apply(self, inverter_id: int, state: InverterState, mode: PollingMode, interval: float):
+        """Đổi mode/interval, chỉ gọi scheduler khi thực sự thay đổi"""
+        if mode != state.mode:
+            print(f"[Policy] 🔁 Inverter {inverter_id}: {state.mode.value} → {mode.value}")
+            state.mode = mode
+            state.history[mode.value] = state.history.get(mode.value, 0) + 1
+        if interval != state.interval:
+            state.interval = interval
+            self.scheduler.update_interval(inverter_id, PollingType.REALTIME, interval)
+
+    def _is_idle(self, sample: Sample) -> Optional[bool]:
+        """None: không xác định được (đọc lỗi nhóm ac, work_state không phải standby)"""
+        if sample.value("error", "work_state") in self.standby_states:
+            return True
+        power = sample.value("ac", "power")
+        return None if power is None else power <= self.idle_power
+
+    def observe(self, inverter_id: int, sample: Sample):
+        """Cập nhật policy sau một lần poll realtime thành công"""
+        state = self._state(inverter_id)
+        now = time.monotonic()
+        state.failures = 0
+
+        if sample.has("energy"):
+            state.last_energy_at = now
+
+        # Fault mới -> poll nhanh (nhóm error đọc lỗi: giữ mã lỗi đã biết, fault kéo dài không kích hoạt lại)
+        fault_code = sample.value("error", "fault_code")
+        if fault_code is not None:
+            if fault_code and fault_code != state.last_fault_code:
+                print(f"[Policy] 🚨 Inverter {inverter_id}: fault_code {fault_code}")
+                state.fault_until = now + self.fault_burst
+            state.last_fault_code = fault_code
+
+        # Theo dõi trạng thái không phát điện (không xác định được thì giữ nguyên)
+        idle = self._is_idle(sample)
+        if idle:
+            state.idle_samples += 1
+            if state.idle_since is None:
+                state.idle_since = now
+        elif idle is not None:
+            state.idle_samples = 0
+            state.idle_since = None
+
+        if now < state.fault_until:
+            self._apply(inverter_id, state, PollingMode.FAULT, self.fault_interval)
+        elif state.idle_samples >= self.idle_samples:
+            self._apply(inverter_id, state, PollingMode.NIGHT, self.night_interval)
+        else:
+            self._apply(inverter_id, state, PollingMode.NORMAL, self.realtime_interval)
+
+    def on_failure(self, inverter_id: int):
+        """Poll realtime thất bại: sau offline_after lần liên tiếp thì giãn chu kỳ gấp đôi mỗi lần"""
+        state = self._state(inverter_id)
+        state.failures += 1
+        if state.failures < self.offline_after:
+            return
+        base = state.interval if state.mode == PollingMode.OFFLINE else self.realtime_interval
+        self._apply(inverter_id, state, PollingMode.OFFLINE, min(base * 2, self.offline_max_interval))
+
+    def should_read_energy(self, inverter_id: int) -> bool:
+        """Có cần đọc sản lượng riêng không"""
+        state = self._state(inverter_id)
+        now = time.monotonic()
+
+        if state.mode == PollingMode.OFFLINE:
+            return False  # Realtime còn không đọc được
+        if state.last_energy_at is not None:
+            # Poll realtime đã đọc sản lượng gần đây
+            if now - state.last_energy_at < self.energy_interval:
+                state.energy_skipped += 1
+                return False
+            # Không phát điện từ trước lần đọc cuối: sản lượng không thể thay đổi
+            if state.idle_since is not None and state.idle_since <= state.last_energy_at:
+                state.energy_skipped += 1
+                return False
+        return True
+
+    def on_energy(self, inverter_id: int):
+        """Ghi nhận vừa đọc được sản lượng"""
+        self._state(inverter_id).last_energy_at = time.monotonic()
+
+    def get_stats(self) -> Dict:
+        """Mode và interval hiện tại của từng inverter"""
+        return {
+            inverter_id: {
+                "mode": state.mode.value,
+                "interval": state.interval,
+                "failures": state.failures,
+                "energy_skipped": state.energy_skipped,
+                "history": dict(state.history)
+            }
+            for inverter_id, state in self.states.items()
+        }
+
+
+# Singleton instance
+_policy_instance: Optional[PollingPolicy] = None
+
+def get_policy() -> PollingPolicy:
+    """Lấy singleton polling policy"""
+    global _policy_instance
+    if _policy_instance is None:
+        _policy_instance = PollingPolicy()
+    return _policy_instance
+
+def configure_policy(**options) -> PollingPolicy:
+    """Tạo lại policy với tham số từ cấu hình"""
+    global _policy_instance
+    _policy_instance = PollingPolicy(**options)
+    return _policy_instance
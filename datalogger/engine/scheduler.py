@@ -1,15 +1,32 @@
 """
 Scheduler - Quản lý polling schedules cho datalogger
 - Hỗ trợ multiple polling intervals
+- Deadline theo đồng hồ monotonic, một heap timer cho tất cả tasks (không trôi chu kỳ)
+- Chu kỳ cố định căn theo mốc wall-clock (vd :00, :05, :10...), lệch pha theo inverter
+- Chu kỳ bị overrun thì bỏ qua thay vì chồng lên nhau
 - Retry logic với exponential backoff
+- Histogram lateness (trễ so với deadline) và thời gian chạy của từng loại polling
 - Dynamic schedule updates
 """
 import asyncio
+import heapq
+import itertools
+import math
 import time
-from typing import Dict, Callable, Any, Optional
+from typing import Dict, Callable, List, Optional, Tuple
 from dataclasses import dataclass
 from enum import Enum
 
+from utils.logger import get_metrics
+
+LATENESS_BUCKETS = (0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+POLL_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 10.0, 30.0)
+
+LATENESS_SECONDS = get_metrics().histogram(
+    "datalogger_scheduler_lateness_seconds", "Độ trễ bắt đầu lần poll so với deadline", ("type",), LATENESS_BUCKETS)
+POLL_SECONDS = get_metrics().histogram(
+    "datalogger_poll_seconds", "Thời gian một lần poll (gồm chờ bus)", ("type", "result"), POLL_BUCKETS)
+
 
 class PollingType(Enum):
     """Loại polling data"""
@@ -28,107 +45,221 @@ class PollingTask:
     retry_count: int = 0
     max_retries: int = 3
     retry_delay: float = 1.0
+    phase: float = 0.0     # Lệch pha so với mốc wall-clock (giây)
     last_success: Optional[float] = None
     consecutive_failures: int = 0
+    # Trạng thái lịch chạy (do scheduler quản lý)
+    deadline: float = 0.0          # Mốc chu kỳ kế tiếp (loop.time())
+    generation: int = 0            # Tăng mỗi lần đổi lịch, entry cũ trong heap bị bỏ qua
+    in_flight: Optional[asyncio.Task] = None
+    current_retry_delay: float = 0.0
+    skipped_cycles: int = 0
+    last_lateness: float = 0.0     # Trễ so với deadline ở lần chạy gần nhất (giây)
+    max_lateness: float = 0.0
 
 
 class Scheduler:
     """Quản lý polling schedules cho các inverters"""
-    
+
     def __init__(self):
         self.tasks: Dict[int, Dict[PollingType, PollingTask]] = {}
         self.running = False
-        
+        self._heap: List[Tuple[float, int, int, PollingTask]] = []
+        self._seq = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
     def add_task(self, inverter_id: int, task: PollingTask):
         """Thêm một polling task"""
         if inverter_id not in self.tasks:
             self.tasks[inverter_id] = {}
+        old = self.tasks[inverter_id].get(task.type)
+        if old:
+            self._cancel(old)
         self.tasks[inverter_id][task.type] = task
-        
+        if self.running:
+            self._schedule(task, self._next_slot(task))
+
     def get_task(self, inverter_id: int, task_type: PollingType) -> Optional[PollingTask]:
         """Lấy task theo inverter_id và type"""
         if inverter_id not in self.tasks:
             return None
         return self.tasks[inverter_id].get(task_type)
-        
+
     def remove_task(self, inverter_id: int, task_type: Optional[PollingType] = None):
         """Xóa task"""
         if inverter_id not in self.tasks:
             return
-            
+
         if task_type is None:
             # Xóa tất cả tasks của inverter
+            for task in self.tasks[inverter_id].values():
+                self._cancel(task)
             del self.tasks[inverter_id]
         else:
             # Xóa task cụ thể
             if task_type in self.tasks[inverter_id]:
+                self._cancel(self.tasks[inverter_id][task_type])
                 del self.tasks[inverter_id][task_type]
-    
-    async def run_task(self, task: PollingTask):
-        """Chạy một polling task với retry logic"""
-        last_error = None
-        retry_delay = task.retry_delay
-        
-        while True:
-            try:
-                # Gọi handler để lấy dữ liệu
-                await task.handler()
-                
-                # Success
-                task.last_success = time.time()
-                task.consecutive_failures = 0
+
+    # ------------------------------------------------------------------
+    # Lịch chạy
+    # ------------------------------------------------------------------
+    def _now(self) -> float:
+        return self._loop.time() if self._loop else time.monotonic()
+
+    def _next_slot(self, task: PollingTask, after: Optional[float] = None) -> float:
+        """Mốc chu kỳ kế tiếp (căn theo wall-clock + phase) sau thời điểm `after`"""
+        now = self._now()
+        after = now if after is None else after
+        wall = time.time() + (after - now)
+        slot = (math.floor((wall - task.phase) / task.interval) + 1) * task.interval + task.phase
+        return after + (slot - wall)
+
+    def _schedule(self, task: PollingTask, when: float, regular: bool = True):
+        """Đặt lần chạy kế tiếp; entry cũ của task trong heap trở thành vô hiệu"""
+        task.generation += 1
+        if regular:
+            task.deadline = when
+        heapq.heappush(self._heap, (when, next(self._seq), task.generation, task))
+        if self._wakeup:
+            self._wakeup.set()
+
+    def _cancel(self, task: PollingTask):
+        """Hủy lịch và lần chạy đang dở của task"""
+        task.generation += 1
+        if task.in_flight and not task.in_flight.done():
+            task.in_flight.cancel()
+
+    def _is_registered(self, task: PollingTask) -> bool:
+        return self.tasks.get(task.inverter_id, {}).get(task.type) is task
+
+    async def run_task(self, task: PollingTask, deadline: float):
+        """Chạy một lần polling task với retry logic"""
+        start = self._now()
+        task.last_lateness = max(0.0, start - deadline)
+        task.max_lateness = max(task.max_lateness, task.last_lateness)
+        LATENESS_SECONDS.labels(task.type.value).observe(task.last_lateness)
+
+        try:
+            # Gọi handler để lấy dữ liệu
+            await task.handler()
+            POLL_SECONDS.labels(task.type.value, "ok").observe(self._now() - start)
+
+            # Success
+            task.last_success = time.time()
+            task.consecutive_failures = 0
+            task.retry_count = 0
+            task.current_retry_delay = task.retry_delay  # Reset retry delay
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            task.consecutive_failures += 1
+            POLL_SECONDS.labels(task.type.value, "failed").observe(self._now() - start)
+
+            print(f"[Scheduler] ❌ {task.type.value} for inverter {task.inverter_id} failed: {e}")
+
+            # max_retries 0: retry ở mức block trên bus, chu kỳ kế tiếp đã được xếp lịch
+            if not self._is_registered(task) or not task.max_retries:
+                return
+
+            # Kiểm tra max retries
+            if task.retry_count >= task.max_retries:
+                print(f"[Scheduler] ⚠️ Max retries reached for {task.type.value} (inverter {task.inverter_id})")
+                # Vẫn tiếp tục chạy nhưng bỏ qua một chu kỳ
                 task.retry_count = 0
-                retry_delay = task.retry_delay  # Reset retry delay
-                
-                # Chờ interval trước khi poll lần tiếp
-                await asyncio.sleep(task.interval)
-                
-            except Exception as e:
-                last_error = e
-                task.consecutive_failures += 1
-                
-                print(f"[Scheduler] ❌ {task.type.value} for inverter {task.inverter_id} failed: {e}")
-                
-                # Kiểm tra max retries
-                if task.retry_count >= task.max_retries:
-                    print(f"[Scheduler] ⚠️ Max retries reached for {task.type.value} (inverter {task.inverter_id})")
-                    # Vẫn tiếp tục chạy nhưng chờ lâu hơn
-                    task.retry_count = 0
-                    await asyncio.sleep(task.interval * 2)  # Chờ gấp đôi
-                else:
-                    # Exponential backoff
-                    task.retry_count += 1
-                    await asyncio.sleep(retry_delay)
-                    retry_delay = min(retry_delay * 2, 60)  # Max 60 seconds
-    
+                task.current_retry_delay = task.retry_delay
+                self._schedule(task, self._next_slot(task, task.deadline))
+            else:
+                # Exponential backoff, chỉ khi lần retry đến trước chu kỳ kế tiếp
+                task.retry_count += 1
+                delay = task.current_retry_delay or task.retry_delay
+                task.current_retry_delay = min(delay * 2, 60)  # Max 60 seconds
+                retry_at = self._now() + delay
+                if retry_at < task.deadline:
+                    self._schedule(task, retry_at, regular=False)
+                    # Lịch chu kỳ được giữ nguyên sau khi retry xong
+                    heapq.heappush(self._heap, (task.deadline, next(self._seq), task.generation, task))
+        finally:
+            task.in_flight = None
+
+    def _dispatch(self, task: PollingTask, when: float):
+        """Xử lý một entry đến hạn trong heap"""
+        now = self._now()
+        is_regular = when == task.deadline
+
+        if task.in_flight is not None:
+            # Overrun: lần chạy trước chưa xong -> bỏ chu kỳ này, không chồng lệnh
+            task.skipped_cycles += 1
+            self._schedule(task, self._next_slot(task, now))
+            return
+
+        if is_regular:
+            # Chu kỳ cố định: deadline kế tiếp = deadline + interval (bỏ qua các mốc đã lỡ)
+            missed = max(0, math.floor((now - when) / task.interval))
+            task.skipped_cycles += missed
+            self._schedule(task, when + (missed + 1) * task.interval)
+
+        task.in_flight = asyncio.create_task(self.run_task(task, when))
+
     async def start_inverter_tasks(self, inverter_id: int):
-        """Khởi động tất cả tasks cho một inverter"""
+        """Đưa tất cả tasks của một inverter vào lịch chạy"""
         if inverter_id not in self.tasks:
             return
-            
-        tasks_to_run = []
+
         for task in self.tasks[inverter_id].values():
-            tasks_to_run.append(asyncio.create_task(self.run_task(task)))
-        
-        # Chờ tất cả tasks (sẽ chạy mãi mãi)
-        await asyncio.gather(*tasks_to_run)
-    
+            task.current_retry_delay = task.retry_delay
+            self._schedule(task, self._next_slot(task))
+
     async def start_all_tasks(self):
-        """Khởi động scheduler cho tất cả inverters"""
+        """Khởi động scheduler cho tất cả inverters (chạy đến khi stop() hoặc bị cancel)"""
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._heap.clear()
         self.running = True
         print("[Scheduler] 🚀 Starting all polling tasks...")
-        
-        all_tasks = []
+
         for inverter_id in self.tasks:
-            all_tasks.append(asyncio.create_task(self.start_inverter_tasks(inverter_id)))
-        
-        await asyncio.gather(*all_tasks)
-    
+            await self.start_inverter_tasks(inverter_id)
+
+        try:
+            while self.running:
+                if not self._heap:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                    continue
+
+                when, _, generation, task = self._heap[0]
+                if generation != task.generation or not self._is_registered(task):
+                    heapq.heappop(self._heap)  # Entry cũ
+                    continue
+
+                wait = when - self._now()
+                if wait > 0:
+                    self._wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), wait)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                heapq.heappop(self._heap)
+                self._dispatch(task, when)
+        finally:
+            self.running = False
+            for tasks in self.tasks.values():
+                for task in tasks.values():
+                    self._cancel(task)
+            self._heap.clear()
+
     def stop(self):
         """Dừng scheduler"""
         self.running = False
+        if self._wakeup:
+            self._wakeup.set()
         print("[Scheduler] ⏹️ Stopping scheduler...")
-    
+
     def get_stats(self) -> Dict:
         """Lấy thống kê về scheduler"""
         stats = {}
@@ -137,20 +268,27 @@ class Scheduler:
             for task_type, task in tasks.items():
                 inv_stats[task_type.value] = {
                     "interval": task.interval,
+                    "phase": task.phase,
                     "retry_count": task.retry_count,
                     "consecutive_failures": task.consecutive_failures,
                     "last_success": task.last_success,
+                    "skipped_cycles": task.skipped_cycles,
+                    "last_lateness": round(task.last_lateness, 3),
+                    "max_lateness": round(task.max_lateness, 3),
                     "status": "healthy" if task.consecutive_failures < 3 else "degraded"
                 }
             stats[inverter_id] = inv_stats
         return stats
-    
+
     def update_interval(self, inverter_id: int, task_type: PollingType, new_interval: int):
         """Cập nhật interval động"""
         task = self.get_task(inverter_id, task_type)
         if task:
             old_interval = task.interval
             task.interval = new_interval
+            if self.running:
+                # Căn lại theo mốc của interval mới
+                self._schedule(task, self._next_slot(task))
             print(f"[Scheduler] Updated {task_type.value} interval for inverter {inverter_id}: {old_interval}s → {new_interval}s")
             return True
         return False
@@ -165,4 +303,3 @@ def get_scheduler() -> Scheduler:
     if _scheduler_instance is None:
         _scheduler_instance = Scheduler()
     return _scheduler_instance
-
@@ -0,0 +1,399 @@
+"""
+Bus process - Mỗi cổng serial chạy trong một process riêng (tùy chọn, nhiều cổng RS-485)
+- Inverter được nhóm theo cổng; mỗi process có event loop, bus, scheduler, policy riêng:
+  CRC/decode hay một lệnh blocking trên một bus không làm chậm các bus khác, tận dụng nhiều core
+- Process bus gửi mẫu đã decode về process chính qua pipe dưới dạng hàng thô của sample cache
+  (ts + bitmask nhóm + mảng words/dwords), không pickle
+- Process chính (aggregator) chép hàng vào sample cache của mình rồi chuyển cho consumer
+  như mẫu poll tại chỗ (DB, MQTT, TCP server, alerts)
+- Lệnh ghi điều khiển được chuyển xuống process của bus, vẫn chen trước polling
+- Supervisor khởi động lại process bus bị crash với backoff tăng dần
+"""
+import asyncio
+import itertools
+import multiprocessing
+import pickle
+import struct
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from engine import collector
+from engine.collector import assign_phases, build_driver
+from storage.cache import get_sample_cache
+
+# Message trên pipe: 1 byte loại + nội dung
+MSG_SAMPLE = b"S"    # Hàng mẫu: SAMPLE_HEADER + words + dwords
+MSG_CONTROL = b"P"   # Tuple pickle: ("call", ...), ("result", ...), ("stats", ...), ("stop",)
+SAMPLE_HEADER = struct.Struct("<cIdHH")  # loại, inverter_id, ts, bitmask đọc, bitmask hợp lệ
+
+STATS_INTERVAL = 5.0   # Chu kỳ process bus gửi thống kê (giây)
+STABLE_AFTER = 60.0    # Process chạy lâu hơn thời gian này thì backoff khởi động lại được reset
+READ_BATCH = 256       # Số message tối đa chuyển sang event loop mỗi lần
+
+# Thống kê bus mặc định khi process chưa báo lần nào
+EMPTY_BUS_STATS = {"frames": 0, "errors": 0, "error_kinds": {}, "pending": 0, "urgent_pending": 0,
+                   "preemptions": 0, "utilisation": 0.0, "retries": 0, "retries_denied": 0,
+                   "open_circuits": 0, "links": {}}
+
+
+def _pack(message: Tuple) -> bytes:
+    return MSG_CONTROL + pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+
+
+# ----------------------------------------------------------------------
+# Process bus
+# ----------------------------------------------------------------------
+def run_bus_process(port: str, configs: List[Dict[str, Any]], options: Dict[str, Any], commands, channel):
+    """Entry point của process bus: polling các inverter của một cổng"""
+    try:
+        asyncio.run(_bus_main(port, configs, options, commands, channel))
+    except KeyboardInterrupt:
+        pass
+
+
+async def _bus_main(port: str, configs: List[Dict[str, Any]], options: Dict[str, Any], commands, channel):
+    # Import trong process con: singleton (scheduler, policy, bus) là của riêng process này
+    from engine.policy import configure_policy
+    from engine.scheduler import get_scheduler
+    from modbus.bus import configure_bus_manager, get_bus_manager
+    from storage.cache import configure_cache
+    from storage.journal import configure_journal
+    from utils.logger import set_level
+
+    set_level(options.get("log_level", "info"))
+    policy = configure_policy(**options.get("polling", {}))
+    configure_bus_manager(**options.get("rtu", {}))
+    # Mẫu được gửi đi ngay trong callback: ring chỉ cần một hàng
+    configure_cache(hours=0, interval=policy.realtime_interval)
+    # Journal thanh ghi thô: mỗi process bus một writer (tên theo cổng) trong cùng thư mục
+    journal = configure_journal(**options["journal"], name=port) if options.get("journal") else None
+    loop = asyncio.get_running_loop()
+    stopped = asyncio.Event()
+
+    async def send_sample(inverter_id: int, ts: float, sample):
+        requested, valid, words, dwords = sample.row()
+        channel.send_bytes(b"".join((SAMPLE_HEADER.pack(MSG_SAMPLE, inverter_id, ts, requested, valid),
+                                     words, dwords)))
+    collector.set_sample_callback(send_sample)
+
+    async def call(request_id: int, urgent: bool, slave_id: int, name: str, args: Tuple):
+        # Lệnh từ process chính: gọi method của driver trên bus của process này
+        try:
+            driver = next((d for _, d in collector.inverters.values() if d.slave_id == slave_id), None)
+            if driver is None:
+                raise ValueError(f"Slave {slave_id} không có trên bus {port}")
+            run = driver.bus.run_urgent if urgent else driver.bus.run
+            message = ("result", request_id, await run(slave_id, getattr(driver, name), *args), None)
+        except Exception as e:
+            message = ("result", request_id, None, str(e) or type(e).__name__)
+        channel.send_bytes(_pack(message))
+
+    def on_command(message: Tuple):
+        if message[0] == "call":
+            asyncio.create_task(call(*message[1:]))
+        elif message[0] == "stop":
+            stopped.set()
+
+    def read_commands():
+        # Thread riêng: recv của pipe là blocking. Hết pipe = process chính đã thoát
+        try:
+            while True:
+                data = commands.recv_bytes()
+                loop.call_soon_threadsafe(on_command, pickle.loads(data[1:]))
+        except (EOFError, OSError):
+            loop.call_soon_threadsafe(stopped.set)
+
+    async def report_stats():
+        while True:
+            await asyncio.sleep(STATS_INTERVAL)
+            skipped: Dict[str, int] = {}
+            for tasks in get_scheduler().tasks.values():
+                for task_type, task in tasks.items():
+                    skipped[task_type.value] = skipped.get(task_type.value, 0) + task.skipped_cycles
+            bus = get_bus_manager().buses.get(port)
+            channel.send_bytes(_pack(("stats", {
+                "bus": bus.get_stats() if bus else {},
+                "skipped_cycles": skipped,
+                "policy": policy.get_stats()
+            })))
+
+    threading.Thread(target=read_commands, name=f"bus-commands-{port}", daemon=True).start()
+    polling = asyncio.create_task(collector.start_all_polling(configs, policy.realtime_interval,
+                                                              policy.energy_interval))
+    reporter = asyncio.create_task(report_stats())
+    waiter = asyncio.create_task(stopped.wait())
+    await asyncio.wait({polling, waiter}, return_when=asyncio.FIRST_COMPLETED)
+
+    get_scheduler().stop()
+    for task in (polling, reporter, waiter):
+        task.cancel()
+    await asyncio.gather(polling, reporter, waiter, return_exceptions=True)
+    get_bus_manager().stop_all()
+    if journal:
+        journal.close()
+
+
+# ----------------------------------------------------------------------
+# Process chính
+# ----------------------------------------------------------------------
+class BusProcess:
+    """
+    Đại diện (ở process chính) cho một process bus: khởi động / giám sát process,
+    nhận mẫu và thống kê, chuyển lệnh ghi xuống. Dùng thay BusWorker cho ModbusWriter.
+    """
+
+    def __init__(self, port: str, configs: List[Dict[str, Any]], options: Dict[str, Any],
+                 deliver: Callable[[List[bytes]], None], restart_delay: float = 1.0,
+                 max_restart_delay: float = 60.0):
+        self.port = port
+        self.configs = configs
+        self.options = options
+        self.deliver = deliver              # Nhận lô message mẫu, chạy trên event loop
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+
+        self.process: Optional[multiprocessing.Process] = None
+        self._commands = None               # Pipe process chính -> process bus
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._exited: Optional[asyncio.Event] = None
+        self._calls: Dict[int, asyncio.Future] = {}
+        self._ids = itertools.count(1)
+        self._stopping = False
+
+        # Thống kê
+        self.started_at = 0.0
+        self.restarts = 0
+        self.samples = 0
+        self.last_exitcode: Optional[int] = None
+        self.stats: Dict[str, Any] = {}     # Thống kê process bus gửi lên gần nhất
+
+    # ------------------------------------------------------------------
+    # Vòng đời process
+    # ------------------------------------------------------------------
+    def start(self):
+        """Khởi động process bus và thread đọc pipe"""
+        self._loop = asyncio.get_running_loop()
+        self._exited = asyncio.Event()
+        # spawn: giống nhau trên Windows / Linux, process con không thừa hưởng thread của cha
+        context = multiprocessing.get_context("spawn")
+        command_recv, self._commands = context.Pipe(duplex=False)
+        channel_recv, channel_send = context.Pipe(duplex=False)
+        self.process = context.Process(
+            target=run_bus_process, name=f"bus-{self.port}", daemon=True,
+            args=(self.port, self.configs, self.options, command_recv, channel_send))
+        self.process.start()
+        # Đóng đầu pipe của process con ở đây để nhận EOF khi process con thoát
+        command_recv.close()
+        channel_send.close()
+        self.started_at = time.monotonic()
+        self.stats = {}
+        threading.Thread(target=self._read, args=(channel_recv,), name=f"bus-reader-{self.port}",
+                         daemon=True).start()
+        print(f"[Workers] 🚀 Bus {self.port}: process {self.process.pid}, {len(self.configs)} inverter")
+
+    def _read(self, channel):
+        """Thread đọc pipe: gom message thành lô rồi chuyển sang event loop"""
+        try:
+            while True:
+                batch = [channel.recv_bytes()]
+                while len(batch) < READ_BATCH and channel.poll():
+                    batch.append(channel.recv_bytes())
+                self._loop.call_soon_threadsafe(self._on_messages, batch)
+        except (EOFError, OSError):
+            pass
+        finally:
+            channel.close()
+            self._loop.call_soon_threadsafe(self._exited.set)
+
+    def _on_messages(self, batch: List[bytes]):
+        samples = []
+        for data in batch:
+            if data[:1] == MSG_SAMPLE:
+                samples.append(data)
+                continue
+            message = pickle.loads(data[1:])
+            if message[0] == "result":
+                _, request_id, result, error = message
+                future = self._calls.pop(request_id, None)
+                if future and not future.done():
+                    if error is None:
+                        future.set_result(result)
+                    else:
+                        future.set_exception(Exception(error))
+            elif message[0] == "stats":
+                self.stats = message[1]
+        if samples:
+            self.samples += len(samples)
+            self.deliver(samples)
+
+    async def supervise(self):
+        """Chờ process bus thoát và khởi động lại với backoff tăng dần"""
+        delay = self.restart_delay
+        while True:
+            await self._exited.wait()
+            await asyncio.to_thread(self.process.join, 5)
+            if self._stopping:
+                return
+            self.last_exitcode = self.process.exitcode
+            self.fail_calls(f"Process bus {self.port} đã thoát")
+            if time.monotonic() - self.started_at > STABLE_AFTER:
+                delay = self.restart_delay
+            print(f"[Workers] 💥 Bus {self.port}: process thoát (exit {self.last_exitcode}), "
+                  f"khởi động lại sau {delay:g}s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_restart_delay)
+            self.restarts += 1
+            self.start()
+
+    def fail_calls(self, error: str):
+        """Báo lỗi cho các lệnh đang chờ kết quả từ process bus"""
+        calls, self._calls = self._calls, {}
+        for future in calls.values():
+            if not future.done():
+                future.set_exception(ConnectionError(error))
+
+    def stop(self, timeout: float = 5.0):
+        """Dừng process bus (xong các job đang chạy), buộc dừng nếu quá thời gian"""
+        self._stopping = True
+        if self.process is None:
+            return
+        try:
+            self._commands.send_bytes(_pack(("stop",)))
+        except (OSError, ValueError):
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join(timeout)
+        self._commands.close()
+
+    # ------------------------------------------------------------------
+    # Giao diện bus (cho ModbusWriter): gọi method của driver trong process bus
+    # ------------------------------------------------------------------
+    async def _call(self, urgent: bool, slave_id: int, fn: Callable, *args):
+        if self.process is None or not self.process.is_alive():
+            raise ConnectionError(f"Process bus {self.port} không chạy")
+        request_id = next(self._ids)
+        future = self._loop.create_future()
+        self._calls[request_id] = future
+        self._commands.send_bytes(_pack(("call", request_id, urgent, slave_id, fn.__name__, args)))
+        return await future
+
+    async def run(self, slave_id: int, fn: Callable, *args):
+        """Chạy method driver fn (theo tên) trong hàng đợi thường của bus"""
+        return await self._call(False, slave_id, fn, *args)
+
+    async def run_urgent(self, slave_id: int, fn: Callable, *args):
+        """Chạy method driver fn (theo tên) trong hàng đợi ưu tiên của bus"""
+        return await self._call(True, slave_id, fn, *args)
+
+    def get_stats(self) -> Dict:
+        """Thống kê bus (do process bus báo lên) và của process"""
+        return {
+            "port": self.port,
+            **EMPTY_BUS_STATS,
+            **self.stats.get("bus", {}),
+            "pid": self.process.pid if self.process else None,
+            "alive": bool(self.process and self.process.is_alive()),
+            "restarts": self.restarts,
+            "last_exitcode": self.last_exitcode,
+            "samples": self.samples,
+            "pending_calls": len(self._calls)
+        }
+
+
+class BusProcessPool:
+    """Aggregator: một process cho mỗi cổng, gộp mẫu của tất cả vào sample cache và consumer"""
+
+    def __init__(self, inverter_configs: List[Dict[str, Any]], options: Dict[str, Any],
+                 realtime_interval: float = 5, queue_size: int = 10000, restart_delay: float = 1.0,
+                 max_restart_delay: float = 60.0):
+        assign_phases(inverter_configs, realtime_interval)
+        by_port: Dict[str, List[Dict[str, Any]]] = {}
+        for config in inverter_configs:
+            by_port.setdefault(config["port"], []).append(config)
+
+        self.queue_size = queue_size
+        self._queue: Optional[asyncio.Queue] = None
+        self.buses: Dict[str, BusProcess] = {
+            port: BusProcess(port, configs, options, self._enqueue, restart_delay, max_restart_delay)
+            for port, configs in by_port.items()
+        }
+
+        # Driver ở process chính: register map cho sample cache và lệnh ghi (qua BusProcess)
+        self.maps = {}
+        for port, configs in by_port.items():
+            for config in configs:
+                driver = build_driver(self.buses[port], config)
+                self.maps[config["id"]] = driver.map
+                collector.inverters[config["id"]] = (self.buses[port], driver)
+
+        # Thống kê
+        self.aggregated = 0
+        self.dropped = 0
+        self.unknown = 0
+
+    def _enqueue(self, samples: List[bytes]):
+        for data in samples:
+            try:
+                self._queue.put_nowait(data)
+            except asyncio.QueueFull:
+                self.dropped += 1
+
+    async def _aggregate(self):
+        """Chép hàng mẫu vào sample cache và chuyển cho consumer, đúng thứ tự nhận"""
+        cache = get_sample_cache()
+        size = SAMPLE_HEADER.size
+        while True:
+            data = await self._queue.get()
+            _, inverter_id, ts, requested, valid = SAMPLE_HEADER.unpack_from(data)
+            cmap = self.maps.get(inverter_id)
+            if cmap is None:
+                self.unknown += 1
+                continue
+            ring = cache.ring(inverter_id, cmap)
+            words = size + ring.schema.word_count * ring.words.itemsize
+            sample = ring.append_row(ts, requested, valid, data[size:words], data[words:])
+            self.aggregated += 1
+            await collector.dispatch_sample(inverter_id, sample)
+
+    async def run(self):
+        """Khởi động tất cả process bus, giám sát và gộp mẫu đến khi bị hủy"""
+        self._queue = asyncio.Queue(self.queue_size)
+        for bus in self.buses.values():
+            bus.start()
+        tasks = [asyncio.create_task(bus.supervise()) for bus in self.buses.values()]
+        tasks.append(asyncio.create_task(self._aggregate()))
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await asyncio.to_thread(self.stop)
+            for bus in self.buses.values():
+                bus.fail_calls(f"Process bus {bus.port} đã dừng")
+
+    def stop(self):
+        """Dừng tất cả process bus"""
+        for bus in self.buses.values():
+            bus.stop()
+
+    def skipped_cycles(self) -> Dict[str, int]:
+        """Tổng chu kỳ poll bị bỏ qua (overrun) theo loại, từ scheduler của các process bus"""
+        totals: Dict[str, int] = {}
+        for bus in self.buses.values():
+            for task_type, count in bus.stats.get("skipped_cycles", {}).items():
+                totals[task_type] = totals.get(task_type, 0) + count
+        return totals
+
+    def get_stats(self) -> Dict:
+        """Thống kê aggregator và từng process bus"""
+        return {
+            "buses": {port: bus.get_stats() for port, bus in self.buses.items()},
+            "aggregated": self.aggregated,
+            "queued": self._queue.qsize() if self._queue else 0,
+            "dropped": self.dropped,
+            "unknown": self.unknown
+        }
@@ -1,20 +1,487 @@
 import asyncio
-from engine.collector import start_all_polling
-from utils.config_loader import load_config
-import sys
+import os
+from alerts.subscriptions import COALESCE, DROP_OLDEST, TOPIC_SAMPLE, SampleEvent, get_event_bus
+from engine.collector import start_all_polling, set_sample_callback
+from utils.config_loader import ConfigWatcher, load_config
+from modbus.planner import DEFAULT_MAX_GAP
+from storage.cache import configure_cache, get_sample_cache
+from storage.journal import configure_journal
+from storage.local_db import LocalDB
+from storage.rollup import RollupEngine, Tier
+from transport.http_client import HttpUploader
+from transport.mqtt_client import Deadband, MqttPublisher
+from drivers.sungrow import SungrowDriver
+from engine.mapper import get_register_map
+from modbus.health import STATES
+from modbus.tcp_server import ModbusTcpServer, RegisterImage, build_fields
+from alerts.error_detector import TOPIC_ALERT, PlantLayout, StringDetector
+from control.command_listener import CommandListener
+from control.modbus_writer import configure_writer
+from engine.plant import TOPIC_PLANT, PlantAggregator, load_projects
+from engine.policy import configure_policy
+from engine.scheduler import get_scheduler
+from engine.workers import BusProcessPool
+from modbus.bus import configure_bus_manager, get_bus_manager
+from utils.logger import LoopLagMonitor, MetricsServer, get_metrics, set_level
+from utils.validator import DEFAULT_PORT, DEFAULT_SLAVE_ID
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Hàng đợi mặc định của từng consumer (server.yaml -> subscriptions ghi đè):
+# sink cần mọi mẫu bỏ message cũ nhất khi đầy, sink chỉ cần giá trị mới nhất thì gộp theo inverter
+SUBSCRIBER_DEFAULTS = {
+    "storage": {"policy": DROP_OLDEST, "queue_size": 20000, "batch_size": 500},
+    "rollup": {"policy": DROP_OLDEST, "queue_size": 20000, "batch_size": 500},
+    "mqtt": {"policy": COALESCE, "queue_size": 1000},
+    "mqtt_alerts": {"policy": DROP_OLDEST, "queue_size": 1000},
+    "modbus_tcp": {"policy": COALESCE, "queue_size": 1000},
+    "plant": {"policy": COALESCE, "queue_size": 1000},
+    "alerts": {"policy": COALESCE, "queue_size": 1000},
+}
+
 def build_inverter_configs(config):
     return [
         {
             "id": inv["id"],
-            "port": inv.get("port", "COM3"),
-            "slave_id": inv.get("slave_id", 1),
+            "port": inv.get("port", DEFAULT_PORT),
+            "slave_id": inv.get("slave_id", DEFAULT_SLAVE_ID),
+            "baudrate": inv.get("baudrate", 9600),
             "mppt_count": inv.get("mppt_count", 9),
-            "string_count": inv.get("string_count", 18)
+            "string_count": inv.get("string_count", 18),
+            "max_gap": inv.get("max_gap", DEFAULT_MAX_GAP),
+            "register_map": inv.get("register_map"),
+            **({"phase": inv["phase"]} if "phase" in inv else {})
         }
         for inv in config.get("inverters", [])
     ]
 
+def build_local_db(server_config):
+    storage = server_config.get("storage", {})
+    if not storage.get("enabled", True):
+        return None
+    return LocalDB(
+        os.path.join(BASE_DIR, storage.get("path", "data/datalogger.db")),
+        batch_size=storage.get("batch_size", 500),
+        flush_interval=storage.get("flush_interval", 30),
+        retention_days=storage.get("retention_days", 30),
+        max_buffered=storage.get("max_buffered")
+    )
+
+def build_journal_options(server_config):
+    journal = server_config.get("journal", {})
+    if not journal.get("enabled"):
+        return None
+    return {
+        "path": os.path.join(BASE_DIR, journal.get("path", "data/journal")),
+        "segment_bytes": int(journal.get("segment_mb", 16) * (1 << 20)),
+        "max_bytes": int(journal.get("max_mb", 256) * (1 << 20)),
+        "flush_interval": journal.get("flush_interval", 5)
+    }
+
+def build_rollup(server_config, db):
+    rollup = server_config.get("rollup", {})
+    if not rollup.get("enabled", True) or db is None:
+        return None
+    tiers = [Tier(**tier) for tier in rollup["tiers"]] if rollup.get("tiers") else None
+    return RollupEngine(db, tiers, grace=rollup.get("grace", 30))
+
+def build_http_uploader(server_config, db):
+    http = server_config.get("http", {})
+    if not http.get("enabled") or db is None:
+        return None
+    return HttpUploader(
+        db,
+        http["endpoint"],
+        token=http.get("token"),
+        interval=http.get("interval", 60),
+        batch_size=http.get("batch_size", 500),
+        backfill_batches=http.get("backfill_batches", 2)
+    )
+
+def build_mqtt_publisher(server_config, inverter_configs):
+    mqtt = server_config.get("mqtt", {})
+    if not mqtt.get("enabled"):
+        return None
+    publisher = MqttPublisher(
+        host=mqtt.get("host", "localhost"),
+        port=mqtt.get("port", 1883),
+        topic_prefix=mqtt.get("topic_prefix", "datalogger"),
+        qos=mqtt.get("qos", 1),
+        username=mqtt.get("username"),
+        password=mqtt.get("password"),
+        max_silence=mqtt.get("max_silence", 900),
+        queue_size=mqtt.get("queue_size", 10000),
+        default_deadband=Deadband(**mqtt.get("default_deadband", {}))
+    )
+    # Deadband theo register map của từng inverter
+    for inv in inverter_configs:
+        register_map = get_register_map(inv.get("register_map") or SungrowDriver.MAP_NAME)
+        publisher.filter.set_deadbands(
+            inv["id"], {key: Deadband(**band) for key, band in register_map.deadbands().items()})
+    return publisher
+
+def build_tcp_server(server_config, inverter_configs, projects):
+    modbus_tcp = server_config.get("modbus_tcp", {})
+    if not modbus_tcp.get("enabled"):
+        return None
+    # Mỗi inverter là một unit id (= id inverter)
+    units = [inv["id"] for inv in inverter_configs]
+    image = RegisterImage(build_fields(modbus_tcp.get("register_map", {})), units)
+    # Mỗi nhà máy một unit id (= plant_unit_base + id project)
+    plant_units = {}
+    base = modbus_tcp.get("plant_unit_base")
+    if base is not None and server_config.get("plant", {}).get("enabled", True):
+        for project in projects:
+            unit = base + project["id"]
+            if unit in units or not 1 <= unit <= 247:
+                print(f"[ModbusTCP] ⚠️ Bỏ qua unit {unit} của project {project['id']}: trùng inverter hoặc ngoài 1-247")
+                continue
+            plant_units[project["id"]] = unit
+    return ModbusTcpServer(
+        image,
+        host=modbus_tcp.get("host", "0.0.0.0"),
+        port=modbus_tcp.get("port", 5020),
+        default_unit=modbus_tcp.get("slave_id"),
+        plant_units=plant_units
+    )
+
+def build_plant_aggregator(server_config, projects, realtime_interval):
+    plant = server_config.get("plant", {})
+    if not plant.get("enabled", True) or not projects:
+        return None
+    return PlantAggregator(load_projects(projects), interval=realtime_interval,
+                           stale_after=plant.get("stale_after", 180))
+
+def build_error_detector(config, inverter_configs, realtime_interval):
+    alerts = dict(config.get("server", {}).get("alerts", {}))
+    if not alerts.pop("enabled", True):
+        return None
+    # Giới hạn Max_I/Max_V/Max_P của từng string/MPPT
+    layout = PlantLayout(inverter_configs, config.get("strings", []), config.get("mppt_channels", []))
+    return StringDetector(layout, interval=realtime_interval, **alerts)
+
+def build_command_listener(config, inverter_configs, publisher=None):
+    control = config.get("server", {}).get("control", {})
+    if not control.get("enabled", False):
+        return None
+    if publisher is None:
+        # Lệnh chỉ đến qua MQTT <prefix>/cmd: không có publisher thì listener không bao giờ nhận được lệnh
+        print("[Control] ⚠️ control.enabled nhưng mqtt.enabled: false - không có kênh nhận lệnh, "
+              "tắt điều khiển (bật mqtt hoặc đặt control.enabled: false)")
+        return None
+    writer = configure_writer(verify=control.get("verify", True), retries=control.get("retries", 2),
+                              points=control.get("points"))
+    projects = {p["id"]: p.get("inverters", []) for p in config.get("projects", {}).get("projects", [])}
+    listener = CommandListener([inv["id"] for inv in inverter_configs], projects, writer)
+    listener.attach_mqtt(publisher)
+    return listener
+
+def build_bus_pool(server_config, inverter_configs, policy):
+    workers = server_config.get("workers", {})
+    if not workers.get("enabled"):
+        return None
+    # Process bus tự dựng policy / log level / journal từ cùng cấu hình
+    options = {
+        "polling": {"realtime_interval": policy.realtime_interval, "energy_interval": policy.energy_interval,
+                    **server_config.get("polling", {})},
+        "log_level": server_config.get("logging", {}).get("level", "info"),
+        "journal": build_journal_options(server_config),
+        "rtu": server_config.get("rtu", {})
+    }
+    return BusProcessPool(
+        inverter_configs, options,
+        realtime_interval=policy.realtime_interval,
+        queue_size=workers.get("queue_size", 10000),
+        restart_delay=workers.get("restart_delay", 1),
+        max_restart_delay=workers.get("max_restart_delay", 60)
+    )
+
+def build_metrics_server(server_config, db=None, uploader=None, publisher=None, listener=None, pool=None,
+                         rollup=None, plant=None, events=None):
+    metrics_config = server_config.get("metrics", {})
+    if not metrics_config.get("enabled"):
+        return None
+    registry = get_metrics()
+    # Chế độ process mỗi bus: thống kê bus do các process bus báo lên
+    buses = pool.buses if pool else get_bus_manager().buses
+    scheduler = get_scheduler()
+
+    # Đọc lúc scrape từ bộ đếm sẵn có của từng thành phần
+    def per_bus(key):
+        return lambda: {(port,): bus.get_stats()[key] for port, bus in list(buses.items())}
+    registry.gauge_func("datalogger_bus_queue_depth", "Job đọc/ghi đang chờ trên bus", per_bus("pending"), ("bus",))
+    registry.gauge_func("datalogger_bus_urgent_queue_depth", "Lệnh điều khiển đang chờ trên bus",
+                        per_bus("urgent_pending"), ("bus",))
+    registry.gauge_func("datalogger_bus_utilisation", "Tỷ lệ thời gian bus bận (cửa sổ 60 s)",
+                        per_bus("utilisation"), ("bus",))
+    registry.counter_func("datalogger_bus_preemptions_total", "Số lần lệnh ưu tiên chen vào job đọc",
+                          per_bus("preemptions"), ("bus",))
+    registry.counter_func("datalogger_bus_retries_total", "Block lỗi được đọc lại ngay trên bus",
+                          per_bus("retries"), ("bus",))
+    registry.counter_func("datalogger_bus_retries_denied_total", "Block lỗi không được đọc lại do hết retry budget",
+                          per_bus("retries_denied"), ("bus",))
+
+    def per_slave(key, convert=lambda value: value):
+        return lambda: {(port, str(slave_id)): convert(link[key])
+                        for port, bus in list(buses.items())
+                        for slave_id, link in bus.get_stats().get("links", {}).items()}
+    registry.gauge_func("datalogger_slave_circuit_state", "Circuit breaker của slave (0 closed, 1 half-open, 2 open)",
+                        per_slave("state", STATES.index), ("bus", "slave"))
+    registry.gauge_func("datalogger_slave_timeout_seconds", "Timeout thích nghi của frame gần nhất",
+                        per_slave("timeout"), ("bus", "slave"))
+
+    def skipped_cycles():
+        if pool:
+            return {(task_type,): count for task_type, count in pool.skipped_cycles().items()}
+        totals = {}
+        for tasks in list(scheduler.tasks.values()):
+            for task_type, task in tasks.items():
+                totals[(task_type.value,)] = totals.get((task_type.value,), 0) + task.skipped_cycles
+        return totals
+    registry.gauge_func("datalogger_sample_cache_bytes", "Bộ nhớ ring buffer mẫu",
+                        lambda: get_sample_cache().get_stats()["bytes"])
+    registry.counter_func("datalogger_scheduler_skipped_cycles_total", "Chu kỳ poll bị bỏ qua do overrun",
+                          skipped_cycles, ("type",))
+
+    if pool:
+        registry.counter_func("datalogger_bus_process_restarts_total", "Số lần process bus được khởi động lại",
+                              per_bus("restarts"), ("bus",))
+        registry.gauge_func("datalogger_bus_process_up", "Process bus đang chạy (1) hay không (0)",
+                            lambda: {(port,): int(bus.get_stats()["alive"]) for port, bus in buses.items()},
+                            ("bus",))
+        registry.gauge_func("datalogger_aggregator_queue_depth", "Mẫu từ process bus chờ aggregator xử lý",
+                            lambda: pool.get_stats()["queued"])
+        registry.counter_func("datalogger_aggregator_dropped_total", "Mẫu bị bỏ do đầy hàng đợi aggregator",
+                              lambda: pool.dropped)
+    if db:
+        registry.gauge_func("datalogger_storage_buffered", "Mẫu chờ ghi xuống DB", lambda: db.get_stats()["buffered"])
+        registry.counter_func("datalogger_storage_rows_written_total", "Mẫu đã ghi xuống DB", lambda: db.rows_written)
+        registry.counter_func("datalogger_storage_flushes_total", "Số lần flush DB", lambda: db.flushes)
+        registry.counter_func("datalogger_storage_dropped_total", "Dòng bị bỏ do buffer đầy khi ghi DB lỗi",
+                              lambda: db.dropped)
+    if rollup:
+        registry.counter_func("datalogger_rollup_windows_total", "Cửa sổ tổng hợp đã ghi theo tầng",
+                              lambda: {(tier,): count for tier, count in rollup.closed.items()}, ("tier",))
+        registry.counter_func("datalogger_rollup_late_samples_total", "Mẫu bị bỏ do cửa sổ tổng hợp đã ghi",
+                              lambda: rollup.late)
+    if plant:
+        def per_plant(name):
+            return lambda: {(str(project_id),): getattr(state.latest, name)
+                            for project_id, state in plant.plants.items() if state.latest}
+        registry.gauge_func("datalogger_plant_power_watts", "Tổng công suất AC nhà máy", per_plant("power_w"),
+                            ("project",))
+        registry.gauge_func("datalogger_plant_availability", "Tỷ lệ inverter có dữ liệu và không fault",
+                            per_plant("availability"), ("project",))
+        registry.gauge_func("datalogger_plant_inverters_missing", "Inverter không có dữ liệu quá stale_after",
+                            per_plant("missing"), ("project",))
+    if uploader:
+        registry.counter_func("datalogger_upload_samples_total", "Mẫu đã upload", lambda: uploader.samples_sent)
+        registry.counter_func("datalogger_upload_bytes_total", "Byte đã upload", lambda: uploader.bytes_sent)
+        registry.counter_func("datalogger_upload_requests_total", "Số request upload", lambda: uploader.requests)
+        registry.counter_func("datalogger_upload_failures_total", "Số lần upload thất bại", lambda: uploader.failures)
+        registry.gauge_func("datalogger_upload_backlog", "Mẫu trong DB chưa upload",
+                            lambda: uploader.get_stats()["pending"])
+    if publisher:
+        registry.counter_func("datalogger_mqtt_published_total", "Message MQTT đã gửi", lambda: publisher.published)
+        registry.counter_func("datalogger_mqtt_bytes_total", "Byte MQTT đã gửi", lambda: publisher.bytes_sent)
+        registry.counter_func("datalogger_mqtt_dropped_total", "Message MQTT bị bỏ do đầy hàng đợi",
+                              lambda: publisher.dropped)
+        registry.gauge_func("datalogger_mqtt_queue_depth", "Message MQTT chờ gửi",
+                            lambda: publisher.get_stats()["queued"])
+    if events:
+        def per_subscriber(key, scale=1):
+            return lambda: {(s.topic.name, s.name): stats[key] * scale
+                            for s in events.all() for stats in (s.get_stats(),) if key in stats}
+        labels = ("topic", "subscriber")
+        registry.gauge_func("datalogger_subscriber_queue_depth", "Message chờ giao cho subscriber",
+                            per_subscriber("queued"), labels)
+        registry.counter_func("datalogger_subscriber_dropped_total", "Message bị bỏ do đầy hàng đợi subscriber",
+                              per_subscriber("dropped"), labels)
+        registry.counter_func("datalogger_subscriber_coalesced_total", "Message bị thay bằng message mới hơn cùng khóa",
+                              per_subscriber("coalesced"), labels)
+        registry.counter_func("datalogger_subscriber_expired_total", "Mẫu bị ring buffer ghi đè trước khi kịp giao",
+                              per_subscriber("expired"), labels)
+        registry.gauge_func("datalogger_subscriber_lag_p99_seconds", "Độ trễ giao p99 (cửa sổ gần nhất)",
+                            per_subscriber("lag_p99_ms", 0.001), labels)
+    if listener:
+        registry.gauge_func("datalogger_control_queue_depth", "Lệnh ghi đang chờ",
+                            lambda: listener.writer.get_stats()["pending"])
+
+    return MetricsServer(registry, host=metrics_config.get("host", "127.0.0.1"),
+                         port=metrics_config.get("port", 9108))
+
+def subscribe(server_config, topic, handler, name):
+    """Đăng ký consumer lên event bus với chính sách hàng đợi theo tên"""
+    options = dict(SUBSCRIBER_DEFAULTS.get(name, {}))
+    options.update(server_config.get("subscriptions", {}).get(name) or {})
+    return get_event_bus().subscribe(topic, handler, name=name, **options)
+
+def build_config_watcher(server_config):
+    reload = server_config.get("config_reload", {})
+    if not reload.get("enabled", True):
+        return None
+    return ConfigWatcher(interval=reload.get("interval", 5))
+
+def apply_config(config, changed, inverter_configs, policy, pool=None, detector=None, plant=None, listener=None):
+    """Áp dụng cấu hình vừa nạp lại vào các thành phần đang chạy, polling không bị dừng"""
+    server_config = config["server"]
+    restart = [name for name in changed if name == "inverters" or name.startswith("register_maps/")]
+    if "server" in changed:
+        set_level(server_config.get("logging", {}).get("level", "info"))
+        polling = server_config.get("polling", {})
+        if pool:
+            # Policy chạy trong từng process bus
+            restart += [f"polling.{name}" for name in polling if getattr(policy, name, None) != polling[name]]
+        else:
+            restart += [f"polling.{name}" for name in policy.update(**polling)]
+        if detector:
+            alerts = dict(server_config.get("alerts", {}))
+            alerts.pop("enabled", None)
+            if "ewma_window" in alerts:
+                detector.alpha = 2 / (alerts.pop("ewma_window") + 1)
+            for name, value in alerts.items():
+                if hasattr(detector, name):
+                    setattr(detector, name, value)
+        if plant:
+            plant.stale_after = server_config.get("plant", {}).get("stale_after", plant.stale_after)
+        if listener and "points" in server_config.get("control", {}):
+            listener.writer.points = set(server_config["control"]["points"] or ())
+    # strings/mppt render với context là project đầu tiên
+    if detector and changed & {"strings", "mppt_channels", "projects"}:
+        detector.layout = PlantLayout(inverter_configs, config.get("strings", []), config.get("mppt_channels", []))
+    if "projects" in changed:
+        projects = config["projects"].get("projects", [])
+        if plant:
+            plant.reload(load_projects(projects))
+        if listener:
+            listener.projects = {p["id"]: p.get("inverters", []) for p in projects}
+    if restart:
+        print(f"[Main] ⚠️ Cần khởi động lại để áp dụng: {', '.join(sorted(restart))}")
+
+def build_polling_policy(server_config):
+    polling = dict(server_config.get("polling", {}))
+    polling.setdefault("realtime_interval", 5)
+    polling.setdefault("energy_interval", 900)
+    return configure_policy(**polling)
+
+async def run(config):
+    inverter_configs = build_inverter_configs(config)
+    server_config = config.get("server", {})
+    projects = config.get("projects", {}).get("projects", [])
+    set_level(server_config.get("logging", {}).get("level", "info"))
+    policy = build_polling_policy(server_config)
+    # Timeout thích nghi / retry budget / circuit breaker của các bus (chế độ process: trong process bus)
+    configure_bus_manager(**server_config.get("rtu", {}))
+    background = []
+
+    # Ring buffer mẫu gọn của từng inverter: storage, alerts, TCP server đọc chung không sao chép
+    configure_cache(hours=server_config.get("cache", {}).get("hours", 1), interval=policy.realtime_interval)
+
+    # Journal frame thô (chế độ process mỗi bus: do từng process bus ghi)
+    journal_options = build_journal_options(server_config)
+    journal = None
+    if journal_options and not server_config.get("workers", {}).get("enabled"):
+        journal = configure_journal(**journal_options)
+
+    # Mỗi consumer một hàng đợi trên event bus: poll loop chỉ publish, không chờ consumer
+    events = get_event_bus()
+
+    # Store-and-forward cục bộ
+    db = build_local_db(server_config)
+    if db:
+        subscribe(server_config, TOPIC_SAMPLE, db.store, "storage")
+        background.append(asyncio.create_task(db.run_flusher()))
+
+    # Tổng hợp 1 phút / 15 phút / ngày vào local DB khi mẫu đến
+    rollup = build_rollup(server_config, db)
+    if rollup:
+        subscribe(server_config, TOPIC_SAMPLE, rollup.on_sample, "rollup")
+        background.append(asyncio.create_task(rollup.run()))
+
+    # Upload lên server từ local DB
+    uploader = build_http_uploader(server_config, db)
+    if uploader:
+        background.append(asyncio.create_task(uploader.run()))
+
+    # MQTT report-by-exception
+    publisher = build_mqtt_publisher(server_config, inverter_configs)
+    if publisher:
+        subscribe(server_config, TOPIC_SAMPLE, publisher.on_sample, "mqtt")
+        publisher.start()
+
+    # Modbus TCP cho SCADA, trả lời từ register image
+    tcp_server = build_tcp_server(server_config, inverter_configs, projects)
+    if tcp_server:
+        subscribe(server_config, TOPIC_SAMPLE, tcp_server.on_sample, "modbus_tcp")
+        background.append(asyncio.create_task(tcp_server.serve_forever()))
+
+    # Snapshot nhà máy căn theo chu kỳ, lưu / publish như một record riêng
+    plant = build_plant_aggregator(server_config, projects, policy.realtime_interval)
+    if plant:
+        subscribe(server_config, TOPIC_SAMPLE, plant.on_sample, "plant")
+        if publisher:
+            # Bức xạ từ cảm biến nhà máy cho performance ratio
+            plant.attach_mqtt(publisher)
+        for target, name in ((db and db.store_plant, "storage"), (publisher and publisher.on_plant, "mqtt"),
+                             (tcp_server and tcp_server.on_plant, "modbus_tcp")):
+            if target:
+                subscribe(server_config, TOPIC_PLANT, target, name)
+        background.append(asyncio.create_task(plant.run()))
+
+    # Phát hiện string/MPPT bất thường
+    detector = build_error_detector(config, inverter_configs, policy.realtime_interval)
+    if detector:
+        subscribe(server_config, TOPIC_SAMPLE, detector.on_sample, "alerts")
+        background.append(asyncio.create_task(detector.run()))
+        # Thay đổi trạng thái alert luôn lên event bus; consumer nào cần thì đăng ký
+        detector.on_alert = lambda alert: events.publish(TOPIC_ALERT, alert)
+        if publisher:
+            subscribe(server_config, TOPIC_ALERT, publisher.on_alert, "mqtt_alerts")
+
+    # Lệnh điều khiển (giới hạn công suất...) qua MQTT, chen trước polling trên bus
+    listener = build_command_listener(config, inverter_configs, publisher)
+
+    # Tùy chọn: mỗi cổng serial một process riêng, process chính chỉ gộp mẫu cho consumer
+    pool = build_bus_pool(server_config, inverter_configs, policy)
+
+    # Nạp lại nóng file cấu hình đã sửa (giới hạn, ngưỡng alert, project...) mà không dừng polling
+    watcher = build_config_watcher(server_config)
+    if watcher:
+        watcher.subscribe(lambda new_config, changed: apply_config(
+            new_config, changed, inverter_configs, policy, pool, detector, plant, listener))
+        background.append(asyncio.create_task(watcher.run()))
+
+    # Metrics cho Prometheus: độ trễ frame, lỗi, hàng đợi, throughput
+    metrics_server = build_metrics_server(server_config, db, uploader, publisher, listener, pool, rollup, plant,
+                                          events)
+    if metrics_server:
+        background.append(asyncio.create_task(metrics_server.serve_forever()))
+        lag_monitor = LoopLagMonitor(interval=server_config["metrics"].get("loop_lag_interval", 0.5))
+        background.append(asyncio.create_task(lag_monitor.run()))
+
+    async def on_sample(inverter_id, ts, data):
+        events.publish(TOPIC_SAMPLE, SampleEvent(inverter_id, ts, data))
+    set_sample_callback(on_sample)
+    background.append(asyncio.create_task(events.run()))
+
+    try:
+        if pool:
+            await pool.run()
+        else:
+            await start_all_polling(inverter_configs, policy.realtime_interval, policy.energy_interval)
+    finally:
+        for task in background:
+            task.cancel()
+        await asyncio.gather(*background, return_exceptions=True)
+        # Đóng client Modbus / thread worker của từng bus trước khi đóng storage
+        get_bus_manager().stop_all()
+        if publisher:
+            publisher.stop()
+        if db:
+            db.close()
+        if journal:
+            journal.close()
+
 if __name__ == "__main__":
     config = load_config()
-    inverter_configs = build_inverter_configs(config)
-    asyncio.run(start_all_polling(inverter_configs))
+    asyncio.run(run(config))
@@ -0,0 +1,416 @@
+"""
+Bus worker - Quản lý truy cập bus RS-485 dùng chung
+- Mỗi cổng serial có một thread riêng sở hữu một client duy nhất
+- Các slave trên cùng cổng dùng chung client qua hàng đợi giao dịch
+- Hàng đợi công bằng (round-robin theo slave), tôn trọng khoảng nghỉ RTU t3.5
+- Hàng đợi ưu tiên (lệnh ghi điều khiển) chen vào giữa các frame của job đọc đang chạy
+- Thống kê mức sử dụng bus (utilisation) theo cửa sổ trượt
+- Histogram độ trễ từng frame và bộ đếm lỗi theo loại (timeout, CRC...) theo bus/slave
+- Timeout thích nghi và circuit breaker theo slave, đọc lại block lỗi trong retry budget của bus
+  (modbus/health.py): inverter offline không làm overrun chu kỳ của các inverter khác
+"""
+import asyncio
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+from pymodbus.client import ModbusSerialClient, ModbusTcpClient
+from pymodbus.exceptions import ConnectionException
+from pymodbus.framer.rtu_framer import ModbusRtuFramer
+from pymodbus.pdu import ExceptionResponse
+
+from modbus.health import CLOSED, RetryBudget, SlaveLink, wire_time
+from utils.logger import get_metrics
+
+UTILISATION_WINDOW = 60.0  # Cửa sổ tính utilisation (giây)
+
+# Bucket độ trễ frame (giây): 9600 baud đọc 100 thanh ghi ~ 0.25 s
+FRAME_BUCKETS = (0.01, 0.025, 0.05, 0.075, 0.1, 0.15, 0.2, 0.3, 0.5, 0.75, 1.0, 2.0, 5.0)
+
+FRAME_SECONDS = get_metrics().histogram(
+    "datalogger_modbus_frame_seconds", "Thời gian một giao dịch request/response trên bus",
+    ("bus", "slave"), FRAME_BUCKETS)
+FRAME_ERRORS = get_metrics().counter(
+    "datalogger_modbus_frame_errors_total", "Frame lỗi theo loại (timeout, crc, exception, connection, error)",
+    ("bus", "slave", "kind"))
+
+# Lỗi đường truyền (tính cho circuit breaker) và lỗi được đọc lại ngay
+LINK_ERRORS = ("timeout", "crc", "connection", "error")
+RETRYABLE = ("timeout", "crc")
+
+
+def _resolve(future: asyncio.Future, result=None, error: Optional[BaseException] = None):
+    """Trả kết quả về future (chạy trên event loop)"""
+    if future.done():
+        return  # Coroutine đã bị cancel
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+def error_kind(result=None, error: Optional[BaseException] = None) -> str:
+    """Phân loại frame lỗi: timeout, crc (response hỏng), exception (slave từ chối), connection, error"""
+    if isinstance(error, ConnectionException):
+        return "connection"
+    if isinstance(result, ExceptionResponse):
+        return "exception"
+    message = str(error if error is not None else result)
+    if "Unable to decode" in message or "CRC" in message:
+        return "crc"
+    if "No response" in message or "No Response" in message or isinstance(error, TimeoutError):
+        return "timeout"
+    return "error"
+
+
+def frame_gap(baudrate: int) -> float:
+    """Khoảng nghỉ tối thiểu giữa 2 frame RTU (t3.5), tính bằng giây"""
+    if baudrate > 19200:
+        return 0.00175  # Giá trị cố định theo chuẩn Modbus RTU
+    return 3.5 * 11 / baudrate  # 11 bit/ký tự (start + 8 data + parity/stop)
+
+
+class BusWorker:
+    """Thread worker sở hữu client Modbus của một cổng serial"""
+
+    def __init__(self, port: str, baudrate: int = 9600, parity: str = 'N',
+                 stopbits: int = 1, bytesize: int = 8, timeout: float = 1,
+                 block_retries: int = 1, retry_budget: float = 0.1, retry_burst: float = 10, **link_options):
+        self.port = port
+        self.baudrate = baudrate
+        self.gap = frame_gap(baudrate)
+        self.timeout = timeout
+        self._serial_params = dict(baudrate=baudrate, parity=parity, stopbits=stopbits,
+                                   bytesize=bytesize, timeout=timeout)
+        self.client: Optional[ModbusSerialClient] = None
+
+        # Đường truyền tới từng slave (tham số: SlaveLink) và retry budget chung của bus
+        self.block_retries = block_retries
+        self.budget = RetryBudget(retry_budget, retry_burst)
+        self._link_options = dict(link_options, timeout=timeout)
+        self.links: Dict[int, SlaveLink] = {}
+
+        # Hàng đợi công bằng: mỗi slave một deque, phục vụ xoay vòng
+        self._jobs: Dict[int, Deque[Tuple]] = {}
+        self._ready: Deque[int] = deque()
+        self._urgent: Deque[Tuple] = deque()  # Job ưu tiên, chạy ở ranh giới frame kế tiếp
+        self._in_urgent = False
+        self._cond = threading.Condition()
+        self._running = True
+
+        # Khóa I/O: mỗi lúc chỉ một frame trên dây
+        self._io_lock = threading.RLock()
+        self._last_frame_end = 0.0
+
+        # Thống kê
+        self.frames = 0
+        self.errors = 0
+        self.preemptions = 0  # Số job ưu tiên chen vào giữa một job khác
+        self.retries = 0
+        self.retries_denied = 0  # Block lỗi không được đọc lại do hết retry budget
+        self.error_kinds: Dict[str, int] = {}
+        self._current_slave: Optional[int] = None  # Slave của job đang chạy (nhãn metrics)
+        self._frame_seconds: Dict[Optional[int], object] = {}  # Histogram theo slave (cache labels)
+        self._busy: Deque[Tuple[float, float]] = deque()  # (thời điểm kết thúc, thời lượng)
+        self._started_at = time.monotonic()
+
+        self._thread = threading.Thread(target=self._run, name=f"bus-{port}", daemon=True)
+        self._thread.start()
+
+    # ------------------------------------------------------------------
+    # Thread của bus
+    # ------------------------------------------------------------------
+    def _next_job(self) -> Optional[Tuple]:
+        """Lấy job kế tiếp: job ưu tiên trước, sau đó round-robin giữa các slave"""
+        with self._cond:
+            while self._running and not self._ready and not self._urgent:
+                self._cond.wait()
+            if self._urgent:
+                return self._urgent.popleft() + (True,)
+            if not self._ready:
+                return None
+
+            slave_id = self._ready.popleft()
+            jobs = self._jobs[slave_id]
+            job = jobs.popleft()
+            if jobs:
+                self._ready.append(slave_id)  # Còn job -> xếp cuối lượt
+            return job + (False,)
+
+    def _execute(self, slave_id: int, fn: Callable, args: Tuple, loop, future: asyncio.Future, urgent: bool):
+        """Chạy một job và trả kết quả về event loop"""
+        if future.cancelled():
+            return
+        previous_slave = self._current_slave  # Job ưu tiên có thể chạy lồng trong job khác
+        self._current_slave = slave_id
+        self._in_urgent = urgent
+        try:
+            result = fn(*args)
+        except Exception as e:
+            loop.call_soon_threadsafe(_resolve, future, None, e)
+        else:
+            loop.call_soon_threadsafe(_resolve, future, result)
+        finally:
+            self._in_urgent = False
+            self._current_slave = previous_slave
+
+    def _preempt(self):
+        """Chạy các job ưu tiên đang chờ trước frame kế tiếp của job hiện tại"""
+        while True:
+            with self._cond:
+                if not self._urgent:
+                    return
+                job = self._urgent.popleft()
+            self.preemptions += 1
+            self._execute(*job, True)
+
+    def _run(self):
+        """Vòng lặp của thread: lấy job và thực thi tuần tự"""
+        while True:
+            job = self._next_job()
+            if job is None:
+                break
+            self._execute(*job)
+
+        if self.client:
+            self.client.close()
+
+    def _ensure_client(self) -> ModbusSerialClient:
+        """Tạo và kết nối client dùng chung (lazy, trên thread của bus)"""
+        if self.client is None:
+            if self.port.startswith("tcp://"):
+                # RTU qua TCP (gateway serial-ethernet, bộ mô phỏng): vẫn frame RTU + CRC
+                url = urlsplit(self.port)
+                self.client = ModbusTcpClient(url.hostname, port=url.port or 502, framer=ModbusRtuFramer,
+                                              timeout=self._serial_params["timeout"])
+            else:
+                self.client = ModbusSerialClient(port=self.port, method="rtu", **self._serial_params)
+            self.client.connect()
+        return self.client
+
+    def _link(self, slave_id: Optional[int]) -> Optional[SlaveLink]:
+        if slave_id is None:
+            return None
+        link = self.links.get(slave_id)
+        if link is None:
+            link = self.links[slave_id] = SlaveLink(self.port, slave_id, **self._link_options)
+        return link
+
+    @staticmethod
+    def _set_timeout(client, timeout: float):
+        """Timeout của frame kế tiếp (pymodbus đọc params.timeout mỗi lần nhận)"""
+        params = getattr(client, "params", client)  # pymodbus 2.x: thuộc tính timeout nằm trên client
+        if params.timeout == timeout:
+            return
+        params.timeout = timeout
+        socket = getattr(client, "socket", None)
+        if socket is None:
+            return
+        if isinstance(client, ModbusSerialClient):
+            socket.timeout = timeout
+        else:
+            socket.settimeout(timeout)
+
+    def transaction(self, fn: Callable, registers: int = 0, retry: bool = False):
+        """
+        Thực hiện một giao dịch request/response trên bus.
+        fn nhận client và gửi đúng một frame. Gọi từ thread của bus.
+        registers: số thanh ghi của frame (ước lượng thời gian truyền cho timeout thích nghi).
+        retry: gửi lại ngay khi timeout/CRC, tối đa block_retries lần trong retry budget của bus.
+        Trả về None (không gửi gì) khi circuit breaker của slave đang ngắt; job ưu tiên
+        (lệnh điều khiển) thì luôn gửi, coi như frame thử half-open.
+        """
+        # Ranh giới frame: lệnh ưu tiên không phải chờ hết chu kỳ đọc của slave khác
+        if self._urgent and not self._in_urgent and threading.current_thread() is self._thread:
+            self._preempt()
+
+        with self._io_lock:
+            link = self._link(self._current_slave)
+            if link is not None and not link.allow(time.monotonic(), probe=self._in_urgent):
+                return None
+            client = self._ensure_client()
+            wire = wire_time(registers, self.baudrate)
+            timeout = link.timeout_for(wire) if link else self.timeout
+            self.budget.earn()
+
+            attempt = 0
+            while True:
+                try:
+                    result, duration = self._exchange(client, fn, timeout)
+                except Exception as e:
+                    self._record_error(None, e)
+                    if link:
+                        link.failure(time.monotonic())
+                    raise
+
+                kind = self._record_error(result) if result is None or result.isError() else None
+                if link is not None:
+                    if kind in LINK_ERRORS:
+                        link.failure(time.monotonic())
+                    else:
+                        link.success(duration, wire)  # Exception response: slave vẫn trả lời
+                if (not retry or kind not in RETRYABLE or attempt >= self.block_retries
+                        or (link is not None and link.state != CLOSED)):
+                    return result
+                if not self.budget.spend():
+                    self.retries_denied += 1
+                    return result
+                attempt += 1
+                self.retries += 1
+                # Lần gửi lại chờ lâu hơn: slave chậm đi vẫn được ghi nhận vào turnaround
+                timeout = min(self.timeout, timeout * 2)
+
+    def _exchange(self, client, fn: Callable, timeout: float):
+        """Một frame trên dây (giữ khoảng nghỉ t3.5), trả về (kết quả, thời gian giao dịch)"""
+        self._set_timeout(client, timeout)
+
+        # Đảm bảo khoảng nghỉ t3.5 kể từ frame trước
+        wait = self._last_frame_end + self.gap - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+
+        start = time.monotonic()
+        try:
+            result = fn(client)
+        finally:
+            end = time.monotonic()
+            self._last_frame_end = end
+            self.frames += 1
+            self._record_busy(end, end - start)
+            self._observe_frame(end - start)
+        return result, end - start
+
+    def _observe_frame(self, duration: float):
+        histogram = self._frame_seconds.get(self._current_slave)
+        if histogram is None:
+            slave = self._current_slave if self._current_slave is not None else ""
+            histogram = self._frame_seconds[self._current_slave] = FRAME_SECONDS.labels(self.port, slave)
+        histogram.observe(duration)
+
+    def _record_error(self, result=None, error: Optional[BaseException] = None) -> str:
+        kind = error_kind(result, error)
+        self.errors += 1
+        self.error_kinds[kind] = self.error_kinds.get(kind, 0) + 1
+        slave = self._current_slave if self._current_slave is not None else ""
+        FRAME_ERRORS.labels(self.port, slave, kind).inc()
+        return kind
+
+    def _record_busy(self, end: float, duration: float):
+        """Ghi nhận thời gian bus bận, loại bỏ mẫu ngoài cửa sổ"""
+        self._busy.append((end, duration))
+        while self._busy and self._busy[0][0] < end - UTILISATION_WINDOW:
+            self._busy.popleft()
+
+    # ------------------------------------------------------------------
+    # API cho event loop
+    # ------------------------------------------------------------------
+    async def run(self, slave_id: int, fn: Callable, *args):
+        """Xếp hàng hàm blocking cho slave trên thread của bus và chờ kết quả"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._cond:
+            if slave_id not in self._jobs:
+                self._jobs[slave_id] = deque()
+            jobs = self._jobs[slave_id]
+            if not jobs:
+                self._ready.append(slave_id)
+            jobs.append((slave_id, fn, args, loop, future))
+            self._cond.notify()
+        return await future
+
+    async def run_urgent(self, slave_id: int, fn: Callable, *args):
+        """Như run() nhưng vượt hàng đợi và chạy ở ranh giới frame kế tiếp (lệnh điều khiển)"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._cond:
+            self._urgent.append((slave_id, fn, args, loop, future))
+            self._cond.notify()
+        return await future
+
+    @property
+    def pending(self) -> int:
+        """Số job đang chờ trong hàng đợi"""
+        with self._cond:
+            return sum(len(jobs) for jobs in self._jobs.values()) + len(self._urgent)
+
+    def utilisation(self) -> float:
+        """Tỷ lệ thời gian bus bận trong cửa sổ gần nhất (0..1)"""
+        now = time.monotonic()
+        window = min(UTILISATION_WINDOW, now - self._started_at)
+        if window <= 0:
+            return 0.0
+        busy = sum(d for end, d in list(self._busy) if end >= now - UTILISATION_WINDOW)
+        return min(busy / window, 1.0)
+
+    def get_stats(self) -> Dict:
+        """Thống kê của bus (links: timeout / turnaround / trạng thái circuit breaker từng slave)"""
+        links = {slave_id: link.get_stats() for slave_id, link in sorted(list(self.links.items()))}
+        return {
+            "port": self.port,
+            "baudrate": self.baudrate,
+            "slaves": sorted(self._jobs),
+            "frames": self.frames,
+            "errors": self.errors,
+            "error_kinds": dict(self.error_kinds),
+            "pending": self.pending,
+            "urgent_pending": len(self._urgent),
+            "preemptions": self.preemptions,
+            "utilisation": round(self.utilisation(), 3),
+            "retries": self.retries,
+            "retries_denied": self.retries_denied,
+            "retry_tokens": round(self.budget.tokens, 2),
+            "open_circuits": sum(1 for link in links.values() if link["state"] != CLOSED),
+            "links": links
+        }
+
+    def stop(self):
+        """Dừng thread sau khi xử lý hết các job đang chờ"""
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+
+
+class BusManager:
+    """Quản lý các bus theo cổng - mỗi cổng chỉ một client"""
+
+    def __init__(self, **options):
+        self.buses: Dict[str, BusWorker] = {}
+        self.options = options  # Timeout / retry / circuit breaker cho bus tạo mới (server.yaml -> rtu)
+
+    def get(self, port: str, **serial_params) -> BusWorker:
+        """Lấy (hoặc tạo) bus cho một cổng serial (hoặc "tcp://host:port" cho RTU qua TCP)"""
+        bus = self.buses.get(port)
+        if bus is None:
+            bus = BusWorker(port, **{**self.options, **serial_params})
+            self.buses[port] = bus
+            print(f"[Bus] 🔌 Mở bus {port} @ {bus.baudrate} baud")
+        return bus
+
+    def get_stats(self) -> Dict:
+        """Thống kê tất cả bus"""
+        return {port: bus.get_stats() for port, bus in self.buses.items()}
+
+    def stop_all(self):
+        """Dừng tất cả bus"""
+        for bus in self.buses.values():
+            bus.stop()
+        self.buses.clear()
+
+
+# Singleton instance
+_bus_manager_instance: Optional[BusManager] = None
+
+def get_bus_manager() -> BusManager:
+    """Lấy singleton bus manager"""
+    global _bus_manager_instance
+    if _bus_manager_instance is None:
+        _bus_manager_instance = BusManager()
+    return _bus_manager_instance
+
+def configure_bus_manager(**options) -> BusManager:
+    """Đặt tham số đường truyền (server.yaml -> rtu) cho các bus mở sau đó"""
+    manager = get_bus_manager()
+    manager.options = options
+    return manager
@@ -0,0 +1,154 @@
+"""
+Health - Trạng thái đường truyền tới từng slave trên một bus
+- Thời gian phản hồi của slave (turnaround = thời gian giao dịch - thời gian truyền frame trên dây)
+  theo cửa sổ trượt; timeout của frame = thời gian truyền + timeout_factor × p99 turnaround,
+  trong khoảng [timeout_min, timeout]: slave khỏe không phải chờ timeout cố định 1 s khi lỡ một frame
+- Circuit breaker: breaker_failures frame lỗi liên tiếp -> ngắt (open), frame tới slave trả về ngay
+  không chiếm bus; hết cooldown cho một frame thử (half-open), lỗi tiếp thì gấp đôi cooldown
+- Retry budget của bus (token bucket): mỗi frame nạp retry_budget token, mỗi lần đọc lại tiêu 1 token,
+  inverter offline không thể chiếm thời gian bus của các inverter khỏe bằng retry
+"""
+import time
+from collections import deque
+from typing import Deque, Dict, Optional
+
+CLOSED = "closed"
+HALF_OPEN = "half_open"
+OPEN = "open"
+STATES = (CLOSED, HALF_OPEN, OPEN)  # Giá trị metrics: vị trí trong tuple
+
+MIN_SAMPLES = 20        # Số mẫu turnaround tối thiểu trước khi dùng timeout thích nghi
+REFRESH_EVERY = 16      # Tính lại phân vị sau mỗi ngần này mẫu mới
+
+
+def wire_time(registers: int, baudrate: int) -> float:
+    """Thời gian truyền request + response của một frame đọc/ghi `registers` thanh ghi (giây)
+
+    Request đọc 8 byte + response 5 + 2n byte, FC16 ngược lại (9 + 2n / 8): cùng 13 + 2n byte.
+    """
+    return (13 + 2 * registers) * 11 / baudrate
+
+
+class SlaveLink:
+    """Độ trễ, timeout thích nghi và circuit breaker của một slave"""
+
+    def __init__(self, port: str, slave_id: int, timeout: float = 1.0, timeout_min: float = 0.1,
+                 timeout_factor: float = 3.0, latency_window: int = 200, breaker_failures: int = 3,
+                 breaker_cooldown: float = 30, breaker_max_cooldown: float = 600):
+        self.port = port
+        self.slave_id = slave_id
+        self.timeout = timeout                  # Trần timeout, dùng khi chưa đủ mẫu
+        self.timeout_min = timeout_min
+        self.timeout_factor = timeout_factor
+        self.breaker_failures = breaker_failures
+        self.breaker_cooldown = breaker_cooldown
+        self.breaker_max_cooldown = breaker_max_cooldown
+
+        self.turnaround: Deque[float] = deque(maxlen=latency_window)
+        self._p50: Optional[float] = None
+        self._p99: Optional[float] = None
+        self._pending = 0                       # Mẫu mới từ lần tính phân vị trước
+
+        self.state = CLOSED
+        self.cooldown = breaker_cooldown
+        self.opened_at = 0.0
+        self.consecutive_failures = 0
+
+        # Thống kê
+        self.frames = 0
+        self.failures = 0
+        self.trips = 0                          # Số lần breaker ngắt
+        self.short_circuited = 0                # Frame trả về ngay do breaker đang ngắt
+        self.last_timeout = timeout
+
+    def _percentiles(self):
+        if self._pending >= REFRESH_EVERY or self._p99 is None:
+            ordered = sorted(self.turnaround)
+            self._p50 = ordered[len(ordered) // 2]
+            self._p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+            self._pending = 0
+
+    def timeout_for(self, wire: float) -> float:
+        """Timeout cho frame có thời gian truyền `wire`"""
+        if self.state != CLOSED or len(self.turnaround) < MIN_SAMPLES:
+            timeout = self.timeout  # Frame thử / chưa biết slave: chờ đủ
+        else:
+            self._percentiles()
+            timeout = min(self.timeout, max(self.timeout_min, wire + self.timeout_factor * self._p99))
+        self.last_timeout = timeout
+        return timeout
+
+    def allow(self, now: float, probe: bool = False) -> bool:
+        """Frame có được gửi không (breaker đóng, hoặc hết cooldown: một frame thử);
+        probe: gửi frame thử ngay cả khi còn cooldown (lệnh điều khiển không chờ breaker)"""
+        if self.state == OPEN:
+            if now - self.opened_at < self.cooldown and not probe:
+                self.short_circuited += 1
+                return False
+            self.state = HALF_OPEN
+        return True
+
+    def success(self, duration: float, wire: float):
+        """Slave đã trả lời (kể cả exception response)"""
+        self.frames += 1
+        self.turnaround.append(max(0.0, duration - wire))
+        self._pending += 1
+        self.consecutive_failures = 0
+        if self.state != CLOSED:
+            print(f"[Bus] ✅ {self.port} slave {self.slave_id} trả lời lại, đóng circuit breaker")
+            self.state = CLOSED
+            self.cooldown = self.breaker_cooldown
+
+    def failure(self, now: float):
+        """Frame lỗi đường truyền (timeout, CRC, mất kết nối)"""
+        self.frames += 1
+        self.failures += 1
+        self.consecutive_failures += 1
+        if self.state == HALF_OPEN:
+            self.cooldown = min(self.cooldown * 2, self.breaker_max_cooldown)
+            self._trip(now)
+        elif self.state == CLOSED and self.consecutive_failures >= self.breaker_failures:
+            self._trip(now)
+
+    def _trip(self, now: float):
+        self.state = OPEN
+        self.opened_at = now
+        self.trips += 1
+        print(f"[Bus] 🔌 {self.port} slave {self.slave_id}: {self.consecutive_failures} frame lỗi liên tiếp, "
+              f"ngắt circuit breaker {self.cooldown:.0f} s")
+
+    def get_stats(self) -> Dict:
+        stats = {
+            "state": self.state,
+            "timeout": round(self.last_timeout, 3),
+            "frames": self.frames,
+            "failures": self.failures,
+            "consecutive_failures": self.consecutive_failures,
+            "trips": self.trips,
+            "short_circuited": self.short_circuited,
+        }
+        if self.turnaround:
+            self._percentiles()
+            stats["turnaround_p50_ms"] = round(self._p50 * 1000, 1)
+            stats["turnaround_p99_ms"] = round(self._p99 * 1000, 1)
+        if self.state == OPEN:
+            stats["retry_in"] = round(max(0.0, self.opened_at + self.cooldown - time.monotonic()), 1)
+        return stats
+
+
+class RetryBudget:
+    """Token bucket retry của một bus: mỗi frame nạp `ratio` token, mỗi retry tiêu 1 token"""
+
+    def __init__(self, ratio: float = 0.1, burst: float = 10):
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = burst
+
+    def earn(self):
+        self.tokens = min(self.burst, self.tokens + self.ratio)
+
+    def spend(self) -> bool:
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
@@ -0,0 +1,84 @@
+"""
+Read planner - Gộp các block thanh ghi để giảm số frame Modbus mỗi chu kỳ
+- Gộp các block gần nhau (khoảng trống <= max_gap) thành một frame
+- Mỗi frame không vượt quá 125 thanh ghi (giới hạn của FC 03/04)
+- Đọc xong thì cắt lại giá trị cho từng block ban đầu
+"""
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+MAX_REGISTERS = 125   # Số thanh ghi tối đa trong một frame đọc
+DEFAULT_MAX_GAP = 20  # Số thanh ghi thừa chấp nhận đọc để gộp 2 block
+
+Block = Tuple[int, int]  # (địa chỉ bắt đầu, số thanh ghi)
+
+
+@dataclass
+class ReadFrame:
+    """Một frame đọc thực tế trên bus"""
+    start: int
+    count: int
+    blocks: List[Block] = field(default_factory=list)
+
+    @property
+    def end(self) -> int:
+        return self.start + self.count
+
+
+def plan_reads(blocks: Iterable[Block], max_gap: int = DEFAULT_MAX_GAP,
+               max_count: int = MAX_REGISTERS) -> List[ReadFrame]:
+    """Gộp các block thành ít frame nhất có thể"""
+    frames: List[ReadFrame] = []
+    for start, count in sorted(set(blocks)):
+        if count > max_count:
+            raise ValueError(f"Block {start}+{count} vượt quá {max_count} thanh ghi")
+
+        current = frames[-1] if frames else None
+        if current is not None:
+            new_end = max(current.end, start + count)
+            if start - current.end <= max_gap and new_end - current.start <= max_count:
+                current.count = new_end - current.start
+                current.blocks.append((start, count))
+                continue
+
+        frames.append(ReadFrame(start, count, [(start, count)]))
+    return frames
+
+
+class ReadPlan:
+    """Kế hoạch đọc cố định cho một tập block (tạo một lần, dùng mỗi chu kỳ)"""
+
+    def __init__(self, blocks: Iterable[Block], max_gap: int = DEFAULT_MAX_GAP,
+                 max_count: int = MAX_REGISTERS):
+        self.blocks = sorted(set(blocks))
+        self.frames = plan_reads(self.blocks, max_gap, max_count)
+
+    @property
+    def frames_before(self) -> int:
+        """Số frame nếu đọc từng block riêng lẻ"""
+        return len(self.blocks)
+
+    @property
+    def frames_after(self) -> int:
+        """Số frame sau khi gộp"""
+        return len(self.frames)
+
+    def execute(self, read_block: Callable[[int, int], Optional[List[int]]]) -> Dict[Block, Optional[List[int]]]:
+        """
+        Đọc tất cả frame bằng read_block(start, count) rồi cắt kết quả theo block.
+        Block thuộc frame đọc lỗi sẽ có giá trị None.
+        """
+        result: Dict[Block, Optional[List[int]]] = {}
+        for frame in self.frames:
+            regs = read_block(frame.start, frame.count)
+            for start, count in frame.blocks:
+                if regs is None:
+                    result[(start, count)] = None
+                else:
+                    offset = start - frame.start
+                    result[(start, count)] = regs[offset:offset + count]
+        return result
+
+    def __repr__(self) -> str:
+        frames = ", ".join(f"{f.start}+{f.count}" for f in self.frames)
+        return f"ReadPlan({self.frames_before} → {self.frames_after} frames: {frames})"
@@ -0,0 +1,240 @@
+"""
+Modbus TCP server - Phục vụ SCADA từ register image trong bộ nhớ
+- Trả lời hoàn toàn từ image, không bao giờ tạo thêm traffic RS-485
+- Image mỗi unit là bytearray big-endian cấp phát sẵn, double-buffer:
+  collector ghi vào buffer sau rồi đổi con trỏ sau mỗi lần poll
+- Request chỉ cắt memoryview của buffer hiện tại, không dựng dict/object
+- Hỗ trợ FC 03/04, nhiều client đồng thời, thống kê độ trễ mỗi request
+- Snapshot nhà máy có unit riêng, cùng bố cục thanh ghi (trường plant.* chỉ có ở unit nhà máy)
+"""
+import asyncio
+import math
+import struct
+import time
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+from storage.cache import Sample
+
+MBAP = struct.Struct(">HHHB")       # transaction id, protocol id, length, unit id
+READ_REQUEST = struct.Struct(">BHH")  # function code, address, quantity
+MAX_READ = 125
+
+# Mã exception Modbus
+ILLEGAL_FUNCTION = 0x01
+ILLEGAL_ADDRESS = 0x02
+ILLEGAL_VALUE = 0x03
+GATEWAY_TARGET_FAILED = 0x0B
+
+# Kiểu dữ liệu trong image -> (số thanh ghi, struct, giá trị khi None)
+TYPES = {
+    "u16": (1, struct.Struct(">H"), 0xFFFF),
+    "s16": (1, struct.Struct(">h"), 0x7FFF),
+    "u32": (2, struct.Struct(">I"), 0xFFFFFFFF),
+    "s32": (2, struct.Struct(">i"), 0x7FFFFFFF),
+    "float32": (2, struct.Struct(">f"), math.nan),
+}
+
+# Nguồn dữ liệu mặc định cho các tên trong server.yaml -> register_map
+DEFAULT_SOURCES = {
+    "voltage": ("ac.voltage_ab", "float32"),
+    "current": ("ac.current_a", "float32"),
+    "power": ("ac.power", "float32"),
+    "reactive_power": ("ac.reactive_power", "float32"),
+    "frequency": ("ac.frequency", "float32"),
+    "energy_dayly": ("energy.energy_day_kwh", "float32"),
+    "energy_monthly": ("energy.energy_month_kwh", "float32"),
+    "energy_total": ("energy.energy_total_kwh", "float32"),
+    "work_state": ("error.work_state", "u16"),
+    "error_code": ("error.fault_code", "u16"),
+    "availability": ("plant.availability", "float32"),
+    "performance_ratio": ("plant.performance_ratio", "float32"),
+    "inverters_reporting": ("plant.reporting", "u16"),
+    "inverters_missing": ("plant.missing", "u16"),
+}
+
+
+class ImageField:
+    """Một trường trong image: lấy từ sample theo nguồn "nhóm.trường", ghi vào địa chỉ cố định"""
+
+    def __init__(self, name: str, address: int, source: str, type_: str):
+        self.name = name
+        self.address = address
+        self.group, _, self.key = source.partition(".")
+        self.width, self.packer, self.missing = TYPES[type_]
+        self.offset = address * 2
+
+    def extract(self, sample: Sample):
+        return sample.value(self.group, self.key)
+
+
+def build_fields(register_map: Dict[str, Any]) -> List[ImageField]:
+    """Dựng danh sách trường từ register_map (dạng `name: address` hoặc `name: {address, source, type}`)"""
+    fields = []
+    for name, entry in register_map.items():
+        if isinstance(entry, dict):
+            address = entry["address"]
+            default_source, default_type = DEFAULT_SOURCES.get(name, (None, "float32"))
+            source = entry.get("source", default_source)
+            type_ = entry.get("type", default_type)
+        else:
+            address = entry
+            source, type_ = DEFAULT_SOURCES.get(name, (None, None))
+        if source is None:
+            print(f"[ModbusTCP] ⚠️ Bỏ qua '{name}': chưa có nguồn dữ liệu (khai báo source trong register_map)")
+            continue
+        fields.append(ImageField(name, address, source, type_))
+    return fields
+
+
+class RegisterImage:
+    """Image thanh ghi double-buffer cho từng unit"""
+
+    def __init__(self, fields: List[ImageField], units: List[int]):
+        self.fields = fields
+        self.size = max((f.address + f.width for f in fields), default=0)  # Số thanh ghi
+        self._front: Dict[int, bytearray] = {}
+        self._back: Dict[int, bytearray] = {}
+        for unit in units:
+            self.add_unit(unit)
+        self.updated_at: Dict[int, float] = {}
+
+    def add_unit(self, unit: int):
+        """Cấp phát image cho một unit; giá trị ban đầu là 'không có dữ liệu'"""
+        if unit in self._front:
+            return
+        buffer = bytearray(self.size * 2)
+        for f in self.fields:
+            f.packer.pack_into(buffer, f.offset, f.missing)
+        self._front[unit] = buffer
+        self._back[unit] = bytearray(buffer)
+
+    def update(self, unit: int, sample: Sample):
+        """Ghi các trường có trong sample vào buffer sau rồi đổi buffer (atomic với reader)"""
+        if unit not in self._front:
+            self.add_unit(unit)
+        front, back = self._front[unit], self._back[unit]
+        back[:] = front  # Giữ giá trị của nhóm không có trong sample này (vd energy)
+        for f in self.fields:
+            if f.group not in sample:
+                continue
+            value = f.extract(sample)
+            try:
+                f.packer.pack_into(back, f.offset, f.missing if value is None else value)
+            except struct.error:
+                f.packer.pack_into(back, f.offset, f.missing)  # Giá trị ngoài phạm vi kiểu
+        self._front[unit], self._back[unit] = back, front
+        self.updated_at[unit] = time.time()
+
+    def read(self, unit: int, address: int, count: int) -> Optional[memoryview]:
+        """Slice big-endian của buffer hiện tại, None nếu unit không tồn tại"""
+        buffer = self._front.get(unit)
+        if buffer is None:
+            return None
+        return memoryview(buffer)[address * 2:(address + count) * 2]
+
+
+class ModbusTcpServer:
+    """Modbus TCP server asyncio đọc từ RegisterImage"""
+
+    def __init__(self, image: RegisterImage, host: str = "0.0.0.0", port: int = 5020,
+                 default_unit: Optional[int] = None, latency_window: int = 10000,
+                 plant_units: Optional[Dict[int, int]] = None):
+        self.image = image
+        self.plant_units = plant_units or {}  # project id -> unit id
+        for unit in self.plant_units.values():
+            image.add_unit(unit)
+        self.host = host
+        self.port = port
+        self.default_unit = default_unit  # Unit dùng khi client gửi 0 hoặc 255
+        self._server: Optional[asyncio.AbstractServer] = None
+
+        # Thống kê
+        self.clients = 0
+        self.requests = 0
+        self.exceptions = 0
+        self._latencies: deque = deque(maxlen=latency_window)  # micro giây
+
+    def _exception(self, tid: int, unit: int, fc: int, code: int) -> bytes:
+        self.exceptions += 1
+        return MBAP.pack(tid, 0, 3, unit) + bytes((fc | 0x80, code))
+
+    def handle_request(self, tid: int, unit: int, pdu: bytes) -> bytes:
+        """Xử lý một PDU, trả về frame phản hồi đầy đủ (MBAP + PDU)"""
+        fc = pdu[0]
+        if fc not in (3, 4):
+            return self._exception(tid, unit, fc, ILLEGAL_FUNCTION)
+        if len(pdu) != 5:
+            return self._exception(tid, unit, fc, ILLEGAL_VALUE)
+
+        _, address, count = READ_REQUEST.unpack(pdu)
+        if not 1 <= count <= MAX_READ:
+            return self._exception(tid, unit, fc, ILLEGAL_VALUE)
+        if address + count > self.image.size:
+            return self._exception(tid, unit, fc, ILLEGAL_ADDRESS)
+
+        target = self.default_unit if unit in (0, 255) and self.default_unit is not None else unit
+        data = self.image.read(target, address, count)
+        if data is None:
+            return self._exception(tid, unit, fc, GATEWAY_TARGET_FAILED)
+
+        return MBAP.pack(tid, 0, 3 + count * 2, unit) + bytes((fc, count * 2)) + data
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.clients += 1
+        try:
+            while True:
+                header = await reader.readexactly(MBAP.size)
+                tid, protocol, length, unit = MBAP.unpack(header)
+                if protocol != 0 or not 2 <= length <= 254:
+                    break  # Frame không hợp lệ: đóng kết nối
+                pdu = await reader.readexactly(length - 1)
+
+                start = time.perf_counter_ns()
+                writer.write(self.handle_request(tid, unit, pdu))
+                self._latencies.append((time.perf_counter_ns() - start) / 1000)
+                self.requests += 1
+
+                if writer.transport.get_write_buffer_size() > 65536:
+                    await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.clients -= 1
+            writer.close()
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_client, self.host, self.port)
+        print(f"[ModbusTCP] 🚀 Listening on {self.host}:{self.port} ({self.image.size} thanh ghi/unit)")
+
+    async def serve_forever(self):
+        if self._server is None:
+            await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def on_sample(self, inverter_id: int, ts: float, sample: Sample):
+        """Callback cho collector: cập nhật image sau mỗi lần poll"""
+        self.image.update(inverter_id, sample)
+
+    async def on_plant(self, snapshot):
+        """Callback cho PlantAggregator: snapshot có cùng giao diện value() với Sample"""
+        unit = self.plant_units.get(snapshot.project_id)
+        if unit is not None:
+            self.image.update(unit, snapshot)
+
+    def get_stats(self) -> Dict:
+        """Thống kê server và độ trễ xử lý request (µs)"""
+        latencies = sorted(self._latencies)
+        stats = {
+            "clients": self.clients,
+            "requests": self.requests,
+            "exceptions": self.exceptions,
+        }
+        if latencies:
+            stats.update({
+                "latency_p50_us": round(latencies[len(latencies) // 2], 1),
+                "latency_p99_us": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))], 1),
+                "latency_max_us": round(latencies[-1], 1),
+            })
+        return stats
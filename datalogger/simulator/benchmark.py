@@ -0,0 +1,315 @@
+"""
+Benchmark end-to-end - Collector thật chạy với fleet giả lập, tăng dần số inverter
+- Fleet giả lập và collector chạy ở 2 process riêng: CPU/bộ nhớ đo được chỉ là của collector
+- Mỗi cỡ fleet: thời gian một lần poll realtime, chu kỳ thực tế, frames/s, lỗi,
+  độ trễ event loop, CPU và bộ nhớ trên mỗi inverter
+- Tùy chọn gửi lệnh giới hạn công suất định kỳ tới cả fleet để đo độ trễ command-to-ack
+- So sánh với kết quả lần trước để phát hiện regression:
+  python -m simulator.benchmark --sizes 4 16 64 200 --save bench.json
+  python -m simulator.benchmark --sizes 4 16 64 200 --compare bench.json
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+from simulator.fleet import add_fleet_arguments, fleet_from_args
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+DEFAULT_SIZES = [4, 8, 16, 32, 64, 100, 200]
+
+# Metric dùng để so sánh: tên -> True nếu giá trị càng cao càng tốt
+COMPARED_METRICS = {
+    "poll_p99_ms": False,
+    "period_p99_s": False,
+    "frames_per_s": True,
+    "completeness": True,
+    "loop_lag_p99_ms": False,
+    "command_ack_p99_ms": False,
+    "cpu_pct_per_inverter": False,
+    "rss_kb_per_inverter": False,
+}
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def rss_kb() -> Optional[float]:
+    """RSS hiện tại của process (KB)"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024
+    except (OSError, ValueError, AttributeError):
+        pass
+    if resource is not None:
+        return float(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)  # Peak, đơn vị KB trên Linux
+    return None
+
+
+# ----------------------------------------------------------------------
+# Process fleet giả lập
+# ----------------------------------------------------------------------
+def _simulator_process(inverters: int, args: argparse.Namespace, conn):
+    async def main():
+        fleet = fleet_from_args(inverters, args)
+        if args.transport == "pty":
+            fleet.start_pty()
+        else:
+            await fleet.start_tcp()
+        conn.send(fleet.inverter_configs())
+        while not conn.poll():
+            await asyncio.sleep(0.2)
+        conn.recv()
+        conn.send(fleet.get_stats())
+        fleet.stop()
+
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        asyncio.run(main())
+
+
+# ----------------------------------------------------------------------
+# Process collector
+# ----------------------------------------------------------------------
+async def _measure(configs: List[Dict[str, Any]], interval: float, warmup: float, duration: float,
+                   command_interval: float = 0) -> Dict:
+    from control.modbus_writer import PRIORITY_GRID, STATUS_OK, ModbusWriter
+    from engine import collector
+    from engine.policy import configure_policy
+    from engine.scheduler import get_scheduler
+    from modbus.bus import get_bus_manager
+
+    configure_policy(realtime_interval=interval)
+    measuring = False
+    polls: List[float] = []
+    periods: List[float] = []
+    lags: List[float] = []
+    last_sample: Dict[int, float] = {}
+    samples = 0
+
+    # Đo thời gian mỗi lần poll realtime (từ lúc task chạy đến khi có mẫu)
+    poll_realtime = collector.poll_realtime
+
+    async def timed_poll(bus, driver, inverter_id):
+        start = time.perf_counter()
+        try:
+            return await poll_realtime(bus, driver, inverter_id)
+        finally:
+            if measuring:
+                polls.append(time.perf_counter() - start)
+
+    collector.poll_realtime = timed_poll
+
+    async def on_sample(inverter_id: int, ts: float, data: Dict[str, Any]):
+        nonlocal samples
+        if "ac" not in data:
+            return  # Mẫu chỉ có sản lượng
+        now = time.monotonic()
+        if measuring:
+            samples += 1
+            if inverter_id in last_sample:
+                periods.append(now - last_sample[inverter_id])
+        last_sample[inverter_id] = now
+
+    collector.set_sample_callback(on_sample)
+
+    # Độ trễ event loop: sleep ngắn và đo phần vượt quá
+    async def lag_probe(step: float = 0.05):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(step)
+            if measuring:
+                lags.append(time.perf_counter() - start - step)
+
+    # Lệnh điều khiển chen vào giữa chu kỳ đọc: fan-out tới mọi inverter
+    writer = ModbusWriter()
+    acks: List[float] = []
+
+    async def command_load():
+        value = 100
+        while True:
+            await asyncio.sleep(command_interval)
+            value = 90 if value == 100 else 100
+            results = await writer.submit_many([c["id"] for c in configs], "power_limit", value, PRIORITY_GRID)
+            if measuring:
+                acks.extend(r.latency for r in results if r.status == STATUS_OK)
+
+    rss_before = rss_kb()
+    probe = asyncio.create_task(lag_probe())
+    commands = asyncio.create_task(command_load()) if command_interval else None
+    polling = asyncio.create_task(collector.start_all_polling(configs, interval, 900))
+    await asyncio.sleep(warmup)
+
+    buses = get_bus_manager().buses.values()
+    frames_before = sum(bus.frames for bus in buses)
+    errors_before = sum(bus.errors for bus in buses)
+    cpu_before = time.process_time()
+    started = time.perf_counter()
+    measuring = True
+    await asyncio.sleep(duration)
+    measuring = False
+    elapsed = time.perf_counter() - started
+    cpu = time.process_time() - cpu_before
+    frames = sum(bus.frames for bus in buses) - frames_before
+    errors = sum(bus.errors for bus in buses) - errors_before
+    rss_after = rss_kb()
+    utilisation = [bus.utilisation() for bus in buses]
+    lateness = max((t.max_lateness for tasks in get_scheduler().tasks.values() for t in tasks.values()),
+                   default=0.0)
+
+    get_scheduler().stop()
+    background = [probe, polling] + ([commands] if commands else [])
+    for task in background:
+        task.cancel()
+    await asyncio.gather(*background, return_exceptions=True)
+    get_bus_manager().stop_all()
+
+    n = len(configs)
+    expected = n * elapsed / interval
+
+    def ms(value):
+        return round(value * 1000, 1) if value is not None else None
+
+    return {
+        "inverters": n,
+        "buses": len(utilisation),
+        "poll_p50_ms": ms(percentile(polls, 50)),
+        "poll_p99_ms": ms(percentile(polls, 99)),
+        "period_p50_s": round(percentile(periods, 50) or 0, 3),
+        "period_p99_s": round(percentile(periods, 99) or 0, 3),
+        "frames_per_s": round(frames / elapsed, 1),
+        "frame_errors": errors,
+        "completeness": round(min(samples / expected, 1.0), 3) if expected else None,
+        "bus_utilisation_max": round(max(utilisation, default=0), 3),
+        "lateness_max_s": round(lateness, 3),
+        "loop_lag_p50_ms": ms(percentile(lags, 50)),
+        "loop_lag_p99_ms": ms(percentile(lags, 99)),
+        "loop_lag_max_ms": ms(max(lags, default=None)),
+        "command_ack_p50_ms": ms(percentile(acks, 50)),
+        "command_ack_p99_ms": ms(percentile(acks, 99)),
+        "cpu_pct": round(cpu / elapsed * 100, 2),
+        "cpu_pct_per_inverter": round(cpu / elapsed * 100 / n, 4),
+        "rss_mb": round(rss_after / 1024, 1) if rss_after else None,
+        "rss_kb_per_inverter": round((rss_after - rss_before) / n, 1) if rss_after and rss_before else None,
+    }
+
+
+def _collector_process(configs: List[Dict[str, Any]], args: argparse.Namespace, conn):
+    # Collector in từng payload ra console: bỏ output để không làm nhiễu bảng kết quả
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        result = asyncio.run(_measure(configs, args.interval, args.warmup, args.duration, args.command_interval))
+    conn.send(result)
+
+
+def run_size(inverters: int, args: argparse.Namespace) -> Dict:
+    """Chạy benchmark cho một cỡ fleet"""
+    sim_conn, sim_child = multiprocessing.Pipe()
+    simulator = multiprocessing.Process(target=_simulator_process, args=(inverters, args, sim_child), daemon=True)
+    simulator.start()
+    try:
+        configs = sim_conn.recv()
+        col_conn, col_child = multiprocessing.Pipe()
+        collector = multiprocessing.Process(
+            target=_collector_process, args=(configs, args, col_child))
+        collector.start()
+        result = col_conn.recv()
+        collector.join()
+
+        sim_conn.send("stop")
+        fleet = sim_conn.recv()
+        result["injected_timeouts"] = sum(bus["timeouts"] for bus in fleet.values())
+        result["injected_crc_errors"] = sum(bus["crc_errors"] for bus in fleet.values())
+        result["injected_faults"] = sum(bus["faults"] for bus in fleet.values())
+        return result
+    finally:
+        simulator.join(timeout=5)
+        if simulator.is_alive():
+            simulator.terminate()
+
+
+def print_table(results: List[Dict]):
+    columns = [
+        ("inverters", "inv"), ("buses", "bus"), ("poll_p50_ms", "poll p50"), ("poll_p99_ms", "poll p99"),
+        ("period_p99_s", "period p99"), ("frames_per_s", "frames/s"), ("frame_errors", "errors"),
+        ("completeness", "complete"), ("bus_utilisation_max", "bus util"), ("loop_lag_p99_ms", "lag p99"),
+        ("loop_lag_max_ms", "lag max"), ("command_ack_p99_ms", "cmd p99"), ("cpu_pct", "cpu %"), ("cpu_pct_per_inverter", "cpu %/inv"),
+        ("rss_mb", "rss MB"), ("rss_kb_per_inverter", "KB/inv"),
+    ]
+    widths = [max(len(title), 9) for _, title in columns]
+    print("  ".join(title.rjust(w) for (_, title), w in zip(columns, widths)))
+    for result in results:
+        print("  ".join(str(result.get(key)).rjust(w) for (key, _), w in zip(columns, widths)))
+
+
+def compare(results: List[Dict], baseline: List[Dict], tolerance: float) -> List[str]:
+    """Các metric xấu hơn baseline quá tolerance (tỷ lệ)"""
+    previous = {r["inverters"]: r for r in baseline}
+    regressions = []
+    for result in results:
+        old = previous.get(result["inverters"])
+        if old is None:
+            continue
+        for key, higher_is_better in COMPARED_METRICS.items():
+            new_value, old_value = result.get(key), old.get(key)
+            if not new_value or not old_value:
+                continue
+            change = (new_value - old_value) / abs(old_value)
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append(f"{result['inverters']} inverter: {key} {old_value} → {new_value} "
+                                   f"({change:+.0%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark collector với fleet inverter giả lập")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="Các cỡ fleet cần đo")
+    parser.add_argument("--interval", type=float, default=5, help="Chu kỳ realtime (giây)")
+    parser.add_argument("--warmup", type=float, default=8, help="Thời gian khởi động trước khi đo (giây)")
+    parser.add_argument("--duration", type=float, default=30, help="Thời gian đo mỗi cỡ fleet (giây)")
+    parser.add_argument("--command-interval", type=float, default=0,
+                        help="Chu kỳ gửi lệnh power_limit tới cả fleet (giây, 0 = tắt)")
+    parser.add_argument("--save", help="Lưu kết quả ra file JSON")
+    parser.add_argument("--compare", help="File JSON kết quả lần trước để so sánh")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Mức xấu đi cho phép khi so sánh")
+    add_fleet_arguments(parser)
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes:
+        print(f"[Benchmark] ⏱️ {size} inverter ({args.transport}, {args.baudrate} baud, "
+              f"{args.per_bus}/bus) ...", flush=True)
+        results.append(run_size(size, args))
+    print()
+    print_table(results)
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump({"options": vars(args), "results": results}, f, indent=2)
+        print(f"\n[Benchmark] 💾 Đã lưu {args.save}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("\n[Benchmark] ❌ Regression so với baseline:")
+            for line in regressions:
+                print(f"  - {line}")
+            sys.exit(1)
+        print("\n[Benchmark] ✅ Không có regression so với baseline")
+
+
+if __name__ == "__main__":
+    main()
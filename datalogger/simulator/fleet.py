@@ -0,0 +1,123 @@
+"""
+Fleet giả lập - Nhiều bus RS-485, mỗi bus nhiều inverter giả lập
+- Sinh sẵn danh sách config inverter dùng trực tiếp cho collector
+- Chạy độc lập: python -m simulator.fleet --inverters 16 --per-bus 8
+"""
+import argparse
+import asyncio
+import itertools
+import json
+from typing import Any, Dict, List, Optional
+
+from simulator.inverter import MODELS, SimulatedInverter
+from simulator.rtu import RtuSlaveServer
+
+
+class SimulatedFleet:
+    """Tập hợp các bus giả lập, inverter id đánh số liên tục từ 1"""
+
+    def __init__(self, inverters: int, per_bus: int = 8, models: Optional[List[str]] = None,
+                 baudrate: int = 9600, turnaround: float = 0.01, timeout_rate: float = 0.0,
+                 crc_error_rate: float = 0.0, fault_rate: float = 0.0, fault_duration: float = 60,
+                 seed: int = 0):
+        self.baudrate = baudrate
+        self.buses: List[RtuSlaveServer] = []
+        self.members: List[Dict[str, Any]] = []  # (bus, inverter id, slave) theo thứ tự id
+        model_cycle = itertools.cycle(models or ["SG110CX", "SG110CX", "SG110CX", "SG50CX"])
+
+        for bus_index in range(0, inverters, per_bus):
+            slaves = []
+            for slave_id in range(1, min(per_bus, inverters - bus_index) + 1):
+                inverter = SimulatedInverter(slave_id, next(model_cycle), fault_rate=fault_rate,
+                                             fault_duration=fault_duration, seed=seed + bus_index + slave_id)
+                slaves.append(inverter)
+                self.members.append({"id": bus_index + slave_id, "bus": len(self.buses), "inverter": inverter})
+            self.buses.append(RtuSlaveServer(slaves, baudrate, turnaround, timeout_rate, crc_error_rate,
+                                             seed=seed + bus_index))
+
+    async def start_tcp(self, host: str = "127.0.0.1", base_port: int = 0):
+        """Mở mỗi bus một port TCP (base_port=0: port ngẫu nhiên)"""
+        for index, bus in enumerate(self.buses):
+            await bus.start_tcp(host, base_port + index if base_port else 0)
+
+    def start_pty(self):
+        """Mở mỗi bus một cặp pty"""
+        for bus in self.buses:
+            bus.start_pty()
+
+    def stop(self):
+        for bus in self.buses:
+            bus.stop()
+
+    def inverter_configs(self) -> List[Dict[str, Any]]:
+        """Config inverter cho collector (cùng dạng build_inverter_configs trong main.py)"""
+        configs = []
+        for member in self.members:
+            inverter: SimulatedInverter = member["inverter"]
+            configs.append({
+                "id": member["id"],
+                "port": self.buses[member["bus"]].port,
+                "slave_id": inverter.slave_id,
+                "baudrate": self.baudrate,
+                "mppt_count": MODELS[inverter.model]["mppt_count"],
+                "string_count": MODELS[inverter.model]["string_count"],
+            })
+        return configs
+
+    def get_stats(self) -> Dict:
+        """Thống kê từng bus giả lập"""
+        return {bus.port: bus.get_stats() for bus in self.buses}
+
+
+def add_fleet_arguments(parser: argparse.ArgumentParser):
+    """Tham số dòng lệnh chung cho fleet và benchmark"""
+    parser.add_argument("--per-bus", type=int, default=8, help="Số inverter trên mỗi bus")
+    parser.add_argument("--transport", choices=("tcp", "pty"), default="tcp")
+    parser.add_argument("--baudrate", type=int, default=9600)
+    parser.add_argument("--turnaround", type=float, default=0.01, help="Thời gian xử lý của slave (giây)")
+    parser.add_argument("--timeout-rate", type=float, default=0.0, help="Tỷ lệ request không trả lời")
+    parser.add_argument("--crc-error-rate", type=float, default=0.0, help="Tỷ lệ response sai CRC")
+    parser.add_argument("--fault-rate", type=float, default=0.0, help="Xác suất fault mỗi lần làm mới giá trị")
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def fleet_from_args(inverters: int, args: argparse.Namespace) -> SimulatedFleet:
+    return SimulatedFleet(inverters, per_bus=args.per_bus, baudrate=args.baudrate,
+                          turnaround=args.turnaround, timeout_rate=args.timeout_rate,
+                          crc_error_rate=args.crc_error_rate, fault_rate=args.fault_rate, seed=args.seed)
+
+
+async def serve(fleet: SimulatedFleet, transport: str = "tcp", host: str = "127.0.0.1", base_port: int = 0,
+                stats_interval: float = 60):
+    """Chạy fleet đến khi bị dừng, in thống kê định kỳ"""
+    if transport == "pty":
+        fleet.start_pty()
+    else:
+        await fleet.start_tcp(host, base_port)
+    print(f"[Simulator] 🚀 {len(fleet.members)} inverter trên {len(fleet.buses)} bus")
+    print(json.dumps(fleet.inverter_configs(), indent=2))
+    try:
+        while True:
+            await asyncio.sleep(stats_interval)
+            for port, stats in fleet.get_stats().items():
+                print(f"[Simulator] 📊 {port}: {stats}")
+    finally:
+        fleet.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Giả lập inverter Sungrow qua Modbus RTU")
+    parser.add_argument("--inverters", type=int, default=4)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--base-port", type=int, default=15020, help="Port TCP của bus đầu tiên")
+    add_fleet_arguments(parser)
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(fleet_from_args(args.inverters, args), args.transport, args.host, args.base_port))
+    except KeyboardInterrupt:
+        print("\n[Simulator] 🛑 Đã dừng")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+"""
+Inverter giả lập - Slave Sungrow SG110CX/SG50CX không cần phần cứng
+- Giá trị được encode ngược qua chính register map mà driver dùng để đọc,
+  nên địa chỉ/kiểu/scale/word order luôn khớp với SungrowDriver
+- Công suất thay đổi chậm theo thời gian, sản lượng tích lũy theo công suất
+- Có thể chủ động gây fault (fault_code + work_state) để thử polling policy
+- Holding register điều khiển (giới hạn công suất, chạy/dừng) được áp dụng vào giá trị phát
+"""
+import math
+import random
+import struct
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from engine.mapper import TYPES, WORDORDER, CompiledMap, get_register_map
+
+# Model -> tham số register map và công suất định mức (W)
+MODELS = {
+    "SG110CX": {"mppt_count": 9, "string_count": 18, "rated_power": 110000},
+    "SG50CX": {"mppt_count": 5, "string_count": 10, "rated_power": 50000},
+}
+
+WORK_STATE_RUN = 0x0000
+WORK_STATE_FAULT = 0x5500
+WORK_STATE_STOP = 0x8000
+
+# Giá trị ban đầu của các điểm điều khiển
+DEFAULT_SETPOINTS = {"start_stop": 0xCF, "power_limit_switch": 0x55, "power_limit": 100}
+
+_warned_overlaps = set()  # (map, model) đã cảnh báo chồng lấn
+
+
+def encode_sample(cmap: CompiledMap, data: Dict[str, Any]) -> Dict[int, int]:
+    """
+    Encode một mẫu (cùng cấu trúc driver trả về) thành thanh ghi theo địa chỉ PDU.
+    Nhóm lặp (MPPT/string) được ghi trước: nếu map khai báo chồng lấn thì trường
+    record (ac, error...) được giữ, giống một thanh ghi thật chỉ có một giá trị.
+    """
+    registers: Dict[int, int] = {}
+    for f in sorted(cmap.fields, key=lambda f: f.index is None):
+        value: Any = data.get(f.group)
+        if f.index is not None:
+            value = value[f.index] if value else None
+        for key in f.path:
+            value = value.get(key) if isinstance(value, dict) else None
+
+        width, code, _ = TYPES[f.type]
+        if value is None:
+            raw = f.sentinel
+        else:
+            raw = round(value / f.scale)
+            if code.islower():  # Kiểu có dấu: đưa về phạm vi trước khi pack
+                limit = 1 << (width * 16 - 1)
+                raw = max(-limit, min(limit - 1, raw))
+            else:
+                raw = max(0, min((1 << (width * 16)) - 1, raw))
+        endian = WORDORDER[f.wordorder]
+        words = struct.unpack(f"{endian}{width}H", struct.pack(f"{endian}{code}", raw))
+        for i, word in enumerate(words):
+            registers[f.address + cmap.address_offset + i] = word
+    return registers
+
+
+def overlapping_fields(cmap: CompiledMap) -> List[str]:
+    """Các cặp trường dùng chung thanh ghi (register map khai báo chồng lấn)"""
+    owners: Dict[int, str] = {}
+    overlaps = []
+    for f in cmap.fields:
+        name = ".".join((f.group,) + ((str(f.index + 1),) if f.index is not None else ()) + f.path)
+        for address in range(f.address, f.address + f.width):
+            if address in owners:
+                overlaps.append(f"{name} @{address} trùng {owners[address]}")
+            owners[address] = name
+    return overlaps
+
+
+class SimulatedInverter:
+    """Một slave giả lập: sinh giá trị theo thời gian và trả về thanh ghi"""
+
+    def __init__(self, slave_id: int, model: str = "SG110CX", map_name: str = "sungrow_sg",
+                 fault_rate: float = 0.0, fault_duration: float = 60, refresh: float = 1.0,
+                 seed: Optional[int] = None):
+        self.slave_id = slave_id
+        self.model = model
+        spec = MODELS[model]
+        self.rated_power = spec["rated_power"]
+        self.map = get_register_map(map_name).compile(mppt_count=spec["mppt_count"],
+                                                      string_count=spec["string_count"])
+        overlaps = overlapping_fields(self.map)
+        if overlaps and (map_name, model) not in _warned_overlaps:
+            _warned_overlaps.add((map_name, model))
+            print(f"[Simulator] ⚠️ {map_name}/{model}: {len(overlaps)} thanh ghi bị khai báo chồng lấn, "
+                  f"vd {overlaps[0]}")
+        self.fault_rate = fault_rate          # Xác suất vào fault mỗi lần làm mới giá trị
+        self.fault_duration = fault_duration  # Thời gian giữ fault (giây)
+        self.refresh = refresh                # Chu kỳ làm mới giá trị (giây)
+        self.random = random.Random(seed if seed is not None else slave_id)
+
+        self.input: Dict[int, int] = {}
+        self.holding: Dict[int, int] = {}
+        for name, value in DEFAULT_SETPOINTS.items():
+            point = self.map.writable.get(name)
+            if point is not None:
+                address = point.address + self.map.address_offset
+                for i, word in enumerate(point.encode(value)):
+                    self.holding[address + i] = word
+        self.fault_code = 0
+        self.fault_until = 0.0
+        self.fault_time: Optional[datetime] = None
+        self.energy_day_kwh = self.random.uniform(0, 300)
+        self.energy_total_kwh = self.random.uniform(1e5, 5e5)
+        self._phase = self.random.uniform(0, 2 * math.pi)
+        self._updated_at = 0.0
+
+        # Thống kê
+        self.reads = 0
+        self.writes = 0
+        self.faults = 0
+
+    def inject_fault(self, code: int, duration: Optional[float] = None):
+        """Gây fault ngay: fault_code != 0, work_state fault, công suất về 0"""
+        self.fault_code = code
+        self.fault_until = time.monotonic() + (duration if duration is not None else self.fault_duration)
+        self.fault_time = datetime.now()
+        self.faults += 1
+        self._updated_at = 0.0
+
+    def setpoint(self, name: str) -> Optional[float]:
+        """Giá trị hiện tại của một điểm điều khiển (None nếu map không khai báo)"""
+        point = self.map.writable.get(name)
+        if point is None:
+            return None
+        address = point.address + self.map.address_offset
+        return point.decode([self.holding.get(address + i, 0) for i in range(point.width)])
+
+    def sample(self, now: float) -> Dict[str, Any]:
+        """Giá trị vật lý hiện tại, cùng cấu trúc với dữ liệu driver decode ra"""
+        if self.fault_code and now >= self.fault_until:
+            self.fault_code = 0
+        elif not self.fault_code and self.fault_rate and self.random.random() < self.fault_rate:
+            self.inject_fault(self.random.choice((2, 14, 39, 106, 532)))
+
+        rnd = self.random
+        if self.fault_code:
+            level = 0.0
+        else:
+            level = 0.7 + 0.25 * math.sin(now / 300 + self._phase) + rnd.uniform(-0.02, 0.02)
+        if self.setpoint("power_limit_switch") == 0xAA:
+            level = min(level, (self.setpoint("power_limit") or 0) / 100)
+        stopped = self.setpoint("start_stop") == 0xCE
+        power = 0.0 if stopped else max(0.0, self.rated_power * level)
+        dt = now - self._updated_at if self._updated_at else 0.0
+        self.energy_day_kwh += power * dt / 3.6e6
+        self.energy_total_kwh += power * dt / 3.6e6
+
+        data = {group: self.map.new_container(group) for group in self.map.realtime_groups}
+        voltage = 400 + rnd.uniform(-3, 3)
+        current = power / (math.sqrt(3) * voltage)
+        data["ac"].update(
+            voltage_ab=voltage, voltage_bc=voltage + rnd.uniform(-1, 1), voltage_ca=voltage + rnd.uniform(-1, 1),
+            current_a=current, current_b=current, current_c=current,
+            power=power, reactive_power=rnd.uniform(-500, 500), power_factor=0.999 if power else 0,
+            frequency=50 + rnd.uniform(-0.05, 0.05)
+        )
+
+        mppts: List[Dict] = data["mppt"]
+        strings: List[Dict] = data["strings"]
+        for mppt in mppts:
+            mppt["voltage"] = 0 if self.fault_code else 620 + rnd.uniform(-20, 20)
+            mppt["current"] = power / len(mppts) / mppt["voltage"] if mppt["voltage"] else 0
+        per_mppt = max(1, len(strings) // len(mppts))
+        for i, string in enumerate(strings):
+            mppt = mppts[min(i // per_mppt, len(mppts) - 1)]
+            string["current"] = mppt["current"] / per_mppt * (1 + rnd.uniform(-0.03, 0.03))
+
+        error = data["error"]
+        if self.fault_code:
+            error["work_state"] = WORK_STATE_FAULT
+        else:
+            error["work_state"] = WORK_STATE_STOP if stopped else WORK_STATE_RUN
+        error["fault_code"] = self.fault_code
+        stamp = self.fault_time or datetime(2000, 1, 1)
+        error["fault_time"].update(year=stamp.year, month=stamp.month, day=stamp.day,
+                                   hour=stamp.hour, minute=stamp.minute, second=stamp.second)
+
+        data["energy"].update(energy_day_kwh=self.energy_day_kwh, energy_month_kwh=self.energy_day_kwh * 15,
+                              energy_total_kwh=self.energy_total_kwh,
+                              runtime_today_min=int(now // 60 % 1440))
+        return data
+
+    def _refresh(self):
+        now = time.monotonic()
+        if now - self._updated_at >= self.refresh:
+            self.input = encode_sample(self.map, self.sample(now))
+            self._updated_at = now
+
+    def read(self, function: int, address: int, count: int) -> Optional[List[int]]:
+        """Đọc thanh ghi (FC03 holding / FC04 input). None nếu không có thanh ghi nào trong vùng"""
+        self.reads += 1
+        if function == 4:
+            self._refresh()
+            table = self.input
+        else:
+            table = self.holding
+        if not any(a in table for a in range(address, address + count)):
+            return None  # Illegal data address
+        return [table.get(a, 0) for a in range(address, address + count)]
+
+    def write(self, address: int, values: List[int]):
+        """Ghi holding registers (FC06/FC16)"""
+        for i, value in enumerate(values):
+            self.holding[address + i] = value
+        self.writes += 1
+        self._updated_at = 0.0  # Giá trị phát thay đổi ngay ở lần đọc kế tiếp
@@ -0,0 +1,135 @@
+"""
+Replay - Chạy lại decoder hiện tại trên journal thanh ghi thô (storage/journal.py)
+- Frame được ghép theo layout của decoder hiện tại: vẫn giải được khi kế hoạch đọc đã đổi
+- Chạy hết tốc độ CPU, không có I/O Modbus: đo decode trên dữ liệu thật
+  python -m simulator.replay data/journal
+- Giải lại lịch sử vào DB mới (mẫu + rollup), vd sau khi sửa scale trong register map:
+  python -m simulator.replay data/journal --db data/redecoded.db --rollup --start 2025-11-01
+"""
+import argparse
+import os
+import time
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from engine.collector import build_driver
+from main import build_inverter_configs
+from storage.cache import SampleCache
+from storage.journal import KIND_ENERGY, assemble, list_segments, read_polls
+from storage.local_db import LocalDB
+from storage.rollup import RollupEngine, Tier
+from utils.config_loader import load_config
+
+
+def parse_time(value: Optional[str]) -> Optional[float]:
+    """Epoch giây hoặc ngày/giờ ISO (giờ địa phương)"""
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+def replay(path: str, inverter_configs: Dict[int, Dict[str, Any]], start: Optional[float] = None,
+           end: Optional[float] = None, db: Optional[LocalDB] = None,
+           rollup: Optional[RollupEngine] = None) -> Dict[str, Any]:
+    """Decode lại mọi lần poll trong journal, trả về thống kê"""
+    # Một hàng mỗi inverter là đủ: mẫu được dùng ngay rồi bỏ
+    cache = SampleCache(hours=0)
+    drivers = {}
+    stats = {"polls": 0, "frames": 0, "failed_frames": 0, "samples": 0, "empty": 0, "unknown": 0, "bytes": 0}
+    last_ts = None
+
+    started = time.perf_counter()
+    for poll in read_polls(path, start, end):
+        stats["polls"] += 1
+        stats["frames"] += len(poll.frames)
+        for frame in poll.frames:
+            if frame.registers is None:
+                stats["failed_frames"] += 1
+            else:
+                stats["bytes"] += frame.count * 2
+
+        config = inverter_configs.get(poll.inverter_id)
+        if config is None:
+            stats["unknown"] += 1
+            continue
+        driver = drivers.get(poll.inverter_id)
+        if driver is None:
+            driver = drivers[poll.inverter_id] = build_driver(None, config)
+        decoder = driver.energy_decoder if poll.kind == KIND_ENERGY else driver.realtime_decoder
+
+        frames = assemble(poll.frames, decoder.layouts, driver.map.address_offset)
+        sample = cache.ring(poll.inverter_id, driver.map).append(poll.ts, decoder, frames)
+        if sample is None:
+            stats["empty"] += 1
+            continue
+        stats["samples"] += 1
+        last_ts = poll.ts
+        if db:
+            if db.add_sample(poll.inverter_id, poll.ts, sample):
+                db.flush()
+        if rollup:
+            rollup.add(poll.inverter_id, sample)
+    elapsed = time.perf_counter() - started
+
+    if rollup and last_ts is not None:
+        rollup.close_idle(last_ts + 86400 * 2)  # Đóng mọi cửa sổ còn mở (kể cả tầng ngày)
+    if db:
+        db.flush()
+
+    stats["elapsed_s"] = round(elapsed, 3)
+    if elapsed > 0:
+        stats["polls_per_s"] = round(stats["polls"] / elapsed)
+        stats["frames_per_s"] = round(stats["frames"] / elapsed)
+        stats["mb_per_s"] = round(stats["bytes"] / elapsed / 1e6, 2)
+    if stats["polls"]:
+        stats["us_per_poll"] = round(elapsed / stats["polls"] * 1e6, 1)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Decode lại journal thanh ghi thô bằng decoder hiện tại")
+    parser.add_argument("journal", help="Thư mục journal (server.yaml -> journal.path)")
+    parser.add_argument("--start", help="Từ thời điểm (epoch hoặc ISO, vd 2025-11-01T06:00)")
+    parser.add_argument("--end", help="Đến trước thời điểm (epoch hoặc ISO)")
+    parser.add_argument("--inverters", type=int, nargs="+", help="Chỉ giải các inverter này")
+    parser.add_argument("--db", help="Ghi mẫu đã giải vào local DB này (nên là file mới)")
+    parser.add_argument("--rollup", action="store_true", help="Tính lại rollup 1 phút / 15 phút / ngày vào --db")
+    args = parser.parse_args()
+
+    segments = list_segments(args.journal)
+    if not segments:
+        parser.error(f"Không có segment nào trong {args.journal}")
+
+    # Cùng cách dựng driver với main: register map, số MPPT/string, max_gap theo devices.yaml
+    config = load_config()
+    inverter_configs = {inv["id"]: inv for inv in build_inverter_configs(config)}
+    if args.inverters:
+        inverter_configs = {i: c for i, c in inverter_configs.items() if i in args.inverters}
+
+    db = None
+    if args.db:
+        db = LocalDB(args.db, batch_size=5000, retention_days=float("inf"))
+    rollup = None
+    if args.rollup:
+        if db is None:
+            parser.error("--rollup cần --db")
+        tiers = config["server"].get("rollup", {}).get("tiers")
+        rollup = RollupEngine(db, [Tier(**t) for t in tiers] if tiers else None)
+
+    size = sum(os.path.getsize(s) for s in segments)
+    print(f"[Replay] ▶️ {len(segments)} segment, {size / 1e6:.1f} MB", flush=True)
+    stats = replay(args.journal, inverter_configs, parse_time(args.start), parse_time(args.end), db, rollup)
+    if db:
+        db.close()
+
+    for key, value in stats.items():
+        print(f"  {key:15} {value}")
+    if stats["unknown"]:
+        print(f"[Replay] ⚠️ {stats['unknown']} lần poll của inverter không có trong devices.yaml (bỏ qua)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+"""
+RTU slave giả lập - Trả lời frame Modbus RTU cho nhiều inverter giả lập trên một "bus"
+- Giao tiếp qua loopback TCP (RTU over TCP, bus dùng port "tcp://host:port")
+  hoặc cặp pty (bus mở đường dẫn /dev/pts/N như cổng serial thật)
+- Giả lập thời gian truyền theo baudrate (11 bit/ký tự) và thời gian xử lý của slave
+- Chèn lỗi: timeout (không trả lời), sai CRC, slave không tồn tại
+- Hỗ trợ FC03/04 (đọc) và FC06/16 (ghi holding)
+"""
+import asyncio
+import os
+import random
+import struct
+import threading
+import time
+from typing import Dict, Iterable, Optional, Tuple
+
+from simulator.inverter import SimulatedInverter
+
+# Mã exception Modbus
+ILLEGAL_FUNCTION = 0x01
+ILLEGAL_ADDRESS = 0x02
+ILLEGAL_VALUE = 0x03
+
+
+def _crc_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+_CRC_TABLE = _crc_table()
+
+def crc16(data: bytes) -> int:
+    """CRC-16/MODBUS"""
+    crc = 0xFFFF
+    for byte in data:
+        crc = (crc >> 8) ^ _CRC_TABLE[(crc ^ byte) & 0xFF]
+    return crc
+
+def with_crc(body: bytes) -> bytes:
+    """Thêm CRC (little-endian) vào cuối frame"""
+    return body + struct.pack("<H", crc16(body))
+
+
+def split_frame(buffer: bytes) -> Tuple[Optional[bytes], bytes]:
+    """
+    Tách một request RTU khỏi buffer theo function code.
+    Trả về (frame, phần còn lại); frame None nếu chưa đủ byte.
+    """
+    if len(buffer) < 2:
+        return None, buffer
+    fc = buffer[1]
+    if fc == 16:
+        if len(buffer) < 7:
+            return None, buffer
+        size = 9 + buffer[6]
+    else:
+        size = 8  # FC01-06: slave, fc, 2 x u16, crc
+    if len(buffer) < size:
+        return None, buffer
+    return buffer[:size], buffer[size:]
+
+
+class RtuSlaveServer:
+    """Một bus RS-485 giả lập với nhiều slave"""
+
+    def __init__(self, inverters: Iterable[SimulatedInverter], baudrate: int = 9600,
+                 turnaround: float = 0.01, timeout_rate: float = 0.0, crc_error_rate: float = 0.0,
+                 seed: Optional[int] = None):
+        self.inverters: Dict[int, SimulatedInverter] = {inv.slave_id: inv for inv in inverters}
+        self.baudrate = baudrate
+        self.turnaround = turnaround          # Thời gian xử lý của slave (giây)
+        self.timeout_rate = timeout_rate      # Tỷ lệ request không được trả lời
+        self.crc_error_rate = crc_error_rate  # Tỷ lệ response bị sai CRC
+        self.random = random.Random(seed)
+        self.port: Optional[str] = None       # Cổng cho BusWorker sau khi start
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._pty_thread: Optional[threading.Thread] = None
+        self._running = False
+
+        # Thống kê
+        self.requests = 0
+        self.responses = 0
+        self.timeouts = 0
+        self.crc_errors = 0
+        self.bad_requests = 0
+
+    def wire_time(self, size: int) -> float:
+        """Thời gian truyền size byte ở baudrate hiện tại"""
+        return size * 11 / self.baudrate if self.baudrate else 0.0
+
+    def handle_frame(self, frame: bytes) -> Optional[bytes]:
+        """Xử lý một request RTU, trả về response (None = không trả lời)"""
+        self.requests += 1
+        if len(frame) < 4 or crc16(frame[:-2]) != struct.unpack("<H", frame[-2:])[0]:
+            self.bad_requests += 1
+            return None  # Slave thật bỏ qua frame sai CRC
+        unit, fc = frame[0], frame[1]
+        inverter = self.inverters.get(unit)
+        if inverter is None:
+            return None  # Không có slave này trên bus
+        if self.timeout_rate and self.random.random() < self.timeout_rate:
+            self.timeouts += 1
+            return None
+
+        if fc in (3, 4):
+            address, count = struct.unpack(">HH", frame[2:6])
+            if not 1 <= count <= 125:
+                body = bytes((unit, fc | 0x80, ILLEGAL_VALUE))
+            else:
+                registers = inverter.read(fc, address, count)
+                if registers is None:
+                    body = bytes((unit, fc | 0x80, ILLEGAL_ADDRESS))
+                else:
+                    body = bytes((unit, fc, count * 2)) + struct.pack(f">{count}H", *registers)
+        elif fc == 6:
+            address, value = struct.unpack(">HH", frame[2:6])
+            inverter.write(address, [value])
+            body = frame[:6]
+        elif fc == 16:
+            address, count = struct.unpack(">HH", frame[2:6])
+            inverter.write(address, list(struct.unpack(f">{count}H", frame[7:7 + count * 2])))
+            body = frame[:6]
+        else:
+            body = bytes((unit, fc | 0x80, ILLEGAL_FUNCTION))
+
+        response = with_crc(body)
+        if self.crc_error_rate and self.random.random() < self.crc_error_rate:
+            self.crc_errors += 1
+            response = response[:-1] + bytes((response[-1] ^ 0xFF,))
+        self.responses += 1
+        return response
+
+    def response_delay(self, request: bytes, response: bytes) -> float:
+        """Request và response đi trên dây + thời gian xử lý của slave"""
+        return self.wire_time(len(request) + len(response)) + self.turnaround
+
+    # ------------------------------------------------------------------
+    # Loopback TCP
+    # ------------------------------------------------------------------
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        buffer = b""
+        try:
+            while True:
+                chunk = await reader.read(512)
+                if not chunk:
+                    break
+                buffer += chunk
+                while True:
+                    frame, buffer = split_frame(buffer)
+                    if frame is None:
+                        break
+                    response = self.handle_frame(frame)
+                    if response is None:
+                        continue
+                    await asyncio.sleep(self.response_delay(frame, response))
+                    writer.write(response)
+        except (ConnectionError, asyncio.CancelledError):
+            pass  # Client ngắt hoặc server dừng
+        finally:
+            writer.close()
+
+    async def start_tcp(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Mở server TCP, trả về port dạng "tcp://host:port" cho BusWorker"""
+        self._server = await asyncio.start_server(self._handle_client, host, port)
+        host, port = self._server.sockets[0].getsockname()[:2]
+        self.port = f"tcp://{host}:{port}"
+        return self.port
+
+    # ------------------------------------------------------------------
+    # Cặp pty (Linux/macOS)
+    # ------------------------------------------------------------------
+    def _serve_pty(self, master: int):
+        buffer = b""
+        while self._running:
+            try:
+                chunk = os.read(master, 512)
+            except OSError:
+                break  # Phía slave đã đóng
+            buffer += chunk
+            while True:
+                frame, buffer = split_frame(buffer)
+                if frame is None:
+                    break
+                response = self.handle_frame(frame)
+                if response is None:
+                    continue
+                time.sleep(self.response_delay(frame, response))
+                os.write(master, response)
+        os.close(master)
+
+    def start_pty(self) -> str:
+        """Tạo cặp pty, trả về đường dẫn phía slave để mở như cổng serial"""
+        import tty  # Chỉ có trên Unix
+        master, slave = os.openpty()
+        tty.setraw(slave)
+        self.port = os.ttyname(slave)
+        self._running = True
+        self._pty_thread = threading.Thread(target=self._serve_pty, args=(master,),
+                                            name=f"sim-{self.port}", daemon=True)
+        self._pty_thread.start()
+        return self.port
+
+    def stop(self):
+        self._running = False
+        if self._server is not None:
+            self._server.close()
+
+    def get_stats(self) -> Dict:
+        """Thống kê request và lỗi đã chèn"""
+        return {
+            "port": self.port,
+            "slaves": sorted(self.inverters),
+            "requests": self.requests,
+            "responses": self.responses,
+            "timeouts": self.timeouts,
+            "crc_errors": self.crc_errors,
+            "bad_requests": self.bad_requests,
+            "faults": sum(inv.faults for inv in self.inverters.values()),
+        }
@@ -0,0 +1,432 @@
+"""
+Cache mẫu - Biểu diễn mẫu gọn trong bộ nhớ và ring buffer theo inverter
+- Mỗi mẫu là một hàng trong các mảng cột cấp phát sẵn: giá trị thô của từng trường
+  (array 'H' cho trường 16 bit, 'I' cho 32 bit) thay cho dict lồng nhau của từng MPPT/string
+- Một trường của nhóm lặp (vd strings.current) là một dải cột liền nhau: đọc cả dải không sao chép
+- Ring buffer N giờ gần nhất cho từng inverter, hàng cũ nhất bị ghi đè
+- Sample là view chỉ đọc (ring, hàng): storage, alerts, TCP server đọc thẳng từ mảng;
+  scale/sentinel áp khi đọc, trường không có giá trị trả về None
+- Vẫn đọc được như dict ("ac" in sample, sample["mppt"]...) cho các consumer cũ
+- Hàng thô (bitmask + words + dwords) chép được nguyên khối sang ring cùng schema ở process khác
+"""
+import math
+from array import array
+from collections.abc import Mapping
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from engine.mapper import BlockDecoder, CompiledMap, make_scaler
+
+MAX_GROUPS = 16  # Bitmask nhóm của mỗi hàng là array 'H'
+
+
+def _decoder(sign: int, sentinel: Optional[int], divisor: Optional[int], factor: float) -> Callable[[int], Any]:
+    """
+    Hàm giá trị thô -> giá trị vật lý (None nếu là sentinel), cùng kết quả với make_scaler của mapper.
+    Scale viết thẳng trong hàm: đây là vòng lặp nóng khi đọc mẫu
+    """
+    if not sign:
+        if factor == 1:
+            return lambda raw: None if raw == sentinel else raw
+        if divisor:
+            return lambda raw: None if raw == sentinel else raw / divisor
+        return lambda raw: None if raw == sentinel else raw * factor
+    scale = make_scaler(factor)
+
+    def decode(raw: int):
+        if raw >= sign:
+            raw -= sign << 1
+        return None if raw == sentinel else scale(raw)
+    return decode
+
+
+class Column:
+    """Một trường trong mảng cột: count cột liền nhau từ start (1 cột nếu không phải nhóm lặp)"""
+    __slots__ = ("group", "key", "bit", "width", "start", "count", "typecode", "sentinel",
+                 "decode", "divisor", "factor")
+
+    def __init__(self, group: str, key: str, bit: int, width: int, start: int, type_: str,
+                 sentinel: Optional[int], scale: float):
+        self.group = group
+        self.key = key                      # Tên trường, vd "voltage", "fault_time.year"
+        self.bit = bit                      # Bit của nhóm trong bitmask của hàng
+        self.width = width                  # 1: mảng words, 2: mảng dwords
+        self.start = start
+        self.count = 1
+        signed = type_.startswith("s")
+        self.typecode = ("h" if signed else "H") if width == 1 else ("i" if signed else "I")
+        self.sentinel = sentinel
+        # Chia cho số nguyên khi có thể, giống make_scaler (dùng cả cho tính toán trên mảng numpy)
+        divisor = 1 / scale
+        self.divisor = round(divisor) if abs(divisor - round(divisor)) < 1e-9 else None
+        self.factor = scale
+        self.decode = _decoder(1 << (16 * width - 1) if signed else 0, sentinel, self.divisor, scale)
+
+    def scale_values(self, raw):
+        """Áp scale cho cả mảng giá trị thô (numpy), chưa xử lý sentinel"""
+        return raw / self.divisor if self.divisor else raw * self.factor
+
+
+class SampleSchema:
+    """Bố cục cột của một register map đã compile"""
+
+    def __init__(self, cmap: CompiledMap):
+        self.map = cmap
+        self.groups = cmap.groups
+        if len(self.groups) > MAX_GROUPS:
+            raise ValueError(f"[Cache] {cmap.name}: tối đa {MAX_GROUPS} nhóm")
+        self.bits = {group: 1 << i for i, group in enumerate(self.groups)}
+        self.word_count = cmap.word_count
+        self.dword_count = cmap.dword_count
+
+        self.columns: Dict[Tuple[str, str], Column] = {}
+        for f, (width, start) in cmap.columns.items():
+            key = (f.group, ".".join(f.path))
+            column = self.columns.get(key)
+            if column is None:
+                self.columns[key] = Column(f.group, key[1], self.bits[f.group], width, start,
+                                           f.type, f.sentinel, f.scale)
+            elif start == column.start + column.count:
+                column.count += 1
+            else:
+                raise ValueError(f"[Cache] {cmap.name}.{key[0]}.{key[1]}: cột không liền nhau")
+
+        # Theo thứ tự khai báo: dựng lại dict và key phẳng giống hệt decode() của mapper.
+        # Slot (độ rộng, cột, hàm decode) tính sẵn để đọc cả nhóm không phải tra cứu từng trường
+        self.group_columns: Dict[str, List[Column]] = {}
+        self.keys: Dict[str, Tuple[str, ...]] = {}
+        self.record_slots: Dict[str, List[Tuple[int, int, Callable]]] = {}
+        self.flat_slots: Dict[str, List[Tuple[str, int, int, Optional[Callable]]]] = {}
+        self.value_keys: Dict[str, Tuple[str, ...]] = {}  # Key phẳng không gồm chỉ số nhóm lặp
+        for group in self.groups:
+            count, index_key, paths = cmap.template(group)
+            columns = [self.columns[(group, ".".join(path))] for path in paths]
+            self.group_columns[group] = columns
+            self.keys[group] = tuple(c.key for c in columns)
+            self.record_slots[group] = [(c.width, c.start, c.decode) for c in columns]
+            if count is None:
+                self.flat_slots[group] = [(f"{group}.{c.key}", c.width, c.start, c.decode) for c in columns]
+            else:
+                flat = []
+                for i in range(count):
+                    flat.append((f"{group}.{i + 1}.{index_key}", 0, i + 1, None))  # Chỉ số: hằng số
+                    flat.extend((f"{group}.{i + 1}.{c.key}", c.width, c.start + i, c.decode) for c in columns)
+                self.flat_slots[group] = flat
+            self.value_keys[group] = tuple(key for key, _, _, decode in self.flat_slots[group] if decode)
+
+        self._masks: Dict[Tuple[str, ...], int] = {}
+
+    def mask(self, groups) -> int:
+        """Bitmask của một tập nhóm"""
+        key = tuple(groups)
+        mask = self._masks.get(key)
+        if mask is None:
+            mask = self._masks[key] = sum(self.bits[g] for g in key)
+        return mask
+
+    def column(self, group: str, key: str) -> Optional[Column]:
+        return self.columns.get((group, key))
+
+
+class Sample(Mapping):
+    """
+    View chỉ đọc của một hàng trong ring. Hợp lệ đến khi ring ghi đè hàng này
+    (sau capacity mẫu); consumer cần giữ lâu hơn thì sao chép bằng to_dict().
+    """
+    __slots__ = ("ring", "seq", "slot", "word_base", "dword_base")
+
+    def __init__(self, ring: "SampleRing", seq: int):
+        self.ring = ring
+        self.seq = seq                     # Số thứ tự tuyệt đối trong ring
+        self.slot = seq % ring.capacity
+        self.word_base = self.slot * ring.schema.word_count
+        self.dword_base = self.slot * ring.schema.dword_count
+
+    @property
+    def inverter_id(self) -> int:
+        return self.ring.inverter_id
+
+    @property
+    def ts(self) -> float:
+        return self.ring.ts[self.slot]
+
+    @property
+    def schema(self) -> SampleSchema:
+        return self.ring.schema
+
+    @property
+    def stale(self) -> bool:
+        """Hàng đã bị mẫu mới hơn ghi đè"""
+        return self.seq < self.ring.written - self.ring.capacity
+
+    def has(self, group: str) -> bool:
+        """Nhóm có trong mẫu và đọc thành công"""
+        bit = self.ring.schema.bits.get(group, 0)
+        return bool(self.ring.valid[self.slot] & bit)
+
+    # ------------------------------------------------------------------
+    # Đọc theo cột
+    # ------------------------------------------------------------------
+    def _raw(self, width: int, column: int) -> int:
+        if width == 1:
+            return self.ring.words[self.word_base + column]
+        return self.ring.dwords[self.dword_base + column]
+
+    def value(self, group: str, key: str, index: int = 0):
+        """Giá trị một trường (index: vị trí trong nhóm lặp, từ 0); None nếu không có"""
+        column = self.ring.schema.columns.get((group, key))
+        if column is None or index >= column.count or not self.ring.valid[self.slot] & column.bit:
+            return None
+        return column.decode(self._raw(column.width, column.start + index))
+
+    def values(self, group: str, key: str) -> List[Optional[float]]:
+        """Giá trị của một trường trên tất cả phần tử nhóm lặp"""
+        column = self.ring.schema.columns.get((group, key))
+        if column is None:
+            return []
+        if not self.ring.valid[self.slot] & column.bit:
+            return [None] * column.count
+        decode = column.decode
+        return [decode(raw) for raw in self.raw(group, key)]
+
+    def record(self, group: str) -> List[Optional[float]]:
+        """Giá trị các trường của một nhóm không lặp, theo thứ tự schema.keys[group]"""
+        if not self.has(group):
+            return [None] * len(self.ring.schema.keys.get(group, ()))
+        words, dwords = self.ring.words, self.ring.dwords
+        word_base, dword_base = self.word_base, self.dword_base
+        return [decode(words[word_base + start] if width == 1 else dwords[dword_base + start])
+                for width, start, decode in self.ring.schema.record_slots[group]]
+
+    def flat_values(self, group: str) -> List[Optional[float]]:
+        """Giá trị các trường của một nhóm (kể cả nhóm lặp), theo thứ tự schema.value_keys[group]"""
+        if not self.has(group):
+            return [None] * len(self.ring.schema.value_keys.get(group, ()))
+        words, dwords = self.ring.words, self.ring.dwords
+        word_base, dword_base = self.word_base, self.dword_base
+        return [decode(words[word_base + column] if width == 1 else dwords[dword_base + column])
+                for _, width, column, decode in self.ring.schema.flat_slots[group] if decode]
+
+    def row(self) -> Tuple[int, int, memoryview, memoryview]:
+        """Cả hàng thô (bitmask nhóm đọc, bitmask nhóm hợp lệ, byte words, byte dwords), không sao chép"""
+        ring = self.ring
+        words = ring.schema.word_count * ring.words.itemsize
+        dwords = ring.schema.dword_count * ring.dwords.itemsize
+        return (ring.requested[self.slot], ring.valid[self.slot],
+                ring.word_bytes[self.slot * words:(self.slot + 1) * words],
+                ring.dword_bytes[self.slot * dwords:(self.slot + 1) * dwords])
+
+    def raw(self, group: str, key: str) -> memoryview:
+        """Giá trị thô (chưa scale/sentinel) của một trường, view thẳng vào mảng - không sao chép"""
+        column = self.ring.schema.columns[(group, key)]
+        if column.width == 1:
+            base = self.word_base + column.start
+            return self.ring.word_view[base:base + column.count]
+        base = self.dword_base + column.start
+        return self.ring.dword_view[base:base + column.count]
+
+    # ------------------------------------------------------------------
+    # Dạng dict (tương thích consumer cũ, MQTT snapshot)
+    # ------------------------------------------------------------------
+    def _group_dict(self, group: str):
+        count, index_key, paths = self.ring.schema.map.template(group)
+        columns = self.ring.schema.group_columns[group]
+
+        def record(index: int) -> Dict[str, Any]:
+            rec: Dict[str, Any] = {}
+            for path, column in zip(paths, columns):
+                target = rec
+                for p in path[:-1]:
+                    target = target.setdefault(p, {})
+                target[path[-1]] = column.decode(self._raw(column.width, column.start + index))
+            return rec
+
+        if count is None:
+            return record(0)
+        items = []
+        for i in range(count):
+            item = {index_key: i + 1}
+            item.update(record(i))
+            items.append(item)
+        return items
+
+    def __getitem__(self, group: str):
+        if group not in self:
+            raise KeyError(group)
+        return self._group_dict(group) if self.has(group) else None
+
+    def __contains__(self, group) -> bool:
+        """Nhóm được đọc trong lần poll này (kể cả khi lỗi, giống dict của decoder)"""
+        bit = self.ring.schema.bits.get(group, 0)
+        return bool(self.ring.requested[self.slot] & bit)
+
+    def __iter__(self) -> Iterator[str]:
+        return (g for g in self.ring.schema.groups if g in self)
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Sao chép thành dict lồng nhau như decoder của mapper trả về"""
+        return {group: self[group] for group in self}
+
+    def flat(self) -> Dict[str, Any]:
+        """Key phẳng dạng "ac.power", "mppt.3.voltage", "error.fault_time.year" -> giá trị"""
+        flat: Dict[str, Any] = {}
+        words, dwords = self.ring.words, self.ring.dwords
+        word_base, dword_base = self.word_base, self.dword_base
+        for group in self:
+            if not self.has(group):
+                flat[group] = None
+                continue
+            for key, width, column, decode in self.ring.schema.flat_slots[group]:
+                if decode is None:
+                    flat[key] = column
+                elif width == 1:
+                    flat[key] = decode(words[word_base + column])
+                else:
+                    flat[key] = decode(dwords[dword_base + column])
+        return flat
+
+    def __repr__(self) -> str:
+        return f"Sample(inverter={self.inverter_id}, ts={self.ts:.3f}, groups={list(self)})"
+
+
+class SampleRing:
+    """Ring buffer cấp phát sẵn cho các mẫu của một inverter"""
+
+    def __init__(self, inverter_id: int, schema: SampleSchema, capacity: int):
+        self.inverter_id = inverter_id
+        self.schema = schema
+        self.capacity = capacity
+        self.words = array("H", bytes(2 * capacity * schema.word_count))
+        self.dwords = array("I", bytes(array("I").itemsize * capacity * schema.dword_count))
+        self.ts = array("d", bytes(8 * capacity))
+        self.requested = array("H", bytes(2 * capacity))  # Bitmask nhóm được đọc
+        self.valid = array("H", bytes(2 * capacity))      # Bitmask nhóm đọc thành công
+        self.word_view = memoryview(self.words)
+        self.dword_view = memoryview(self.dwords)
+        self.word_bytes = self.word_view.cast("B")
+        self.dword_bytes = self.dword_view.cast("B")
+        self.written = 0  # Tổng số mẫu đã ghi
+
+    def append(self, ts: float, decoder: BlockDecoder, frames: List[Optional[List[int]]]) -> Optional[Sample]:
+        """Decode các frame vào hàng kế tiếp; None nếu không nhóm nào đọc được (không ghi)"""
+        slot = self.written % self.capacity
+        groups = decoder.decode_into(frames, self.words, self.dwords,
+                                     slot * self.schema.word_count, slot * self.schema.dword_count)
+        if not groups:
+            return None
+        self.ts[slot] = ts
+        self.requested[slot] = self.schema.mask(decoder.groups)
+        self.valid[slot] = self.schema.mask(groups)
+        sample = Sample(self, self.written)
+        self.written += 1
+        return sample
+
+    def append_row(self, ts: float, requested: int, valid: int, words: bytes, dwords: bytes) -> Sample:
+        """Ghi nguyên một hàng thô lấy từ Sample.row() của ring cùng schema (vd ở process bus)"""
+        slot = self.written % self.capacity
+        size = len(words)
+        self.word_bytes[slot * size:(slot + 1) * size] = words
+        size = len(dwords)
+        self.dword_bytes[slot * size:(slot + 1) * size] = dwords
+        self.ts[slot] = ts
+        self.requested[slot] = requested
+        self.valid[slot] = valid
+        sample = Sample(self, self.written)
+        self.written += 1
+        return sample
+
+    def __len__(self) -> int:
+        return min(self.written, self.capacity)
+
+    def __iter__(self) -> Iterator[Sample]:
+        """Các mẫu còn trong ring, cũ nhất trước"""
+        return (Sample(self, seq) for seq in range(self.written - len(self), self.written))
+
+    def latest(self, group: Optional[str] = None) -> Optional[Sample]:
+        """Mẫu mới nhất; group: mẫu mới nhất có nhóm này (mẫu chỉ có sản lượng xen giữa các mẫu realtime)"""
+        if group is None:
+            return Sample(self, self.written - 1) if self.written else None
+        bit = self.schema.bits.get(group, 0)
+        for seq in range(self.written - 1, self.written - len(self) - 1, -1):
+            if self.valid[seq % self.capacity] & bit:
+                return Sample(self, seq)
+        return None
+
+    def since(self, ts: float) -> List[Sample]:
+        """Các mẫu có ts >= ts, cũ nhất trước"""
+        result = []
+        for seq in range(self.written - 1, self.written - len(self) - 1, -1):
+            sample = Sample(self, seq)
+            if sample.ts < ts:
+                break
+            result.append(sample)
+        result.reverse()
+        return result
+
+    @property
+    def nbytes(self) -> int:
+        return sum(a.itemsize * len(a) for a in (self.words, self.dwords, self.ts, self.requested, self.valid))
+
+
+class SampleCache:
+    """Ring buffer của tất cả inverter, dài khoảng `hours` giờ ở chu kỳ realtime `interval`"""
+
+    def __init__(self, hours: float = 1.0, interval: float = 5):
+        self.hours = hours
+        self.interval = interval
+        # Số hàng cố định: khi poll nhanh hơn (fault burst) ring chứa ít thời gian hơn
+        self.capacity = max(1, math.ceil(hours * 3600 / interval))
+        self.rings: Dict[int, SampleRing] = {}
+        self._schemas: Dict[CompiledMap, SampleSchema] = {}
+
+    def schema(self, cmap: CompiledMap) -> SampleSchema:
+        schema = self._schemas.get(cmap)
+        if schema is None:
+            schema = self._schemas[cmap] = SampleSchema(cmap)
+        return schema
+
+    def ring(self, inverter_id: int, cmap: CompiledMap) -> SampleRing:
+        """Lấy (hoặc cấp phát) ring của một inverter"""
+        ring = self.rings.get(inverter_id)
+        if ring is None or ring.schema.map is not cmap:
+            ring = self.rings[inverter_id] = SampleRing(inverter_id, self.schema(cmap), self.capacity)
+        return ring
+
+    def get(self, inverter_id: int) -> Optional[SampleRing]:
+        return self.rings.get(inverter_id)
+
+    def latest(self, inverter_id: int, group: Optional[str] = None) -> Optional[Sample]:
+        ring = self.rings.get(inverter_id)
+        return ring.latest(group) if ring else None
+
+    def get_stats(self) -> Dict:
+        """Số mẫu và bộ nhớ của cache"""
+        nbytes = sum(ring.nbytes for ring in self.rings.values())
+        rows = len(self.rings) * self.capacity
+        return {
+            "inverters": len(self.rings),
+            "capacity": self.capacity,
+            "hours": self.hours,
+            "samples": sum(len(ring) for ring in self.rings.values()),
+            "bytes": nbytes,
+            "bytes_per_sample": round(nbytes / rows, 1) if rows else None
+        }
+
+
+# Singleton instance
+_cache_instance: Optional[SampleCache] = None
+
+def get_sample_cache() -> SampleCache:
+    """Lấy singleton sample cache"""
+    global _cache_instance
+    if _cache_instance is None:
+        _cache_instance = SampleCache()
+    return _cache_instance
+
+def configure_cache(**options) -> SampleCache:
+    """Tạo lại cache với tham số từ cấu hình"""
+    global _cache_instance
+    _cache_instance = SampleCache(**options)
+    return _cache_instance
@@ -0,0 +1,255 @@
+"""
+Journal - Nhật ký append-only các block thanh ghi thô đọc từ inverter
+- Ghi nguyên frame Modbus (timestamp, inverter, slave, địa chỉ, payload uint16) trước khi decode:
+  lỗi scale/decode phát hiện sau này vẫn giải lại được lịch sử bằng decoder đã sửa
+- Segment nhị phân little-endian cố định: header 16 byte + các record nối tiếp,
+  reader mmap file và đọc thẳng bằng struct (không parse, không dựng object trung gian)
+- Mỗi record: header 20 byte + 2 byte mỗi thanh ghi; frame lỗi chỉ có header (cờ FLAG_FAILED)
+- Các frame của một lần poll có cùng (inverter, ts): replay ghép lại thành đúng một lần poll
+- Xoay segment theo kích thước, xóa segment cũ nhất khi vượt max_bytes (mỗi writer một tên,
+  vd mỗi process bus một writer, cùng thư mục)
+"""
+import heapq
+import mmap
+import os
+import re
+import struct
+import time
+from typing import Dict, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+MAGIC = b"DLRJ"
+VERSION = 1
+SEGMENT_HEADER = struct.Struct("<4sHHd")   # magic, version, reserved, thời điểm tạo
+RECORD_HEADER = struct.Struct("<dIBBBxHH")  # ts, inverter_id, slave, kind, cờ, địa chỉ (trên dây), số thanh ghi
+SUFFIX = ".seg"
+
+KIND_REALTIME = 0
+KIND_ENERGY = 1
+
+FLAG_FAILED = 0x01    # Slave không trả lời / lỗi: không có payload
+
+_payloads: Dict[int, struct.Struct] = {}
+
+
+def _payload(count: int) -> struct.Struct:
+    """Struct của payload count thanh ghi (cache theo count)"""
+    s = _payloads.get(count)
+    if s is None:
+        s = _payloads[count] = struct.Struct(f"<{count}H")
+    return s
+
+
+class Frame(NamedTuple):
+    """Một block thanh ghi trong journal"""
+    ts: float
+    inverter_id: int
+    slave_id: int
+    kind: int
+    address: int                        # Địa chỉ gửi trên dây (đã cộng address_offset của map)
+    count: int
+    registers: Optional[Tuple[int, ...]]  # None: frame lỗi
+
+
+class Poll(NamedTuple):
+    """Các frame của một lần poll"""
+    ts: float
+    inverter_id: int
+    slave_id: int
+    kind: int
+    frames: List[Frame]
+
+
+class RegisterJournal:
+    """Writer: ghi frame vào segment hiện tại, xoay segment theo kích thước"""
+
+    def __init__(self, path: str, name: str = "main", segment_bytes: int = 16 << 20,
+                 max_bytes: int = 256 << 20, flush_interval: float = 5):
+        self.path = path
+        self.name = re.sub(r"[^A-Za-z0-9_.-]+", "_", name).strip("_") or "main"
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes            # Tổng dung lượng các segment của writer này
+        self.flush_interval = flush_interval
+        os.makedirs(path, exist_ok=True)
+
+        self._file = None
+        self._size = 0
+        self._last_flush = 0.0
+
+        # Thống kê
+        self.frames = 0
+        self.bytes_written = 0
+        self.segments = 0
+        self.deleted = 0
+
+    def _open(self, ts: float):
+        """Mở segment mới (mỗi lần khởi động cũng mở segment mới: không nối vào đuôi có thể dở)"""
+        self.close()
+        stamp = int(ts * 1000)
+        path = os.path.join(self.path, f"{self.name}-{stamp:013d}{SUFFIX}")
+        while os.path.exists(path):
+            stamp += 1
+            path = os.path.join(self.path, f"{self.name}-{stamp:013d}{SUFFIX}")
+        self._file = open(path, "wb", buffering=1 << 16)
+        self._file.write(SEGMENT_HEADER.pack(MAGIC, VERSION, 0, ts))
+        self._size = SEGMENT_HEADER.size
+        self.segments += 1
+        self._prune()
+
+    def _prune(self):
+        """Xóa segment cũ nhất của writer này khi tổng dung lượng vượt max_bytes"""
+        own = sorted(p for p in list_segments(self.path) if _segment_name(p) == self.name)
+        sizes = {p: os.path.getsize(p) for p in own}
+        total = sum(sizes.values())
+        for path in own[:-1]:  # Không bao giờ xóa segment đang ghi
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= sizes[path]
+            self.deleted += 1
+
+    def record(self, inverter_id: int, slave_id: int, ts: float, kind: int, address_offset: int,
+               layouts: Sequence, frames: Sequence[Optional[Sequence[int]]]):
+        """Ghi các frame của một lần poll (layouts: FrameLayout của decoder, cùng thứ tự với frames)"""
+        parts = []
+        for layout, regs in zip(layouts, frames):
+            address = layout.start + address_offset
+            if not regs or len(regs) < layout.count:
+                parts.append(RECORD_HEADER.pack(ts, inverter_id, slave_id, kind, FLAG_FAILED, address, layout.count))
+                continue
+            count = len(regs)
+            parts.append(RECORD_HEADER.pack(ts, inverter_id, slave_id, kind, 0, address, count))
+            parts.append(_payload(count).pack(*regs))
+        data = b"".join(parts)
+
+        if self._file is None or self._size + len(data) > self.segment_bytes:
+            self._open(ts)
+        self._file.write(data)
+        self._size += len(data)
+        self.frames += len(frames)
+        self.bytes_written += len(data)
+
+        now = time.monotonic()
+        if now - self._last_flush >= self.flush_interval:
+            self._file.flush()
+            self._last_flush = now
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def get_stats(self) -> Dict:
+        return {
+            "path": self.path,
+            "name": self.name,
+            "frames": self.frames,
+            "bytes_written": self.bytes_written,
+            "segments": self.segments,
+            "deleted": self.deleted
+        }
+
+
+# ----------------------------------------------------------------------
+# Đọc
+# ----------------------------------------------------------------------
+def _segment_name(path: str) -> str:
+    """Tên writer của segment (phần trước '-<timestamp ms>')"""
+    return os.path.basename(path)[:-len(SUFFIX)].rpartition("-")[0]
+
+
+def list_segments(path: str) -> List[str]:
+    """Các segment trong thư mục, theo tên writer rồi thời điểm tạo"""
+    try:
+        names = os.listdir(path)
+    except FileNotFoundError:
+        return []
+    return sorted(os.path.join(path, n) for n in names if n.endswith(SUFFIX))
+
+
+def read_segment(path: str, start: Optional[float] = None, end: Optional[float] = None) -> Iterator[Frame]:
+    """Các frame của một segment có start <= ts < end; record ghi dở ở cuối file (mất điện) bị bỏ qua"""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size < SEGMENT_HEADER.size:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            magic, version, _, _ = SEGMENT_HEADER.unpack_from(mm, 0)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError(f"{path}: không phải segment journal v{VERSION}")
+            offset, size = SEGMENT_HEADER.size, len(mm)
+            unpack_header, header_size = RECORD_HEADER.unpack_from, RECORD_HEADER.size
+            while offset + header_size <= size:
+                ts, inverter_id, slave_id, kind, flags, address, count = unpack_header(mm, offset)
+                offset += header_size
+                if flags & FLAG_FAILED:
+                    registers = None
+                else:
+                    if offset + count * 2 > size:
+                        break
+                    registers = _payload(count).unpack_from(mm, offset)
+                    offset += count * 2
+                if (start is None or ts >= start) and (end is None or ts < end):
+                    yield Frame(ts, inverter_id, slave_id, kind, address, count, registers)
+
+
+def read_frames(path: str, start: Optional[float] = None, end: Optional[float] = None) -> Iterator[Frame]:
+    """Frame của mọi writer trong thư mục, trộn theo thời gian"""
+    by_name: Dict[str, List[str]] = {}
+    for segment in list_segments(path):
+        by_name.setdefault(_segment_name(segment), []).append(segment)
+
+    def stream(segments: List[str]) -> Iterator[Frame]:
+        for segment in segments:
+            # Segment kế tiếp tạo sau khi segment này đầy: bỏ qua segment kết thúc trước start
+            yield from read_segment(segment, start, end)
+
+    return heapq.merge(*(stream(s) for s in by_name.values()), key=lambda frame: frame.ts)
+
+
+def read_polls(path: str, start: Optional[float] = None, end: Optional[float] = None) -> Iterator[Poll]:
+    """Gộp các frame liên tiếp cùng (inverter, ts) thành một lần poll"""
+    poll: Optional[Poll] = None
+    for frame in read_frames(path, start, end):
+        if poll is not None and frame.ts == poll.ts and frame.inverter_id == poll.inverter_id:
+            poll.frames.append(frame)
+            continue
+        if poll is not None:
+            yield poll
+        poll = Poll(frame.ts, frame.inverter_id, frame.slave_id, frame.kind, [frame])
+    if poll is not None:
+        yield poll
+
+
+def assemble(frames: List[Frame], layouts: Sequence, address_offset: int) -> List[Optional[Tuple[int, ...]]]:
+    """Frame cho layouts của decoder hiện tại, cắt từ các block đã ghi (kế hoạch đọc có thể đã khác)"""
+    result = []
+    for layout in layouts:
+        address = layout.start + address_offset
+        regs = None
+        for frame in frames:
+            if (frame.registers is not None and frame.address <= address
+                    and address + layout.count <= frame.address + frame.count):
+                first = address - frame.address
+                regs = frame.registers if first == 0 and frame.count == layout.count else \
+                    frame.registers[first:first + layout.count]
+                break
+        result.append(regs)
+    return result
+
+
+# Singleton instance (None: không ghi journal)
+_journal_instance: Optional[RegisterJournal] = None
+
+def get_journal() -> Optional[RegisterJournal]:
+    """Journal đang ghi của process, None nếu chưa bật"""
+    return _journal_instance
+
+def configure_journal(path: str, **options) -> RegisterJournal:
+    """Bật journal với tham số từ cấu hình (mỗi process một writer riêng, đặt name khác nhau)"""
+    global _journal_instance
+    if _journal_instance is not None:
+        _journal_instance.close()
+    _journal_instance = RegisterJournal(path, **options)
+    return _journal_instance
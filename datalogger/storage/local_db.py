@@ -0,0 +1,527 @@
+"""
+Local DB - Lưu trữ time-series cục bộ kiểu store-and-forward (SQLite WAL)
+- Mẫu được gom trong bộ nhớ và ghi theo lô trong một transaction (giảm ghi thẻ SD)
+- Mỗi inverter/thời điểm một dòng; MPPT/string đóng gói thành mảng float32
+- Cursor upload theo id dòng: mất kết nối thì dữ liệu vẫn nằm chờ, không mất
+- Bảng rollups: các tầng tổng hợp (1 phút, 15 phút, ngày) với retention riêng từng tầng
+- Bảng plants: snapshot nhà máy theo project, retention như mẫu thô
+"""
+import asyncio
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from typing import Any, Dict, List, Optional, Tuple
+
+from storage.cache import Sample
+
+KIND_REALTIME = 0
+KIND_ENERGY = 1
+
+ENERGY_FIELDS = ["energy_day_kwh", "energy_month_kwh", "energy_total_kwh", "runtime_today_min"]
+FAULT_TIME_FIELDS = ["year", "month", "day", "hour", "minute", "second"]
+U16_NONE = 0xFFFF
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS samples (
+    id INTEGER PRIMARY KEY,
+    inverter_id INTEGER NOT NULL,
+    ts REAL NOT NULL,
+    kind INTEGER NOT NULL,
+    layout INTEGER,
+    ac BLOB,
+    mppt BLOB,
+    strings BLOB,
+    work_state INTEGER,
+    fault_code INTEGER,
+    fault_time BLOB,
+    energy BLOB
+);
+CREATE INDEX IF NOT EXISTS idx_samples_ts ON samples(ts);
+CREATE TABLE IF NOT EXISTS layouts (
+    id INTEGER PRIMARY KEY,
+    fields TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS cursors (
+    name TEXT PRIMARY KEY,
+    last_id INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS rollups (
+    id INTEGER PRIMARY KEY,
+    tier INTEGER NOT NULL,
+    inverter_id INTEGER NOT NULL,
+    start REAL NOT NULL,
+    samples INTEGER NOT NULL,
+    layout INTEGER NOT NULL,
+    mean BLOB,
+    low BLOB,
+    high BLOB,
+    last BLOB,
+    delta BLOB,
+    UNIQUE (tier, inverter_id, start)
+);
+CREATE INDEX IF NOT EXISTS idx_rollups_start ON rollups(tier, start);
+CREATE TABLE IF NOT EXISTS plants (
+    id INTEGER PRIMARY KEY,
+    project_id INTEGER NOT NULL,
+    ts REAL NOT NULL,
+    power_w REAL,
+    energy_day_kwh REAL,
+    energy_total_kwh REAL,
+    reporting INTEGER,
+    stale INTEGER,
+    missing INTEGER,
+    faulted INTEGER,
+    availability REAL,
+    specific_yield REAL,
+    capacity_factor REAL,
+    performance_ratio REAL,
+    max_age REAL,
+    inverters TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_plants_ts ON plants(project_id, ts);
+"""
+
+ROLLUP_STATS = ("mean", "min", "max", "last", "delta")
+PLANT_FIELDS = ("power_w", "energy_day_kwh", "energy_total_kwh", "reporting", "stale", "missing", "faulted",
+                "availability", "specific_yield", "capacity_factor", "performance_ratio", "max_age")
+
+
+def _pack_floats(values: List[Optional[float]], typecode: str = "f") -> bytes:
+    """Đóng gói list số thành mảng nhị phân, None -> NaN"""
+    return array(typecode, [math.nan if v is None else v for v in values]).tobytes()
+
+
+def _unpack_floats(blob: Optional[bytes], typecode: str = "f") -> List[Optional[float]]:
+    """Giải mảng nhị phân, NaN -> None"""
+    if blob is None:
+        return []
+    values = array(typecode)
+    values.frombytes(blob)
+    if typecode == "f":
+        # float32 chỉ có ~7 chữ số có nghĩa: làm tròn để 400.1 không thành 400.1000061
+        return [None if math.isnan(v) else float("%.7g" % v) for v in values]
+    return [None if math.isnan(v) else v for v in values]
+
+
+class LocalDB:
+    """Kho dữ liệu cục bộ với ghi theo lô và cursor upload"""
+
+    def __init__(self, path: str, batch_size: int = 500, flush_interval: float = 30,
+                 retention_days: float = 30, max_buffered: Optional[int] = None):
+        self.path = path
+        self.batch_size = batch_size
+        # Giới hạn mỗi buffer khi flush lỗi liên tục (đĩa đầy...): bỏ dòng cũ nhất thay vì tràn RAM
+        self.max_buffered = max_buffered or 4 * batch_size
+        self.flush_interval = flush_interval
+        self.retention_days = retention_days
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")  # WAL: an toàn khi mất điện, ít fsync hơn
+        self.conn.execute("PRAGMA temp_store=MEMORY")
+        self.conn.executescript(SCHEMA)
+        self.conn.commit()
+
+        self._lock = threading.Lock()     # Bảo vệ buffer (giữ rất ngắn, gọi từ event loop)
+        self._db_lock = threading.Lock()  # Bảo vệ connection (ghi/đọc có thể lâu)
+        self._buffer: List[Tuple] = []
+        self._rollups: List[Tuple] = []
+        self._plants: List[Tuple] = []
+        self._layouts: Dict[Tuple[str, ...], int] = {
+            tuple(json.loads(fields)): layout_id
+            for layout_id, fields in self.conn.execute("SELECT id, fields FROM layouts")
+        }
+        self._layout_fields: Dict[int, List[str]] = {v: list(k) for k, v in self._layouts.items()}
+
+        # Số ngày giữ của từng tầng rollup (tier = độ dài cửa sổ, giây), do RollupEngine đăng ký
+        self.rollup_retention: Dict[int, float] = {}
+
+        # Thống kê
+        self.rows_written = 0
+        self.rollups_written = 0
+        self.plants_written = 0
+        self.flushes = 0
+        self.errors = 0
+        self.dropped = 0
+
+    # ------------------------------------------------------------------
+    # Ghi
+    # ------------------------------------------------------------------
+    def _layout_id(self, fields: Tuple[str, ...]) -> int:
+        """Id của bộ tên trường AC (lưu một lần thay vì lặp lại tên trong mỗi dòng)"""
+        layout_id = self._layouts.get(fields)
+        if layout_id is None:
+            cur = self.conn.execute("INSERT INTO layouts (fields) VALUES (?)", (json.dumps(list(fields)),))
+            layout_id = cur.lastrowid
+            self._layouts[fields] = layout_id
+            self._layout_fields[layout_id] = list(fields)
+        return layout_id
+
+    def _encode(self, inverter_id: int, ts: float, sample: Sample) -> Tuple:
+        """Chuyển một mẫu (đọc thẳng từ mảng cột của sample cache) thành dòng nén"""
+        has_ac = sample.has("ac")
+        has_mppt = sample.has("mppt")
+        has_error = sample.has("error")
+
+        kind = KIND_REALTIME if has_ac or has_mppt else KIND_ENERGY
+        ac_fields = sample.schema.keys["ac"] if has_ac else ()
+
+        mppt_blob = None
+        if has_mppt:
+            voltages = sample.values("mppt", "voltage")
+            flat = [None] * (2 * len(voltages))
+            flat[0::2] = voltages
+            flat[1::2] = sample.values("mppt", "current")
+            mppt_blob = _pack_floats(flat)
+
+        error: Dict[str, Any] = {}
+        fault_time = None
+        if has_error:
+            error = dict(zip(sample.schema.keys["error"], sample.record("error")))
+            fault_time = array("H", [U16_NONE if v is None else v for v in
+                                     (error.get(f"fault_time.{k}") for k in FAULT_TIME_FIELDS)]
+                               ).tobytes()
+
+        energy = None
+        if sample.has("energy"):
+            values = dict(zip(sample.schema.keys["energy"], sample.record("energy")))
+            energy = _pack_floats([values.get(k) for k in ENERGY_FIELDS], "d")
+
+        return (
+            inverter_id, ts, kind, ac_fields,
+            _pack_floats(sample.record("ac")) if has_ac else None,
+            mppt_blob,
+            _pack_floats(sample.values("strings", "current")) if sample.has("strings") else None,
+            error.get("work_state"),
+            error.get("fault_code"),
+            fault_time,
+            energy
+        )
+
+    def add_sample(self, inverter_id: int, ts: float, sample: Sample) -> bool:
+        """Thêm mẫu vào buffer; trả về True nếu buffer đã đầy cần flush"""
+        row = self._encode(inverter_id, ts, sample)
+        with self._lock:
+            self._buffer.append(row)
+            return len(self._buffer) >= self.batch_size
+
+    def add_rollup(self, tier: int, inverter_id: int, start: float, samples: int, fields: Tuple[str, ...],
+                   mean: List[float], low: List[float], high: List[float], last: List[float],
+                   delta: List[float]):
+        """Thêm một cửa sổ tổng hợp vào buffer (NaN: trường không có giá trị), ghi cùng lần flush kế tiếp"""
+        row = (tier, inverter_id, start, samples, fields) + tuple(
+            array("d", values).tobytes() for values in (mean, low, high, last, delta))
+        with self._lock:
+            self._rollups.append(row)
+
+    def add_plant(self, project_id: int, ts: float, snapshot: Dict[str, Any]):
+        """Thêm snapshot nhà máy vào buffer; chỉ lưu trạng thái của inverter không 'ok'"""
+        inverters = {k: v for k, v in snapshot.get("inverters", {}).items() if v != "ok"}
+        row = (project_id, ts) + tuple(snapshot.get(name) for name in PLANT_FIELDS) + (
+            json.dumps(inverters, separators=(",", ":")) if inverters else None,)
+        with self._lock:
+            self._plants.append(row)
+
+    def flush(self) -> int:
+        """Ghi toàn bộ buffer (mẫu, rollup, snapshot nhà máy) xuống DB trong một transaction"""
+        with self._lock:
+            if not self._buffer and not self._rollups and not self._plants:
+                return 0
+            rows, self._buffer = self._buffer, []
+            rollups, self._rollups = self._rollups, []
+            plants, self._plants = self._plants, []
+
+        try:
+            self._write(rows, rollups, plants)
+        except Exception:
+            # Ghi lỗi (đĩa đầy, DB bị khóa...): trả các dòng về đầu buffer để lần flush sau ghi lại
+            with self._lock:
+                self._buffer[:0] = rows
+                self._rollups[:0] = rollups
+                self._plants[:0] = plants
+                self._trim()
+            raise
+        self.rows_written += len(rows)
+        self.rollups_written += len(rollups)
+        self.plants_written += len(plants)
+        self.flushes += 1
+        return len(rows)
+
+    def _trim(self):
+        """Cắt các buffer về max_buffered, bỏ dòng cũ nhất (gọi khi đang giữ _lock)"""
+        for buffer in (self._buffer, self._rollups, self._plants):
+            excess = len(buffer) - self.max_buffered
+            if excess > 0:
+                del buffer[:excess]
+                self.dropped += excess
+                print(f"[LocalDB] ⚠️ Buffer đầy ({self.max_buffered} dòng), bỏ {excess} dòng cũ nhất")
+
+    def _write(self, rows: List[Tuple], rollups: List[Tuple], plants: List[Tuple]):
+        """Ghi một lô trong một transaction (lỗi thì rollback toàn bộ, kể cả layout mới)"""
+        with self._db_lock:
+            layouts = set(self._layouts)
+            try:
+                with self.conn:
+                    self.conn.executemany(
+                        "INSERT INTO samples (inverter_id, ts, kind, layout, ac, mppt, strings, "
+                        "work_state, fault_code, fault_time, energy) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        [(r[0], r[1], r[2], self._layout_id(r[3]) if r[3] else None) + r[4:] for r in rows]
+                    )
+                    # Mỗi cửa sổ chỉ ghi một lần (RollupEngine bỏ mẫu trễ); trùng mốc thì giữ dòng đã lưu
+                    self.conn.executemany(
+                        "INSERT OR IGNORE INTO rollups (tier, inverter_id, start, samples, layout, "
+                        "mean, low, high, last, delta) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        [r[:4] + (self._layout_id(r[4]),) + r[5:] for r in rollups]
+                    )
+                    self.conn.executemany(
+                        f"INSERT INTO plants (project_id, ts, {', '.join(PLANT_FIELDS)}, inverters) "
+                        f"VALUES ({', '.join('?' * (len(PLANT_FIELDS) + 3))})", plants
+                    )
+            except Exception:
+                # Layout vừa thêm trong transaction đã bị rollback: bỏ khỏi cache id
+                for fields in set(self._layouts) - layouts:
+                    self._layout_fields.pop(self._layouts.pop(fields), None)
+                raise
+
+    async def store(self, inverter_id: int, ts: float, sample: Sample):
+        """Callback cho collector: buffer mẫu, flush ở thread riêng khi đủ lô"""
+        if self.add_sample(inverter_id, ts, sample):
+            await asyncio.to_thread(self.flush)
+
+    async def store_plant(self, snapshot):
+        """Callback cho PlantAggregator: buffer snapshot, ghi cùng lần flush định kỳ"""
+        self.add_plant(snapshot.project_id, snapshot.ts, snapshot.to_dict())
+
+    async def run_flusher(self):
+        """Flush định kỳ và dọn dữ liệu cũ đã upload"""
+        last_prune = 0.0
+        try:
+            while True:
+                await asyncio.sleep(self.flush_interval)
+                try:
+                    await asyncio.to_thread(self.flush)
+                    if time.time() - last_prune > 3600:
+                        await asyncio.to_thread(self.prune)
+                        last_prune = time.time()
+                except Exception as e:
+                    self.errors += 1
+                    print(f"[LocalDB] ❌ Lỗi flush/prune, thử lại sau {self.flush_interval}s: {e}")
+        finally:
+            self.flush()
+
+    # ------------------------------------------------------------------
+    # Đọc / cursor upload
+    # ------------------------------------------------------------------
+    def decode_row(self, row: Tuple) -> Dict[str, Any]:
+        """Chuyển dòng DB về dạng dict giống output của driver"""
+        (row_id, inverter_id, ts, kind, layout, ac, mppt, strings,
+         work_state, fault_code, fault_time, energy) = row
+        sample: Dict[str, Any] = {"id": row_id, "inverter_id": inverter_id, "ts": ts}
+
+        if ac is not None:
+            sample["ac"] = dict(zip(self._layout_fields[layout], _unpack_floats(ac)))
+        if mppt is not None:
+            flat = _unpack_floats(mppt)
+            sample["mppt"] = [
+                {"mppt_index": i + 1, "voltage": flat[i * 2], "current": flat[i * 2 + 1]}
+                for i in range(len(flat) // 2)
+            ]
+        if strings is not None:
+            sample["strings"] = [
+                {"string_index": i + 1, "current": c} for i, c in enumerate(_unpack_floats(strings))
+            ]
+        if kind == KIND_REALTIME and (work_state is not None or fault_code is not None or fault_time):
+            ft = array("H")
+            if fault_time:
+                ft.frombytes(fault_time)
+            sample["error"] = {
+                "work_state": work_state,
+                "fault_time": {k: (None if v == U16_NONE else v) for k, v in zip(FAULT_TIME_FIELDS, ft)},
+                "fault_code": fault_code
+            }
+        if energy is not None:
+            sample["energy"] = dict(zip(ENERGY_FIELDS, _unpack_floats(energy, "d")))
+        return sample
+
+    def decode_rollup(self, row: Tuple) -> Dict[str, Any]:
+        """Chuyển dòng rollup về dict: mỗi thống kê là {trường: giá trị}, bỏ trường không có giá trị"""
+        row_id, tier, inverter_id, start, samples, layout = row[:6]
+        rollup: Dict[str, Any] = {"id": row_id, "tier": tier, "inverter_id": inverter_id, "start": start,
+                                  "samples": samples}
+        fields = self._layout_fields[layout]
+        for name, blob in zip(ROLLUP_STATS, row[6:]):
+            rollup[name] = {k: v for k, v in zip(fields, _unpack_floats(blob, "d")) if v is not None}
+        return rollup
+
+    def fetch_rollups(self, tier: int, inverter_id: Optional[int] = None, start: Optional[float] = None,
+                      end: Optional[float] = None, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Các cửa sổ của một tầng có start <= thời điểm bắt đầu < end, cũ nhất trước"""
+        query = "SELECT * FROM rollups WHERE tier = ?"
+        params: List[Any] = [tier]
+        if inverter_id is not None:
+            query += " AND inverter_id = ?"
+            params.append(inverter_id)
+        if start is not None:
+            query += " AND start >= ?"
+            params.append(start)
+        if end is not None:
+            query += " AND start < ?"
+            params.append(end)
+        query += " ORDER BY start, inverter_id"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        with self._db_lock:
+            rows = self.conn.execute(query, params).fetchall()
+        return [self.decode_rollup(r) for r in rows]
+
+    def latest_rollups(self, tier: int) -> List[Dict[str, Any]]:
+        """Cửa sổ mới nhất của một tầng cho từng inverter"""
+        with self._db_lock:
+            rows = self.conn.execute(
+                "SELECT * FROM rollups WHERE id IN "
+                "(SELECT MAX(id) FROM rollups WHERE tier = ? GROUP BY inverter_id)", (tier,)).fetchall()
+        return [self.decode_rollup(r) for r in rows]
+
+    def fetch_plants(self, project_id: int, start: Optional[float] = None, end: Optional[float] = None,
+                     limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Snapshot nhà máy của project có start <= ts < end, cũ nhất trước"""
+        query = "SELECT * FROM plants WHERE project_id = ?"
+        params: List[Any] = [project_id]
+        if start is not None:
+            query += " AND ts >= ?"
+            params.append(start)
+        if end is not None:
+            query += " AND ts < ?"
+            params.append(end)
+        query += " ORDER BY ts"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        with self._db_lock:
+            rows = self.conn.execute(query, params).fetchall()
+        plants = []
+        for row in rows:
+            plant = {"id": row[0], "project_id": row[1], "ts": row[2], **dict(zip(PLANT_FIELDS, row[3:-1]))}
+            plant["inverters"] = {int(k): v for k, v in json.loads(row[-1]).items()} if row[-1] else {}
+            plants.append(plant)
+        return plants
+
+    def get_cursor(self, name: str) -> int:
+        """Id dòng cuối cùng đã được xác nhận cho cursor"""
+        with self._db_lock:
+            row = self.conn.execute("SELECT last_id FROM cursors WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else 0
+
+    def ack(self, name: str, last_id: int):
+        """Xác nhận đã xử lý (upload) đến id này"""
+        with self._db_lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO cursors (name, last_id) VALUES (?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET last_id = MAX(last_id, excluded.last_id)",
+                (name, last_id)
+            )
+
+    def set_cursor(self, name: str, last_id: int):
+        """Ghi đè giá trị cursor (dùng cho trạng thái nội bộ của consumer)"""
+        with self._db_lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO cursors (name, last_id) VALUES (?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET last_id = excluded.last_id",
+                (name, last_id)
+            )
+
+    def fetch_pending(self, name: str, limit: int = 500) -> List[Dict[str, Any]]:
+        """Lấy các mẫu chưa xử lý theo cursor (cũ nhất trước)"""
+        return self.fetch_range(self.get_cursor(name), None, limit)
+
+    def fetch_range(self, after_id: int, until_id: Optional[int] = None, limit: int = 500,
+                    newest_first: bool = False) -> List[Dict[str, Any]]:
+        """Lấy các mẫu có after_id < id <= until_id"""
+        query = "SELECT * FROM samples WHERE id > ?"
+        params: List[Any] = [after_id]
+        if until_id is not None:
+            query += " AND id <= ?"
+            params.append(until_id)
+        query += " ORDER BY id DESC LIMIT ?" if newest_first else " ORDER BY id LIMIT ?"
+        params.append(limit)
+        with self._db_lock:
+            rows = self.conn.execute(query, params).fetchall()
+        return [self.decode_row(r) for r in rows]
+
+    def last_id(self) -> int:
+        """Id lớn nhất đã ghi xuống DB"""
+        with self._db_lock:
+            row = self.conn.execute("SELECT MAX(id) FROM samples").fetchone()
+        return row[0] or 0
+
+    def pending_count(self, name: str) -> int:
+        """Số mẫu chưa xử lý theo cursor"""
+        return self.count_range(self.get_cursor(name))
+
+    def count_range(self, after_id: int, until_id: Optional[int] = None) -> int:
+        """Số mẫu có after_id < id <= until_id"""
+        query = "SELECT COUNT(*) FROM samples WHERE id > ?"
+        params: List[Any] = [after_id]
+        if until_id is not None:
+            query += " AND id <= ?"
+            params.append(until_id)
+        with self._db_lock:
+            return self.conn.execute(query, params).fetchone()[0]
+
+    def prune(self) -> int:
+        """Xóa mẫu cũ hơn retention_days đã được mọi cursor xác nhận"""
+        cutoff = time.time() - self.retention_days * 86400
+        with self._db_lock, self.conn:
+            row = self.conn.execute("SELECT MIN(last_id) FROM cursors").fetchone()
+            if row[0] is None:
+                # Không có consumer nào đăng ký cursor: chỉ xóa theo tuổi
+                cur = self.conn.execute("DELETE FROM samples WHERE ts < ?", (cutoff,))
+            else:
+                cur = self.conn.execute("DELETE FROM samples WHERE ts < ? AND id <= ?", (cutoff, row[0]))
+        if cur.rowcount:
+            print(f"[LocalDB] 🧹 Đã xóa {cur.rowcount} mẫu cũ")
+        deleted = cur.rowcount
+
+        with self._db_lock, self.conn:
+            cur = self.conn.execute("DELETE FROM plants WHERE ts < ?", (cutoff,))
+        if cur.rowcount:
+            print(f"[LocalDB] 🧹 Đã xóa {cur.rowcount} snapshot nhà máy cũ")
+
+        # Rollup: retention riêng từng tầng (không phụ thuộc cursor upload)
+        for tier, days in self.rollup_retention.items():
+            with self._db_lock, self.conn:
+                cur = self.conn.execute("DELETE FROM rollups WHERE tier = ? AND start < ?",
+                                        (tier, time.time() - days * 86400))
+            if cur.rowcount:
+                print(f"[LocalDB] 🧹 Đã xóa {cur.rowcount} rollup {tier}s cũ")
+        return deleted
+
+    def get_stats(self) -> Dict:
+        """Thống kê của store"""
+        with self._lock:
+            buffered = len(self._buffer)
+        return {
+            "path": self.path,
+            "buffered": buffered,
+            "rows_written": self.rows_written,
+            "rollups_written": self.rollups_written,
+            "plants_written": self.plants_written,
+            "flushes": self.flushes,
+            "errors": self.errors,
+            "dropped": self.dropped
+        }
+
+    def close(self):
+        """Flush buffer và đóng DB"""
+        self.flush()
+        with self._db_lock:
+            self.conn.close()
@@ -0,0 +1,312 @@
+"""
+Rollup - Tổng hợp dần mẫu thành các tầng 1 phút / 15 phút / ngày
+- Mỗi inverter giữ cửa sổ đang mở của từng tầng; mẫu chỉ cộng vào tầng nhỏ nhất,
+  cửa sổ đóng được gộp lên tầng kế (1 phút -> 15 phút -> ngày): không quét lại dữ liệu thô
+- Trường đo (AC, MPPT, string): min/max/mean/last; trạng thái (error): last;
+  bộ đếm (energy): last và sản lượng tăng thêm trong cửa sổ (delta, tính cả khi bộ đếm reset đầu ngày)
+- Cửa sổ căn theo giờ địa phương: tầng ngày bắt đầu lúc 0h
+- Ghi vào bảng rollups của local DB, retention riêng từng tầng (dữ liệu thô chỉ cần giữ vài ngày)
+- Khởi động lại: cửa sổ đang mở của tầng trên được dựng lại từ các dòng tầng dưới đã ghi,
+  delta bộ đếm nối tiếp từ giá trị cuối đã ghi
+- Mẫu đến trễ cho cửa sổ đã ghi (vd sau khi close_idle đóng cửa sổ) bị bỏ và đếm,
+  không mở lại cửa sổ cùng mốc bắt đầu để ghi đè dòng đã lưu
+"""
+import asyncio
+import math
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+from storage.cache import Sample, SampleSchema
+from storage.local_db import LocalDB
+
+STATE_GROUPS = ("error",)     # Chỉ giữ giá trị cuối
+COUNTER_GROUPS = ("energy",)  # Bộ đếm tăng dần: giá trị cuối + delta
+
+KIND_MEASURE = 0
+KIND_STATE = 1
+KIND_COUNTER = 2
+
+NAN = math.nan
+
+
+@dataclass
+class Tier:
+    """Một tầng tổng hợp"""
+    name: str
+    window: int                 # Độ dài cửa sổ (giây), cũng là id tầng trong DB
+    retention_days: float
+
+
+DEFAULT_TIERS = [
+    Tier("1m", 60, 30),
+    Tier("15m", 900, 730),
+    Tier("1d", 86400, 3650),
+]
+
+
+def window_start(ts: float, size: int) -> float:
+    """Đầu cửa sổ chứa ts, căn theo giờ địa phương"""
+    offset = time.localtime(ts).tm_gmtoff
+    return ts - (ts + offset) % size
+
+
+class Window:
+    """Cửa sổ đang mở: thống kê của từng trường theo thứ tự layout của inverter"""
+    __slots__ = ("start", "end", "samples", "count", "total", "low", "high", "last", "delta")
+
+    def __init__(self, start: float, size: int, fields: int):
+        self.start = start
+        self.end = start + size
+        self.samples = 0
+        self.count = [0] * fields
+        self.total = [0.0] * fields
+        self.low = [math.inf] * fields
+        self.high = [-math.inf] * fields
+        self.last = [NAN] * fields
+        self.delta = [NAN] * fields
+
+    def merge(self, other: "Window"):
+        """Gộp cửa sổ tầng dưới (đã đóng, mới hơn các cửa sổ đã gộp trước đó)"""
+        self.samples += other.samples
+        for i, n in enumerate(other.count):
+            if n:
+                self.count[i] += n
+                self.total[i] += other.total[i]
+                if other.low[i] < self.low[i]:
+                    self.low[i] = other.low[i]
+                if other.high[i] > self.high[i]:
+                    self.high[i] = other.high[i]
+        for i, value in enumerate(other.last):
+            if value == value:  # Không phải NaN
+                self.last[i] = value
+        for i, value in enumerate(other.delta):
+            if value == value:
+                self.delta[i] = value if self.delta[i] != self.delta[i] else self.delta[i] + value
+
+    def stats(self) -> Tuple[List[float], List[float], List[float]]:
+        """mean, min, max (NaN nếu trường không có giá trị trong cửa sổ)"""
+        mean = [t / n if n else NAN for t, n in zip(self.total, self.count)]
+        low = [v if n else NAN for v, n in zip(self.low, self.count)]
+        high = [v if n else NAN for v, n in zip(self.high, self.count)]
+        return mean, low, high
+
+
+class InverterRollup:
+    """Layout trường và các cửa sổ đang mở của một inverter"""
+
+    def __init__(self, inverter_id: int, schema: SampleSchema, tiers: int):
+        self.inverter_id = inverter_id
+        self.schema = schema
+        names: List[str] = []
+        self.kinds: List[int] = []
+        self.offsets: Dict[str, int] = {}  # Nhóm -> vị trí trường đầu tiên trong layout
+        for group in schema.groups:
+            kind = KIND_STATE if group in STATE_GROUPS else KIND_COUNTER if group in COUNTER_GROUPS \
+                else KIND_MEASURE
+            self.offsets[group] = len(names)
+            names.extend(schema.value_keys[group])
+            self.kinds.extend([kind] * len(schema.value_keys[group]))
+        self.fields: Tuple[str, ...] = tuple(names)
+        self.index = {name: i for i, name in enumerate(names)}
+        self.windows: List[Optional[Window]] = [None] * tiers
+        self.previous: List[Optional[float]] = [None] * len(names)  # Giá trị bộ đếm lần trước
+        self.written_until = 0.0  # Cuối cửa sổ tầng nhỏ nhất đã ghi: mẫu cũ hơn mốc này là mẫu trễ
+
+
+class RollupEngine:
+    """Consumer mẫu: tổng hợp tăng dần và ghi các tầng vào local DB"""
+
+    def __init__(self, db: LocalDB, tiers: Optional[List[Tier]] = None, grace: float = 30):
+        self.db = db
+        self.tiers = sorted(tiers or DEFAULT_TIERS, key=lambda t: t.window)
+        self.grace = grace          # Đóng cửa sổ khi không có mẫu mới quá grace giây sau cuối cửa sổ
+        self.inverters: Dict[int, InverterRollup] = {}
+        self._restore: Optional[Dict[int, Dict[str, Any]]] = None
+
+        # Đăng ký retention từng tầng để local DB dọn cùng lần prune
+        for tier in self.tiers:
+            self.db.rollup_retention[tier.window] = tier.retention_days
+
+        # Thống kê
+        self.samples = 0
+        self.late = 0               # Mẫu bị bỏ do cửa sổ của nó đã ghi
+        self.closed = {tier.name: 0 for tier in self.tiers}
+        self.restored = 0
+
+    # ------------------------------------------------------------------
+    # Nhận mẫu
+    # ------------------------------------------------------------------
+    def _state(self, inverter_id: int, sample: Sample) -> InverterRollup:
+        state = self.inverters.get(inverter_id)
+        if state is None or state.schema is not sample.schema:
+            state = self.inverters[inverter_id] = InverterRollup(inverter_id, sample.schema, len(self.tiers))
+            if self._restore is not None:
+                self._apply_restore(state, self._restore.get(inverter_id))
+        return state
+
+    def add(self, inverter_id: int, sample: Sample):
+        """Cộng một mẫu vào cửa sổ nhỏ nhất (đóng và gộp lên các tầng trên nếu đã hết cửa sổ)"""
+        state = self._state(inverter_id, sample)
+        ts = sample.ts
+        window = state.windows[0]
+        if ts < state.written_until or (window is not None and ts < window.start):
+            # Cửa sổ của mẫu đã ghi và đã gộp lên tầng trên: không thể cộng thêm
+            self.late += 1
+            return
+        if window is None or ts >= window.end:
+            if window is not None:
+                self._close(state, 0)
+            window = self._open(state, 0, ts)
+
+        window.samples += 1
+        count, total, low, high, last, delta = (window.count, window.total, window.low, window.high,
+                                                window.last, window.delta)
+        kinds, previous = state.kinds, state.previous
+        for group in sample:
+            if not sample.has(group):
+                continue
+            i = state.offsets[group]
+            for value in sample.flat_values(group):
+                if value is not None:
+                    kind = kinds[i]
+                    if kind == KIND_MEASURE:
+                        count[i] += 1
+                        total[i] += value
+                        if value < low[i]:
+                            low[i] = value
+                        if value > high[i]:
+                            high[i] = value
+                    elif kind == KIND_COUNTER:
+                        before = previous[i]
+                        if before is not None:
+                            # Bộ đếm giảm = reset (đầu ngày/tháng): phần tăng là chính giá trị mới
+                            step = value - before if value >= before else value
+                            delta[i] = step if delta[i] != delta[i] else delta[i] + step
+                        previous[i] = value
+                    last[i] = value
+                i += 1
+        self.samples += 1
+
+    async def on_sample(self, inverter_id: int, ts: float, sample: Sample):
+        """Callback cho collector"""
+        self.add(inverter_id, sample)
+
+    def _open(self, state: InverterRollup, level: int, ts: float) -> Window:
+        size = self.tiers[level].window
+        window = state.windows[level] = Window(window_start(ts, size), size, len(state.fields))
+        return window
+
+    def _close(self, state: InverterRollup, level: int):
+        """Ghi cửa sổ của một tầng và gộp nó vào cửa sổ tầng trên"""
+        window = state.windows[level]
+        state.windows[level] = None
+        if window is None or not window.samples:
+            return
+        if level == 0:
+            state.written_until = window.end
+        tier = self.tiers[level]
+        mean, low, high = window.stats()
+        self.db.add_rollup(tier.window, state.inverter_id, window.start, window.samples, state.fields,
+                           mean, low, high, window.last, window.delta)
+        self.closed[tier.name] += 1
+
+        if level + 1 < len(self.tiers):
+            upper = state.windows[level + 1]
+            if upper is not None and window.start >= upper.end:
+                self._close(state, level + 1)
+                upper = None
+            if upper is None:
+                upper = self._open(state, level + 1, window.start)
+            upper.merge(window)
+
+    def close_idle(self, now: Optional[float] = None) -> int:
+        """Đóng các cửa sổ đã hết hạn grace giây mà không có mẫu mới (inverter offline, ban đêm)"""
+        now = time.time() if now is None else now
+        closed = 0
+        for state in list(self.inverters.values()):
+            for level in range(len(self.tiers)):  # Tầng nhỏ trước: gộp lên trước khi tầng trên đóng
+                window = state.windows[level]
+                if window is not None and now >= window.end + self.grace:
+                    self._close(state, level)
+                    closed += 1
+        return closed
+
+    # ------------------------------------------------------------------
+    # Khởi động lại
+    # ------------------------------------------------------------------
+    def load_restore(self, now: Optional[float] = None) -> Dict[int, Dict[str, Any]]:
+        """Đọc từ DB các dòng tầng dưới thuộc cửa sổ đang mở của mỗi tầng trên, và bộ đếm cuối"""
+        now = time.time() if now is None else now
+        restore: Dict[int, Dict[str, Any]] = {}
+        for level in range(1, len(self.tiers)):
+            start = window_start(now, self.tiers[level].window)
+            for row in self.db.fetch_rollups(self.tiers[level - 1].window, start=start):
+                entry = restore.setdefault(row["inverter_id"], {"levels": {}, "latest": None})
+                entry["levels"].setdefault(level, []).append(row)
+        for row in self.db.latest_rollups(self.tiers[0].window):
+            restore.setdefault(row["inverter_id"], {"levels": {}, "latest": None})["latest"] = row
+        return restore
+
+    def _apply_restore(self, state: InverterRollup, entry: Optional[Dict[str, Any]]):
+        if not entry:
+            return
+        latest = entry["latest"]
+        if latest:
+            state.written_until = max(state.written_until, latest["start"] + self.tiers[0].window)
+            for name, value in latest["last"].items():
+                i = state.index.get(name)
+                if i is not None and state.kinds[i] == KIND_COUNTER and state.previous[i] is None:
+                    state.previous[i] = value
+        for level, rows in sorted(entry["levels"].items()):
+            size = self.tiers[level].window
+            for row in rows:
+                window = state.windows[level]
+                if window is None:
+                    window = state.windows[level] = Window(window_start(row["start"], size), size,
+                                                           len(state.fields))
+                window.merge(self._window_from_row(state, row))
+                self.restored += 1
+
+    def _window_from_row(self, state: InverterRollup, row: Dict[str, Any]) -> Window:
+        """Dựng lại cửa sổ từ dòng DB (mean được coi là trung bình của tất cả mẫu trong cửa sổ)"""
+        window = Window(row["start"], self.tiers[0].window, len(state.fields))
+        window.samples = samples = row["samples"]
+        for name, mean in row["mean"].items():
+            i = state.index.get(name)
+            if i is not None:
+                window.count[i] = samples
+                window.total[i] = mean * samples
+                window.low[i] = row["min"].get(name, mean)
+                window.high[i] = row["max"].get(name, mean)
+        for stat, target in (("last", window.last), ("delta", window.delta)):
+            for name, value in row[stat].items():
+                i = state.index.get(name)
+                if i is not None:
+                    target[i] = value
+        return window
+
+    async def run(self):
+        """Dựng lại cửa sổ đang mở từ DB, sau đó định kỳ đóng cửa sổ của inverter không còn gửi mẫu"""
+        restore = await asyncio.to_thread(self.load_restore)
+        for inverter_id, state in self.inverters.items():
+            # Mẫu đến trước khi đọc xong DB: gộp phần đã ghi vào cửa sổ hiện tại
+            self._apply_restore(state, restore.get(inverter_id))
+        self._restore = restore
+        if restore:
+            print(f"[Rollup] ♻️ Dựng lại cửa sổ đang mở của {len(restore)} inverter từ {self.restored} dòng")
+        while True:
+            await asyncio.sleep(max(self.grace / 2, 1))
+            self.close_idle()
+
+    def get_stats(self) -> Dict:
+        """Số mẫu đã tổng hợp và số cửa sổ đã đóng theo tầng"""
+        return {
+            "tiers": {tier.name: {"window": tier.window, "retention_days": tier.retention_days}
+                      for tier in self.tiers},
+            "inverters": len(self.inverters),
+            "samples": self.samples,
+            "late": self.late,
+            "closed": dict(self.closed),
+            "restored": self.restored
+        }
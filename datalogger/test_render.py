@@ -41,7 +41,8 @@ def main():
         print("📊 MPPT của 3 inverter Sungrow SG110CX (ID: 1, 2, 3)")
         print("=" * 60)
         sg110_ids = [1, 2, 3]
-        sg110_mppts = [m for m in mppts if m["inverter_id"] in sg110_ids]
+        index = config["index"]
+        sg110_mppts = [m for inverter_id in sg110_ids for m in index["mppt_by_inverter"].get(inverter_id, [])]
         print(f"Tổng cộng: {len(sg110_mppts)} MPPT")
         for m in sg110_mppts:
             print(f"  • MPPT ID={m['id']}, Inverter={m['inverter_id']}, MPPT Index={m['mppt_index']}, Max_P={m['Max_P']}W")
@@ -70,7 +71,7 @@ def main():
         print("\n" + "=" * 60)
         print("🔗 STRINGS của inverter 1")
         print("=" * 60)
-        inverter_1_strings = [s for s in strings if s.get("inverter_id") == 1]
+        inverter_1_strings = index["strings_by_inverter"].get(1, [])
         print(f"Tổng cộng: {len(inverter_1_strings)} strings")
         for s in inverter_1_strings:
             print(f"  • String ID={s['id']}, MPPT={s['mppt_id']},INV={s.get('inverter_id', 'N/A')}, Max_P={s.get('Max_P', 'N/A')}W")
@@ -78,7 +79,7 @@ def main():
         print("\n" + "=" * 60)
         print("🔗 STRINGS của inverter 4")
         print("=" * 60)
-        inverter_4_strings = [s for s in strings if s.get("inverter_id") == 4]
+        inverter_4_strings = index["strings_by_inverter"].get(4, [])
         print(f"Tổng cộng: {len(inverter_4_strings)} strings")
         for s in inverter_4_strings:
             print(f"  • String ID={s['id']}, MPPT={s['mppt_id']},INV={s.get('inverter_id', 'N/A')}, Max_P={s.get('Max_P', 'N/A')}W")
@@ -0,0 +1,8 @@
+"""
+Cấu hình pytest
+- Các module của datalogger được import như khi chạy main.py (engine, storage, transport... ở top-level)
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
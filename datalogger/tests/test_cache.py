@@ -0,0 +1,44 @@
+"""
+Test SampleRing / SampleCache
+- Ring ghi đè mẫu cũ nhất khi đầy
+- latest(group): bỏ qua mẫu chỉ có sản lượng khi cần mẫu realtime
+"""
+from engine.mapper import get_register_map
+from storage.cache import SampleCache
+
+
+def make_ring(hours=1, interval=5):
+    cmap = get_register_map("sungrow_sg").compile(mppt_count=2, string_count=4)
+    cache = SampleCache(hours=hours, interval=interval)
+    return cache, cache.ring(1, cmap), cmap
+
+
+def append(ring, cmap, ts, groups, value=100):
+    decoder = cmap.decoder(groups)
+    return ring.append(ts, decoder, [[value] * layout.count for layout in decoder.layouts])
+
+
+def test_ring_overwrites_oldest():
+    cache, ring, cmap = make_ring(hours=1, interval=1200)  # 3 hàng
+    samples = [append(ring, cmap, ts, ["ac"]) for ts in range(5)]
+
+    assert len(ring) == 3
+    assert [s.ts for s in ring] == [2, 3, 4]
+    assert samples[0].stale and not samples[-1].stale
+    assert [s.ts for s in ring.since(3)] == [3, 4]
+
+
+def test_latest_by_group():
+    cache, ring, cmap = make_ring()
+    append(ring, cmap, 1, ["ac", "mppt", "error"], value=100)
+    append(ring, cmap, 2, ["energy"])
+
+    assert cache.latest(1).ts == 2
+    assert not cache.latest(1).has("ac")
+
+    realtime = cache.latest(1, "ac")
+    assert realtime.ts == 1
+    assert realtime.value("ac", "voltage_ab") == 10.0
+    assert cache.latest(1, "energy").ts == 2
+    assert cache.latest(1, "strings") is None
+    assert cache.latest(2, "ac") is None
@@ -0,0 +1,135 @@
+"""
+Test ModbusWriter với bộ mô phỏng RTU qua loopback TCP
+- Lệnh ghi chen trước các chu kỳ đọc đang xếp hàng trên bus
+- Lệnh mới cho cùng inverter + điểm thay thế lệnh chưa chạy, chỉ một frame ghi
+- Ghi xong đọc lại để xác nhận: slave không áp dụng giá trị -> verify_failed sau khi thử lại
+- Điểm ngoài control.points hoặc inverter đã bị gỡ -> rejected; breaker đang ngắt không chặn lệnh ghi
+"""
+import asyncio
+import contextlib
+import time
+
+from control.modbus_writer import (PRIORITY_GRID, STATUS_MISMATCH, STATUS_OK, STATUS_REJECTED,
+                                   STATUS_SUPERSEDED, ModbusWriter)
+from drivers.base import MappedDriver
+from modbus.bus import BusWorker
+from modbus.health import CLOSED, OPEN
+from simulator.fleet import SimulatedFleet
+
+BAUDRATE = 38400
+
+
+@contextlib.asynccontextmanager
+async def simulated_plant(inverters: int = 1, retries: int = 2, points=None):
+    """Các inverter giả lập trên một bus và writer trỏ vào driver của chúng"""
+    fleet = SimulatedFleet(inverters, per_bus=inverters, baudrate=BAUDRATE, turnaround=0.005)
+    await fleet.start_tcp()
+    server = fleet.buses[0]
+    bus = BusWorker(server.port, baudrate=BAUDRATE, timeout=0.5)
+    targets = {}
+    for config in fleet.inverter_configs():
+        driver = MappedDriver(bus, config["slave_id"], "sungrow_sg",
+                              mppt_count=config["mppt_count"], string_count=config["string_count"])
+        targets[config["id"]] = (bus, driver)
+    writer = ModbusWriter(retries=retries, resolve=targets.get, points=points)
+    try:
+        yield server, bus, targets, writer
+    finally:
+        bus.stop()
+        fleet.stop()
+
+
+def test_write_preempts_queued_polling():
+    async def main():
+        async with simulated_plant(4) as (server, bus, targets, writer):
+            # Hai chu kỳ realtime của cả 4 inverter xếp hàng trên bus (~0.7 s)
+            reads = [asyncio.ensure_future(bus.run(driver.slave_id, driver.read_frames, driver.realtime_decoder))
+                     for _ in range(2) for _, driver in targets.values()]
+            while not bus.frames:
+                await asyncio.sleep(0.005)
+
+            result = await writer.submit(3, "power_limit", 40, PRIORITY_GRID)
+
+            assert result.status == STATUS_OK
+            assert sum(task.done() for task in reads) < len(reads) // 2
+            assert bus.preemptions >= 1
+            assert server.inverters[3].setpoint("power_limit") == 40
+            # Điểm ghi kèm trong cùng frame FC16
+            assert server.inverters[3].setpoint("power_limit_switch") == 0xAA
+            await asyncio.gather(*reads)
+
+    asyncio.run(main())
+
+
+def test_newer_setpoint_supersedes_pending():
+    async def main():
+        async with simulated_plant() as (server, bus, targets, writer):
+            futures = [writer.submit(1, "power_limit", value) for value in (10, 20, 30)]
+            results = await asyncio.gather(*futures)
+
+            assert [r.status for r in results] == [STATUS_SUPERSEDED, STATUS_SUPERSEDED, STATUS_OK]
+            assert server.inverters[1].writes == 1
+            assert server.inverters[1].setpoint("power_limit") == 30
+
+    asyncio.run(main())
+
+
+def test_read_back_verify():
+    async def main():
+        async with simulated_plant(retries=1) as (server, bus, targets, writer):
+            inverter = server.inverters[1]
+            result = await writer.submit(1, "power_limit", 55)
+            assert result.status == STATUS_OK
+            assert result.attempts == 1
+
+            # Slave trả lời FC16 nhưng không áp dụng giá trị: đọc lại phát hiện, thử lại rồi báo lỗi
+            inverter.write = lambda address, values: None
+            result = await writer.submit(1, "power_limit", 70)
+            assert result.status == STATUS_MISMATCH
+            assert result.attempts == 2
+            assert inverter.setpoint("power_limit") == 55
+
+    asyncio.run(main())
+
+
+def test_points_allow_list():
+    async def main():
+        async with simulated_plant(points=["power_limit"]) as (server, bus, targets, writer):
+            result = await writer.submit(1, "start_stop", 0xCE)
+            assert result.status == STATUS_REJECTED
+            assert "control.points" in result.error
+            assert server.inverters[1].writes == 0
+
+            assert (await writer.submit(1, "power_limit", 30)).status == STATUS_OK
+
+    asyncio.run(main())
+
+
+def test_inverter_removed_while_pending():
+    async def main():
+        async with simulated_plant() as (server, bus, targets, writer):
+            future = writer.submit(1, "power_limit", 30)
+            del targets[1]  # Nạp lại cấu hình gỡ inverter trước khi lệnh đến lượt
+
+            result = await future
+            assert result.status == STATUS_REJECTED
+            assert server.inverters[1].writes == 0
+            # Lệnh sau vẫn được xử lý (vòng drain không chết)
+            assert (await writer.submit(1, "power_limit", 30)).status == STATUS_REJECTED
+
+    asyncio.run(main())
+
+
+def test_write_probes_open_breaker():
+    async def main():
+        async with simulated_plant() as (server, bus, targets, writer):
+            link = bus._link(1)
+            link.state, link.opened_at, link.cooldown = OPEN, time.monotonic(), 60
+
+            result = await writer.submit(1, "power_limit", 30)
+            assert result.status == STATUS_OK
+            assert server.inverters[1].setpoint("power_limit") == 30
+            # Slave trả lời frame thử: breaker đóng lại cho polling
+            assert link.state == CLOSED
+
+    asyncio.run(main())
@@ -0,0 +1,101 @@
+"""
+Test MappedDriver + BusWorker với bộ mô phỏng RTU qua loopback TCP
+- Một chu kỳ realtime đúng số frame của kế hoạch đọc, thanh ghi và giá trị decode khớp với slave
+- Timeout / CRC được chèn ở simulator: đọc lại trong retry budget, circuit breaker ngắt slave lỗi
+"""
+import asyncio
+import contextlib
+import time
+
+import pytest
+
+from drivers.base import MappedDriver
+from modbus.bus import BusWorker, RETRYABLE
+from modbus.health import OPEN
+from simulator.fleet import SimulatedFleet
+
+BAUDRATE = 115200
+
+
+@contextlib.asynccontextmanager
+async def simulated_bus(timeout_rate: float = 0.0, crc_error_rate: float = 0.0, **bus_options):
+    """Một inverter SG110CX giả lập và bus + driver đọc nó"""
+    fleet = SimulatedFleet(1, baudrate=BAUDRATE, turnaround=0.002, timeout_rate=timeout_rate,
+                           crc_error_rate=crc_error_rate, seed=1)
+    await fleet.start_tcp()
+    config = fleet.inverter_configs()[0]
+    bus = BusWorker(config["port"], baudrate=BAUDRATE, timeout=0.2, **bus_options)
+    driver = MappedDriver(bus, config["slave_id"], "sungrow_sg",
+                          mppt_count=config["mppt_count"], string_count=config["string_count"])
+    try:
+        yield fleet.buses[0], bus, driver
+    finally:
+        bus.stop()
+        fleet.stop()
+
+
+async def read_realtime(bus: BusWorker, driver: MappedDriver):
+    return await bus.run(driver.slave_id, driver.read_frames, driver.realtime_decoder)
+
+
+def test_realtime_frames_and_values():
+    async def main():
+        async with simulated_bus() as (server, bus, driver):
+            inverter = server.inverters[driver.slave_id]
+            inverter.refresh = 3600  # Giữ nguyên giá trị trong suốt lần đọc
+            inverter.inject_fault(532)
+
+            frames = await read_realtime(bus, driver)
+
+            layouts = driver.realtime_decoder.layouts
+            assert len(frames) == len(layouts)
+            assert bus.frames == server.requests == len(layouts)
+            assert bus.errors == 0
+            for layout, registers in zip(layouts, frames):
+                start = layout.start + driver.map.address_offset
+                assert registers == [inverter.input.get(a, 0) for a in range(start, start + layout.count)]
+
+            data = driver.realtime_decoder.decode(frames)
+            assert data["error"]["fault_code"] == 532
+            assert data["error"]["work_state"] == 0x5500
+            assert data["ac"]["power"] == 0
+            assert len(data["mppt"]) == 9
+            assert len(data["strings"]) == 18
+            assert data["energy"]["energy_total_kwh"] == pytest.approx(inverter.energy_total_kwh, abs=0.1)
+
+    asyncio.run(main())
+
+
+def test_timeouts_trip_circuit_breaker():
+    async def main():
+        async with simulated_bus(timeout_rate=1.0) as (server, bus, driver):
+            frames = await read_realtime(bus, driver)
+
+            assert frames == [None] * len(driver.realtime_decoder.layouts)
+            assert set(bus.error_kinds) <= set(RETRYABLE)
+            # Frame đầu được đọc lại một lần; lỗi thứ ba liên tiếp ngắt breaker, frame còn lại không gửi
+            assert bus.retries == 1
+            assert bus.frames == server.requests == server.timeouts == 3
+            assert bus.links[driver.slave_id].state == OPEN
+
+            # Breaker đang ngắt: chu kỳ sau trả về ngay, không chiếm bus
+            started = time.monotonic()
+            assert await read_realtime(bus, driver) == [None] * len(frames)
+            assert time.monotonic() - started < 0.1
+            assert server.requests == 3
+
+    asyncio.run(main())
+
+
+def test_crc_errors_are_retried():
+    async def main():
+        async with simulated_bus(crc_error_rate=1.0, breaker_failures=100) as (server, bus, driver):
+            frames = await read_realtime(bus, driver)
+
+            layouts = len(driver.realtime_decoder.layouts)
+            assert frames == [None] * layouts
+            assert bus.error_kinds == {"crc": 2 * layouts}
+            assert bus.retries == layouts
+            assert bus.frames == server.requests == server.crc_errors == 2 * layouts
+
+    asyncio.run(main())
@@ -0,0 +1,128 @@
+"""
+Test SlaveLink và RetryBudget
+- Circuit breaker: ngắt sau breaker_failures frame lỗi liên tiếp, frame trả về ngay trong cooldown
+- Half-open: hết cooldown cho một frame thử; thành công thì đóng, lỗi thì gấp đôi cooldown (có trần)
+- Frame thử bắt buộc (probe) bỏ qua cooldown
+- timeout_for: dùng trần timeout khi chưa đủ mẫu, sau đó kẹp trong [timeout_min, timeout]
+- Retry budget: hết token thì từ chối retry, mỗi frame nạp lại ratio token
+"""
+import pytest
+
+from modbus.health import CLOSED, HALF_OPEN, MIN_SAMPLES, OPEN, RetryBudget, SlaveLink
+
+
+def make_link(**options) -> SlaveLink:
+    options = {"breaker_failures": 3, "breaker_cooldown": 10, "breaker_max_cooldown": 30, **options}
+    return SlaveLink("COM3", 1, **options)
+
+
+def trip(link: SlaveLink, now: float):
+    for _ in range(link.breaker_failures):
+        assert link.allow(now)
+        link.failure(now)
+
+
+def test_trips_after_consecutive_failures():
+    link = make_link()
+    link.failure(0)
+    link.failure(0)
+    link.success(0.05, 0.01)  # Trả lời xen giữa: đếm lại từ đầu
+    link.failure(0)
+    link.failure(0)
+    assert link.state == CLOSED
+
+    link.failure(0)
+    assert link.state == OPEN
+    assert link.trips == 1
+    assert not link.allow(5)
+    assert link.short_circuited == 1
+
+
+def test_half_open_after_cooldown_closes_on_success():
+    link = make_link()
+    trip(link, now=100)
+
+    assert not link.allow(109.9)
+    assert link.allow(110)
+    assert link.state == HALF_OPEN
+
+    link.success(0.05, 0.01)
+    assert link.state == CLOSED
+    assert link.consecutive_failures == 0
+    assert link.cooldown == 10
+
+
+def test_failed_probe_doubles_cooldown_up_to_max():
+    link = make_link()
+    trip(link, now=0)
+
+    now = 0
+    for expected in (20, 30, 30):
+        now += link.cooldown
+        assert link.allow(now)
+        link.failure(now)
+        assert link.state == OPEN
+        assert link.cooldown == expected
+        assert link.opened_at == now
+    assert link.trips == 4
+
+    # Thành công sau đó trả cooldown về giá trị ban đầu
+    assert link.allow(now + link.cooldown)
+    link.success(0.05, 0.01)
+    assert link.cooldown == 10
+
+
+def test_probe_bypasses_cooldown():
+    link = make_link()
+    trip(link, now=0)
+
+    assert not link.allow(1)
+    assert link.allow(1, probe=True)
+    assert link.state == HALF_OPEN
+    assert link.short_circuited == 1
+
+
+def test_timeout_for_clamped_after_enough_samples():
+    link = make_link(timeout=1.0, timeout_min=0.1, timeout_factor=3.0)
+    for _ in range(MIN_SAMPLES - 1):
+        link.success(0.02, 0.01)
+    assert link.timeout_for(0.01) == 1.0  # Chưa đủ mẫu: chờ đủ trần
+
+    link.success(0.02, 0.01)
+    assert link.timeout_for(0.01) == 0.1  # 0.01 + 3 × 0.01 < timeout_min
+    assert link.last_timeout == 0.1
+
+    slow = make_link(timeout=1.0, timeout_min=0.1, timeout_factor=3.0)
+    for _ in range(MIN_SAMPLES):
+        slow.success(0.51, 0.01)
+    assert slow.timeout_for(0.01) == 1.0  # 0.01 + 3 × 0.5 > timeout
+
+    medium = make_link(timeout=1.0, timeout_min=0.1, timeout_factor=3.0)
+    for _ in range(MIN_SAMPLES):
+        medium.success(0.11, 0.01)
+    assert medium.timeout_for(0.02) == pytest.approx(0.32)
+
+
+def test_timeout_for_uses_ceiling_when_not_closed():
+    link = make_link(timeout=1.0, timeout_min=0.1)
+    for _ in range(MIN_SAMPLES):
+        link.success(0.02, 0.01)
+    trip(link, now=0)
+    assert link.allow(link.cooldown)
+    assert link.timeout_for(0.01) == 1.0
+
+
+def test_retry_budget_exhaustion_and_refill():
+    budget = RetryBudget(ratio=0.5, burst=2)
+    assert budget.spend()
+    assert budget.spend()
+    assert not budget.spend()
+
+    budget.earn()
+    assert not budget.spend()  # 0.5 token: chưa đủ một retry
+    budget.earn()
+    assert budget.spend()
+
+    for _ in range(10):
+        budget.earn()
+    assert budget.tokens == 2  # Không vượt burst
@@ -0,0 +1,189 @@
+"""
+Test HttpUploader với server HTTP giả (http.server chạy ở thread riêng)
+- Body là gzip JSON lines, mỗi dòng một mẫu kèm id
+- Cursor chỉ tiến khi server trả 2xx
+- Backoff khi lỗi (HTTP hoặc DB), lần sau gửi lại từ cursor đã xác nhận
+- Backlog lớn: dữ liệu mới gửi trước, dữ liệu cũ được backfill xen kẽ qua các vòng
+"""
+import asyncio
+import gzip
+import json
+import sqlite3
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from engine.mapper import get_register_map
+from storage.cache import SampleCache
+from storage.local_db import LocalDB
+from transport import http_client
+from transport.http_client import CURSOR, HttpUploader, UploadError
+
+
+class StubServer:
+    """Server ghi lại mọi request; statuses: mã trả về lần lượt cho từng request (hết thì 200)"""
+
+    def __init__(self):
+        self.requests = []
+        self.statuses = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive như server thật
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                stub.requests.append((dict(self.headers), body))
+                status = stub.statuses.pop(0) if stub.statuses else 200
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}/ingest?site=1"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def batches(self):
+        """id của các mẫu trong từng request"""
+        return [[json.loads(line)["id"] for line in gzip.decompress(body).splitlines()]
+                for _, body in self.requests]
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def server():
+    stub = StubServer()
+    yield stub
+    stub.close()
+
+
+@pytest.fixture
+def db(tmp_path):
+    store = LocalDB(str(tmp_path / "datalogger.db"))
+    yield store
+    store.close()
+
+
+def add_samples(db: LocalDB, count: int):
+    """Thêm `count` mẫu realtime (giá trị giả) vào DB"""
+    cmap = get_register_map("sungrow_sg").compile(mppt_count=2, string_count=4)
+    decoder = cmap.decoder(["ac", "mppt", "error"])
+    ring = SampleCache(hours=1, interval=5).ring(1, cmap)
+    for i in range(count):
+        sample = ring.append(time.time(), decoder, [[100 + i] * layout.count for layout in decoder.layouts])
+        db.add_sample(1, sample.ts, sample)
+    db.flush()
+
+
+def test_post_gzip_ndjson(server, db):
+    add_samples(db, 3)
+    uploader = HttpUploader(db, server.url, token="secret")
+
+    assert uploader.upload_round() == 3
+
+    headers, body = server.requests[0]
+    assert headers["Content-Type"] == "application/x-ndjson"
+    assert headers["Content-Encoding"] == "gzip"
+    assert headers["Authorization"] == "Bearer secret"
+    lines = [json.loads(line) for line in gzip.decompress(body).decode("utf-8").split("\n")]
+    assert [s["id"] for s in lines] == [1, 2, 3]
+    assert lines[0]["ac"]["voltage_ab"] == 10.0
+    assert uploader.bytes_sent == len(body)
+
+
+def test_cursor_advances_only_on_2xx(server, db):
+    add_samples(db, 4)
+    uploader = HttpUploader(db, server.url)
+    server.statuses = [500]
+
+    with pytest.raises(UploadError):
+        uploader.upload_round()
+    assert db.get_cursor(CURSOR) == 0
+    assert uploader.get_stats()["pending"] == 4
+
+    assert uploader.upload_round() == 4
+    assert db.get_cursor(CURSOR) == 4
+    assert uploader.get_stats()["pending"] == 0
+    assert server.batches() == [[1, 2, 3, 4], [1, 2, 3, 4]]
+
+
+def test_retry_with_backoff(server, db, monkeypatch):
+    add_samples(db, 2)
+    uploader = HttpUploader(db, server.url, interval=1, max_backoff=4)
+    server.statuses = [503, 503, 503]
+    delays = []
+
+    async def sleep(delay):
+        delays.append(delay)
+        if len(delays) > 5:
+            raise asyncio.CancelledError
+
+    monkeypatch.setattr(http_client.asyncio, "sleep", sleep)
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(uploader.run())
+
+    # Gấp đôi đến max_backoff, về lại interval khi thành công
+    assert delays == [1, 2, 4, 4, 1, 1]
+    assert uploader.failures == 3
+    assert server.batches() == [[1, 2]] * 4
+    assert db.get_cursor(CURSOR) == 2
+
+
+def test_db_error_backs_off_without_stopping(server, db, monkeypatch):
+    add_samples(db, 2)
+    uploader = HttpUploader(db, server.url, interval=1, max_backoff=4)
+    flush = db.flush
+    errors = [sqlite3.OperationalError("database is locked")] * 2
+    delays = []
+
+    def failing_flush():
+        if errors:
+            raise errors.pop()
+        return flush()
+
+    async def sleep(delay):
+        delays.append(delay)
+        if len(delays) > 3:
+            raise asyncio.CancelledError
+
+    monkeypatch.setattr(db, "flush", failing_flush)
+    monkeypatch.setattr(http_client.asyncio, "sleep", sleep)
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(uploader.run())
+
+    # Lỗi DB được đếm như lỗi upload và backoff, vòng lặp vẫn chạy tiếp
+    assert delays == [1, 2, 4, 1]
+    assert uploader.failures == 2
+    assert server.batches() == [[1, 2]]
+
+
+def test_backfill_interleaves_with_live(server, db):
+    add_samples(db, 40)
+    uploader = HttpUploader(db, server.url, batch_size=5, backfill_batches=2)
+
+    uploader.upload_round()
+    # Dữ liệu mới nhất trước, sau đó 2 lô dữ liệu cũ
+    assert server.batches() == [[36, 37, 38, 39, 40], [1, 2, 3, 4, 5], [6, 7, 8, 9, 10]]
+    assert db.get_cursor(CURSOR) == 10
+    # Cửa sổ live (35, 40] đã gửi không tính là chờ
+    stats = uploader.get_stats()
+    assert (stats["pending"], stats["pending_backfill"], stats["pending_live"]) == (25, 25, 0)
+
+    add_samples(db, 3)
+    assert uploader.get_stats()["pending_live"] == 3
+    uploader.upload_round()
+    assert server.batches()[3:] == [[41, 42, 43], [11, 12, 13, 14, 15], [16, 17, 18, 19, 20]]
+
+    while uploader.get_stats()["pending"]:
+        uploader.upload_round()
+    sent = [i for batch in server.batches() for i in batch]
+    assert sorted(sent) == list(range(1, 44))
+    assert db.get_cursor(CURSOR) == 43
@@ -0,0 +1,124 @@
+"""
+Test LocalDB (SQLite WAL, store-and-forward)
+- Ghi theo lô: add_sample báo khi đủ batch_size, một lần flush ghi cả lô
+- Cursor chỉ tiến (ack), prune giữ lại dòng chưa được mọi cursor xác nhận
+- Flush lỗi: dòng được trả về buffer và ghi lại lần sau; buffer bị giới hạn, bỏ dòng cũ nhất
+"""
+import sqlite3
+import time
+
+import pytest
+
+from engine.mapper import get_register_map
+from storage.cache import SampleCache
+from storage.local_db import LocalDB
+
+
+@pytest.fixture
+def db(tmp_path):
+    store = LocalDB(str(tmp_path / "datalogger.db"), batch_size=10)
+    yield store
+    store.close()
+
+
+def buffer_samples(db: LocalDB, count: int, ts: float = None):
+    """Thêm `count` mẫu realtime vào buffer (chưa flush); ac.* = 100 + i để nhận diện thứ tự"""
+    cmap = get_register_map("sungrow_sg").compile(mppt_count=2, string_count=4)
+    decoder = cmap.decoder(["ac", "mppt", "error"])
+    ring = SampleCache(hours=1, interval=5).ring(1, cmap)
+    start = time.time() if ts is None else ts
+    full = []
+    for i in range(count):
+        sample = ring.append(start + i, decoder, [[100 + i] * layout.count for layout in decoder.layouts])
+        full.append(db.add_sample(1, sample.ts, sample))
+    return full
+
+
+def failing_write(*args):
+    """Thay LocalDB._write: giả lập đĩa lỗi"""
+    raise sqlite3.OperationalError("disk I/O error")
+
+
+def test_batch_written_in_one_flush(db):
+    full = buffer_samples(db, 10)
+
+    # Chỉ mẫu thứ batch_size báo cần flush
+    assert full == [False] * 9 + [True]
+    assert db.conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert db.last_id() == 0
+
+    assert db.flush() == 10
+    assert db.flushes == 1
+    assert db.last_id() == 10
+    assert db.get_stats()["buffered"] == 0
+
+    rows = db.fetch_range(0)
+    assert [r["ts"] for r in rows] == sorted(r["ts"] for r in rows)
+    assert set(rows[0]) >= {"ac", "mppt", "error"}
+
+
+def test_cursor_ack_only_moves_forward(db):
+    buffer_samples(db, 5)
+    db.flush()
+
+    assert db.pending_count("cloud") == 5
+    db.ack("cloud", 3)
+    assert db.get_cursor("cloud") == 3
+    assert [r["id"] for r in db.fetch_pending("cloud")] == [4, 5]
+
+    # ack cũ hơn (ví dụ response đến trễ) không kéo cursor lùi
+    db.ack("cloud", 1)
+    assert db.get_cursor("cloud") == 3
+
+    # set_cursor ghi đè (trạng thái nội bộ)
+    db.set_cursor("cloud", 1)
+    assert db.pending_count("cloud") == 4
+    assert db.get_cursor("other") == 0
+
+
+def test_prune_keeps_rows_not_acked_by_every_cursor(db):
+    buffer_samples(db, 6, ts=time.time() - 60 * 86400)  # cũ hơn retention_days
+    db.flush()
+    db.ack("cloud", 5)
+    db.ack("mqtt", 2)
+
+    # Cũ hơn retention nhưng chỉ dòng <= MIN(cursor) mới được xóa
+    assert db.prune() == 2
+    assert [r["id"] for r in db.fetch_range(0)] == [3, 4, 5, 6]
+
+    db.ack("mqtt", 6)
+    assert db.prune() == 3
+    assert [r["id"] for r in db.fetch_range(0)] == [6]
+
+
+def test_failed_flush_restores_buffer(db, monkeypatch):
+    buffer_samples(db, 4)
+    write = db._write
+    monkeypatch.setattr(db, "_write", failing_write)
+    with pytest.raises(sqlite3.OperationalError):
+        db.flush()
+    assert db.get_stats()["buffered"] == 4
+
+    # Mẫu mới đến trong lúc lỗi nằm sau mẫu được trả lại
+    buffer_samples(db, 2, ts=time.time() + 100)
+    monkeypatch.setattr(db, "_write", write)
+    assert db.flush() == 6
+    assert [r["ac"]["voltage_ab"] for r in db.fetch_range(0)] == [10.0, 10.1, 10.2, 10.3, 10.0, 10.1]
+    assert db.dropped == 0
+
+
+def test_failed_flush_drops_oldest_beyond_limit(tmp_path, monkeypatch):
+    db = LocalDB(str(tmp_path / "datalogger.db"), batch_size=10, max_buffered=5)
+    monkeypatch.setattr(db, "_write", failing_write)
+
+    buffer_samples(db, 8)
+    with pytest.raises(sqlite3.OperationalError):
+        db.flush()
+    assert db.get_stats()["buffered"] == 5
+    assert db.get_stats()["dropped"] == 3
+
+    monkeypatch.undo()
+    assert db.flush() == 5
+    # Giữ lại 5 mẫu mới nhất
+    assert [r["ac"]["voltage_ab"] for r in db.fetch_range(0)] == [10.3, 10.4, 10.5, 10.6, 10.7]
+    db.close()
@@ -0,0 +1,143 @@
+"""
+Test MqttPublisher với client giả (truyền qua client=, không cần broker)
+- Deadband: chỉ các trường thay đổi vượt ngưỡng được gửi trong delta
+- Snapshot (retain) chỉ từ mẫu realtime, mẫu sản lượng luôn gửi dạng delta
+- Offline: message chờ trong hàng đợi có giới hạn, gửi đúng một lần khi kết nối lại
+"""
+import json
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from engine.mapper import get_register_map
+from storage.cache import SampleCache
+from transport.mqtt_client import MQTT_ERR_NO_CONN, Deadband, MqttPublisher
+
+
+class FakeClient:
+    """Giả lập paho: offline thì QoS 0 trả NO_CONN và bỏ message, QoS > 0 trả NO_CONN nhưng vẫn giữ lại"""
+
+    def __init__(self):
+        self.online = False
+        self.sent = []      # (topic, payload, retain) đã tới broker
+        self.held = []      # message QoS > 0 paho giữ lại khi offline
+        self.on_connect = None
+        self.on_disconnect = None
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        message = (topic, json.loads(payload), retain)
+        if self.online:
+            self.sent.append(message)
+            return SimpleNamespace(rc=0)
+        if qos > 0:
+            self.held.append(message)
+        return SimpleNamespace(rc=MQTT_ERR_NO_CONN)
+
+    def connect(self):
+        self.online = True
+        self.sent.extend(self.held)
+        self.held.clear()
+        self.on_connect(self, None, {}, 0)
+
+
+@pytest.fixture
+def inverter():
+    """Hàm tạo mẫu: mọi thanh ghi của các nhóm `groups` bằng `value`"""
+    register_map = get_register_map("sungrow_sg")
+    cmap = register_map.compile(mppt_count=2, string_count=4)
+    ring = SampleCache(hours=1, interval=5).ring(1, cmap)
+
+    def sample(value, groups=("ac", "mppt", "error")):
+        decoder = cmap.decoder(list(groups))
+        return ring.append(time.time(), decoder, [[value] * layout.count for layout in decoder.layouts])
+
+    sample.deadbands = {key: Deadband(**band) for key, band in register_map.deadbands().items()}
+    return sample
+
+
+def make_publisher(client, inverter, **options):
+    publisher = MqttPublisher(topic_prefix="site", client=client, **options)
+    publisher.filter.set_deadbands(1, inverter.deadbands)
+    return publisher
+
+
+def test_delta_only_fields_beyond_deadband(inverter):
+    client = FakeClient()
+    publisher = make_publisher(client, inverter)
+    client.connect()
+
+    publisher.publish_sample(1, 1.0, inverter(100))
+    publisher.publish_sample(1, 2.0, inverter(101))
+
+    (topic, snapshot, retain), (delta_topic, delta, delta_retain) = client.sent
+    assert (topic, retain) == ("site/1/snapshot", True)
+    assert snapshot["data"]["ac"]["voltage_ab"] == 10.0
+    assert (delta_topic, delta_retain) == ("site/1/delta", False)
+    # Điện áp / dòng thay đổi 0.1 nằm trong deadband; mã lỗi và trạng thái gửi mọi thay đổi
+    assert "ac.voltage_ab" not in delta["values"]
+    assert "mppt.1.current" not in delta["values"]
+    assert delta["values"]["error.fault_code"] == 101
+    assert delta["values"]["error.work_state"] == 101
+
+    # Không có gì vượt deadband: không gửi
+    publisher.publish_sample(1, 3.0, inverter(101))
+    assert len(client.sent) == 2
+    assert publisher.get_stats()["suppression_ratio"] > 0.5
+
+
+def test_energy_sample_never_becomes_snapshot(inverter):
+    client = FakeClient()
+    publisher = make_publisher(client, inverter, max_silence=0)
+    client.connect()
+
+    # Mẫu chỉ có sản lượng: delta, không retain (không ghi đè snapshot đầy đủ)
+    publisher.publish_sample(1, 1.0, inverter(100, groups=("energy",)))
+    publisher.publish_sample(1, 2.0, inverter(100))
+
+    assert [(topic, retain) for topic, _, retain in client.sent] == [
+        ("site/1/delta", False), ("site/1/snapshot", True)]
+    assert client.sent[0][1]["values"]["energy.energy_day_kwh"] == 10.0
+    assert "energy" not in client.sent[1][1]["data"]
+
+
+def test_offline_queue_delivers_once_in_order(inverter):
+    client = FakeClient()
+    publisher = make_publisher(client, inverter, queue_size=2)
+
+    for n in range(3):
+        publisher.publish(f"plant/{n}", {"n": n})
+    assert client.sent == client.held == []
+    assert publisher.get_stats()["queued"] == 2
+    assert publisher.dropped == 1
+
+    client.connect()
+    assert [payload["n"] for _, payload, _ in client.sent] == [1, 2]
+    assert publisher.get_stats()["queued"] == 0
+
+
+def test_no_duplicate_when_paho_holds_qos1_message(inverter):
+    client = FakeClient()
+    publisher = make_publisher(client, inverter)
+    client.connect()
+
+    # Mất kết nối nhưng callback on_disconnect chưa chạy: paho trả NO_CONN và tự giữ message QoS 1
+    client.online = False
+    publisher.publish("plant/1", {"n": 1})
+    assert publisher.get_stats()["queued"] == 0
+
+    client.connect()
+    assert [payload["n"] for _, payload, _ in client.sent] == [1]
+
+
+def test_qos0_message_kept_until_reconnect(inverter):
+    client = FakeClient()
+    publisher = make_publisher(client, inverter, qos=0)
+    client.connect()
+
+    client.online = False
+    publisher.publish("plant/1", {"n": 1})
+    assert publisher.get_stats()["queued"] == 1
+
+    client.connect()
+    assert [payload["n"] for _, payload, _ in client.sent] == [1]
@@ -0,0 +1,124 @@
+"""
+Test PlantAggregator
+- Inverter im lặng: stale (giữ giá trị cũ) -> missing sau stale_after (bỏ công suất khỏi tổng)
+- Tổng nhà máy cập nhật tăng dần: bộ đếm sản lượng + tích phân công suất giữa hai lần đọc
+- Bức xạ từ MQTT <prefix>/irradiance/<project_id> cho performance ratio
+"""
+import asyncio
+import time
+
+import pytest
+
+from engine.mapper import get_register_map
+from engine.plant import STATUS_MISSING, STATUS_OK, STATUS_STALE, PlantAggregator, Project
+from storage.cache import SampleCache
+
+
+@pytest.fixture
+def sample():
+    """Hàm tạo mẫu: power (W) -> nhóm ac; energy_day / energy_total (kWh) -> nhóm energy"""
+    cmap = get_register_map("sungrow_sg").compile(mppt_count=2, string_count=4)
+    ring = SampleCache(hours=1, interval=5).ring(1, cmap)
+
+    def make(power=None, energy_day=None, energy_total=None):
+        groups = (["ac", "error"] if power is not None else []) + (["energy"] if energy_day is not None else [])
+        decoder = cmap.decoder(groups)
+        registers = {5031: power or 0}
+        if energy_day is not None:
+            registers.update({5003: round(energy_day * 10), 5144: round(energy_total * 10)})
+        frames = [[registers.get(layout.start + i, 0) for i in range(layout.count)] for layout in decoder.layouts]
+        return ring.append(time.time(), decoder, frames)
+
+    return make
+
+
+@pytest.fixture
+def plant():
+    project = Project(id=1, name="A", inverters=[1, 2], capacity_kwp=100, ac_capacity_kw=50)
+    return PlantAggregator([project], interval=5, stale_after=30)
+
+
+def test_stale_then_missing(plant, sample):
+    now = time.time()
+    state = plant.plants[1]
+    plant.add(1, now, sample(power=1000))
+    plant.add(2, now, sample(power=2000))
+
+    snapshot = plant.snapshot(state, now + 1)
+    assert (snapshot.reporting, snapshot.stale, snapshot.missing) == (2, 0, 0)
+    assert snapshot.power_w == 3000
+    assert snapshot.capacity_factor == 0.06
+    assert plant.snapshot(state, now + 2) is None  # Không có gì mới
+
+    # Inverter 2 im lặng quá một chu kỳ: dùng lại công suất cũ
+    plant.add(1, now + 10, sample(power=1500))
+    snapshot = plant.snapshot(state, now + 11)
+    assert snapshot.inverters == {1: STATUS_OK, 2: STATUS_STALE}
+    assert snapshot.power_w == 3500
+    assert snapshot.max_age == 11
+
+    # Quá stale_after: mất, công suất bị bỏ khỏi tổng
+    snapshot = plant.snapshot(state, now + 31)
+    assert snapshot.inverters == {1: STATUS_STALE, 2: STATUS_MISSING}
+    assert snapshot.power_w == 1500
+    assert snapshot.availability == 0.5
+
+    # Inverter 2 trả lời lại
+    plant.add(2, now + 32, sample(power=2000))
+    snapshot = plant.snapshot(state, now + 33)
+    assert snapshot.inverters == {1: STATUS_STALE, 2: STATUS_OK}
+    assert snapshot.power_w == 3500
+
+
+def test_incremental_totals(plant, sample):
+    now = time.time()
+    state = plant.plants[1]
+    plant.add(1, now, sample(energy_day=5.0, energy_total=100.0))
+    plant.add(2, now, sample(energy_day=3.0, energy_total=50.0))
+    assert state.totals[1:] == [8.0, 150.0]
+
+    # Giữa hai lần đọc bộ đếm: cộng tích phân công suất (3600 W trong 10 s = 0.01 kWh)
+    plant.add(1, now, sample(power=3600))
+    plant.add(1, now + 10, sample(power=3600))
+    snapshot = plant.snapshot(state, now + 10)
+    assert snapshot.energy_day_kwh == 8.01
+    assert snapshot.energy_total_kwh == 150.01
+    assert snapshot.specific_yield == round(8.01 / 100, 4)
+
+    # Đọc bộ đếm mới: thay phần ước tính, không cộng dồn
+    plant.add(1, now + 12, sample(energy_day=5.5, energy_total=100.5))
+    assert state.totals[1:] == pytest.approx([8.5, 150.5])
+    assert state.totals == pytest.approx([sum(share.counted[i] for share in state.shares.values())
+                                          for i in range(3)])
+
+
+class FakePublisher:
+    topic_prefix = "site"
+
+    def __init__(self):
+        self.callbacks = {}
+
+    def subscribe(self, topic, callback, qos=1):
+        self.callbacks[topic] = callback
+
+
+def test_irradiance_from_mqtt(plant, sample):
+    async def main():
+        publisher = FakePublisher()
+        plant.attach_mqtt(publisher)
+        callback = publisher.callbacks["site/irradiance/+"]
+
+        now = time.time()
+        plant.add(1, now, sample(power=40000))
+        assert plant.snapshot(plant.plants[1], now).performance_ratio is None
+
+        callback("site/irradiance/1", b'{"irradiance": 800}')
+        callback("site/irradiance/1", b'"bad"')
+        await asyncio.sleep(0)
+        plant.add(1, now + 1, sample(power=40000))
+        snapshot = plant.snapshot(plant.plants[1], now + 1)
+        # 40 kW / 100 kWp / 0.8 kW/m²
+        assert snapshot.performance_ratio == 0.5
+        assert plant.irradiance_invalid == 1
+
+    asyncio.run(main())
@@ -0,0 +1,135 @@
+"""
+Test PollingPolicy (scheduler giả, đồng hồ giả)
+- Night: đủ idle_samples mẫu không phát điện -> night_interval, phát lại -> realtime_interval
+- Fault: fault_code mới -> fault_interval trong fault_burst giây, mã lỗi kéo dài không kích hoạt lại
+- Offline: sau offline_after lần lỗi liên tiếp giãn chu kỳ gấp đôi đến offline_max_interval
+- Đọc sản lượng: bỏ khi vừa có giá trị, khi không phát điện từ trước lần đọc cuối, khi offline
+"""
+import time
+
+import pytest
+
+from engine import policy as policy_module
+from engine.mapper import get_register_map
+from engine.policy import PollingMode, PollingPolicy
+from storage.cache import SampleCache
+
+STANDBY = 0x1200
+
+
+class FakeScheduler:
+    """Ghi lại các lần đổi chu kỳ realtime"""
+
+    def __init__(self):
+        self.intervals = []
+
+    def update_interval(self, inverter_id, polling_type, interval):
+        self.intervals.append(interval)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(policy_module.time, "monotonic", clock)
+    return clock
+
+
+@pytest.fixture
+def policy(clock):
+    return PollingPolicy(FakeScheduler(), realtime_interval=5, energy_interval=900, night_interval=60,
+                         fault_interval=2, fault_burst=120, offline_after=3, offline_max_interval=40,
+                         idle_samples=3)
+
+
+@pytest.fixture
+def sample():
+    """Hàm tạo mẫu realtime: công suất (W), work_state, fault_code; energy=True thêm nhóm sản lượng"""
+    cmap = get_register_map("sungrow_sg").compile(mppt_count=2, string_count=4)
+    ring = SampleCache(hours=1, interval=5).ring(1, cmap)
+
+    def make(power=5000, work_state=0, fault_code=0, energy=False):
+        decoder = cmap.decoder(["ac", "mppt", "error"] + (["energy"] if energy else []))
+        registers = {5031: power, 5038: work_state, 5045: fault_code}
+        frames = [[registers.get(layout.start + i, 0) for i in range(layout.count)] for layout in decoder.layouts]
+        return ring.append(time.time(), decoder, frames)
+
+    return make
+
+
+def test_night_after_idle_samples(policy, sample):
+    for _ in range(2):
+        policy.observe(1, sample(power=0))
+    assert policy.states[1].mode == PollingMode.NORMAL
+
+    policy.observe(1, sample(work_state=STANDBY))
+    assert policy.states[1].mode == PollingMode.NIGHT
+    assert policy.scheduler.intervals == [60]
+
+    policy.observe(1, sample(power=3000))
+    assert policy.states[1].mode == PollingMode.NORMAL
+    assert policy.scheduler.intervals == [60, 5]
+
+
+def test_fault_burst_then_back(policy, sample, clock):
+    policy.observe(1, sample(fault_code=12))
+    assert policy.states[1].mode == PollingMode.FAULT
+    assert policy.states[1].interval == 2
+
+    # Cùng mã lỗi sau khi hết burst: không kích hoạt lại
+    clock.now += 121
+    policy.observe(1, sample(fault_code=12))
+    assert policy.states[1].mode == PollingMode.NORMAL
+
+    # Mã lỗi mới: burst mới
+    policy.observe(1, sample(fault_code=13))
+    assert policy.states[1].mode == PollingMode.FAULT
+    assert policy.scheduler.intervals == [2, 5, 2]
+    assert policy.get_stats()[1]["history"] == {"fault": 2, "normal": 1}
+
+
+def test_offline_backoff_and_recovery(policy, sample):
+    for _ in range(2):
+        policy.on_failure(1)
+    assert policy.states[1].mode == PollingMode.NORMAL
+
+    for _ in range(4):
+        policy.on_failure(1)
+    assert policy.states[1].mode == PollingMode.OFFLINE
+    # 10, 20, 40 rồi giữ ở offline_max_interval
+    assert policy.scheduler.intervals == [10, 20, 40]
+    assert policy.should_read_energy(1) is False
+
+    policy.observe(1, sample())
+    assert policy.states[1].mode == PollingMode.NORMAL
+    assert policy.states[1].failures == 0
+    assert policy.scheduler.intervals[-1] == 5
+
+
+def test_should_read_energy(policy, sample, clock):
+    assert policy.should_read_energy(1) is True
+
+    # Poll realtime vừa đọc sản lượng: chưa cần đọc riêng
+    policy.observe(1, sample(energy=True))
+    assert policy.should_read_energy(1) is False
+    clock.now += 901
+    assert policy.should_read_energy(1) is True
+
+    # Không phát điện từ trước lần đọc cuối: sản lượng không đổi
+    for _ in range(3):
+        policy.observe(1, sample(power=0))
+    policy.on_energy(1)
+    clock.now += 901
+    assert policy.should_read_energy(1) is False
+    assert policy.get_stats()[1]["energy_skipped"] == 2
+
+    # Phát điện trở lại: đọc theo energy_interval như bình thường
+    policy.observe(1, sample(power=3000))
+    assert policy.should_read_energy(1) is True
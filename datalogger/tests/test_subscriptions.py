@@ -0,0 +1,102 @@
+"""
+Test EventBus / Subscription
+- Hàng đợi đầy: drop_oldest bỏ message cũ nhất, coalesce giữ message mới nhất mỗi khóa
+- Message hết hạn (slot ring bị ghi đè) không được giao
+- Publish sai kiểu báo lỗi ngay; thống kê độ trễ giao
+"""
+import asyncio
+from typing import NamedTuple
+
+import pytest
+
+from alerts.subscriptions import COALESCE, DROP_OLDEST, EventBus, Topic
+
+
+class Reading(NamedTuple):
+    inverter_id: int
+    value: int
+
+
+TOPIC = Topic("reading", Reading, key=lambda r: r.inverter_id, expired=lambda r: r.value < 0)
+
+
+async def deliver(bus: EventBus):
+    """Chạy bus đến khi mọi message đã publish được xử lý (giao / lỗi / bỏ / gộp / hết hạn) rồi dừng"""
+    task = asyncio.create_task(bus.run())
+    while any(s.delivered + s.errors + s.dropped + s.coalesced + s.expired < s.published for s in bus.all()):
+        await asyncio.sleep(0.001)
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+
+
+def test_drop_oldest_overflow():
+    received = []
+    bus = EventBus()
+    subscription = bus.subscribe(TOPIC, lambda inverter_id, value: received.append(value), "db",
+                                 policy=DROP_OLDEST, queue_size=3)
+
+    for value in range(5):
+        assert bus.publish(TOPIC, Reading(1, value)) == 1
+    asyncio.run(deliver(bus))
+
+    assert received == [2, 3, 4]
+    stats = subscription.get_stats()
+    assert (stats["published"], stats["delivered"], stats["dropped"]) == (5, 3, 2)
+
+
+def test_coalesce_keeps_latest_per_key():
+    received = []
+    bus = EventBus()
+    subscription = bus.subscribe(TOPIC, lambda inverter_id, value: received.append((inverter_id, value)),
+                                 "mqtt", policy=COALESCE, queue_size=2)
+
+    bus.publish(TOPIC, Reading(1, 10))
+    bus.publish(TOPIC, Reading(2, 20))
+    bus.publish(TOPIC, Reading(1, 11))   # Gộp vào khóa 1, giữ vị trí
+    bus.publish(TOPIC, Reading(3, 30))   # Đầy: bỏ khóa chờ lâu nhất (1)
+    asyncio.run(deliver(bus))
+
+    assert received == [(2, 20), (3, 30)]
+    stats = subscription.get_stats()
+    assert (stats["coalesced"], stats["dropped"], stats["delivered"]) == (1, 1, 2)
+
+
+def test_expired_messages_not_delivered():
+    received = []
+    bus = EventBus()
+    subscription = bus.subscribe(TOPIC, received.append, "batch", batch=True, batch_size=10)
+
+    for value in (1, -1, 2):
+        bus.publish(TOPIC, Reading(1, value))
+    asyncio.run(deliver(bus))
+
+    assert received == [[Reading(1, 1), Reading(1, 2)]]
+    assert subscription.expired == 1
+    assert subscription.batches == 1
+
+
+def test_lag_stats_and_errors():
+    async def slow(inverter_id, value):
+        await asyncio.sleep(0.01)
+        if value == 2:
+            raise RuntimeError("consumer lỗi")
+
+    bus = EventBus()
+    subscription = bus.subscribe(TOPIC, slow, "slow", queue_size=10, batch_size=1)
+    for value in range(4):
+        bus.publish(TOPIC, Reading(1, value))
+    asyncio.run(deliver(bus))
+
+    stats = subscription.get_stats()
+    assert stats["delivered"] == 3 and stats["errors"] == 1
+    # Message cuối chờ ba message trước được giao
+    assert stats["lag_max_ms"] >= 25
+    assert stats["lag_p50_ms"] <= stats["lag_p99_ms"] <= stats["lag_max_ms"]
+
+
+def test_publish_checks_type_and_counts_unrouted():
+    bus = EventBus()
+    with pytest.raises(TypeError):
+        bus.publish(TOPIC, (1, 2))
+    assert bus.publish(TOPIC, Reading(1, 1)) == 0
+    assert bus.unrouted == 1
@@ -0,0 +1,138 @@
+"""
+Test validate_config (schema + tham chiếu chéo của cấu hình đã render) và cache của config loader
+- Cấu hình mẫu trong config/ hợp lệ; lỗi được gom đủ, không dừng ở lỗi đầu tiên
+- Unit id Modbus TCP: inverter và nhà máy trong 1-247, không trùng nhau
+- Hai inverter không dùng chung (port, slave_id), kể cả khi lấy giá trị mặc định
+- Cache theo hash nội dung: không đổi -> không parse lại, đổi nội dung / context -> parse lại
+"""
+import copy
+
+import pytest
+
+from utils import config_loader
+from utils.validator import validate_config
+
+BASE = {
+    "projects": {"projects": [{"id": 1, "name": "Plant A", "inverters": [1, 2]}]},
+    "inverters": [
+        {"id": 1, "project_id": 1, "port": "COM3", "slave_id": 1},
+        {"id": 2, "project_id": 1, "port": "COM3", "slave_id": 2},
+    ],
+    "mppt_channels": [{"id": 1, "inverter_id": 1, "mppt_index": 1}],
+    "strings": [{"id": 1, "inverter_id": 1, "mppt_id": 1, "string_index": 1}],
+    "server": {"modbus_tcp": {"enabled": True, "plant_unit_base": 100}},
+}
+
+
+@pytest.fixture
+def config():
+    return copy.deepcopy(BASE)
+
+
+def test_shipped_config_is_valid():
+    from utils.config_loader import load_config
+    config = load_config()
+    assert config["inverters"]
+    assert validate_config(config) == []
+
+
+def test_valid_config(config):
+    assert validate_config(config) == []
+
+
+def test_collects_schema_and_reference_errors(config):
+    config["inverters"][0]["slave_id"] = 0
+    config["mppt_channels"][0]["inverter_id"] = 9
+    config["strings"][0]["string_index"] = "1"
+    config["server"]["storage"] = {"batch_size": True}
+
+    errors = validate_config(config)
+    assert len(errors) == 5
+    assert "devices.yaml: inverter id=1: 'slave_id' = 0 nhỏ hơn 1" in errors
+    # Inverter lỗi schema bị loại: project tham chiếu tới nó cũng báo lỗi
+    assert "projects.yaml: project id=1: inverter 1 không có trong devices.yaml" in errors
+    assert any(e.startswith("mppt.yaml: mppt id=1: inverter 9") for e in errors)
+    assert any(e.startswith("strings.yaml: string id=1: 'string_index'") for e in errors)
+    assert any(e.startswith("server.yaml: storage: 'batch_size'") for e in errors)
+
+
+def test_duplicate_port_and_slave(config):
+    config["inverters"][1]["slave_id"] = 1
+    errors = validate_config(config)
+    assert errors == ["devices.yaml: inverter id=2: port COM3 slave_id 1 trùng inverter 1"]
+
+    # Cùng slave_id trên bus khác: hợp lệ
+    config["inverters"][1]["port"] = "COM4"
+    assert validate_config(config) == []
+
+    # Bỏ trống port/slave_id: dùng mặc định COM3 / 1 cho cả hai
+    for inverter in config["inverters"]:
+        del inverter["port"], inverter["slave_id"]
+    assert len(validate_config(config)) == 1
+
+
+def test_inverter_unit_out_of_range(config):
+    config["inverters"][1]["id"] = 300
+    config["projects"]["projects"][0]["inverters"] = [1, 300]
+    errors = validate_config(config)
+    assert errors == ["devices.yaml: inverter id=300: id dùng làm unit Modbus TCP, phải trong 1-247"]
+
+    # Modbus TCP tắt: id inverter không bị giới hạn
+    config["server"]["modbus_tcp"]["enabled"] = False
+    assert validate_config(config) == []
+
+
+def test_plant_unit_collides_with_inverter(config):
+    config["server"]["modbus_tcp"]["plant_unit_base"] = 1
+    errors = validate_config(config)
+    assert len(errors) == 1 and "trùng id inverter" in errors[0]
+
+    config["server"]["modbus_tcp"]["plant_unit_base"] = 246
+    config["projects"]["projects"].append({"id": 2, "name": "Plant B"})
+    errors = validate_config(config)
+    assert len(errors) == 1 and "ngoài 1-247" in errors[0]
+
+    # Không publish snapshot nhà máy: không cấp unit nhà máy
+    config["server"]["plant"] = {"enabled": False}
+    assert validate_config(config) == []
+
+
+@pytest.fixture
+def config_dir(tmp_path, monkeypatch):
+    """Thư mục config và file cache tạm, cache trong process trống (như vừa khởi động)"""
+    monkeypatch.setattr(config_loader, "CONFIG_DIR", str(tmp_path))
+    monkeypatch.setattr(config_loader, "CACHE_PATH", str(tmp_path / "data" / "config.cache"))
+    monkeypatch.setattr(config_loader, "_cache", None)
+    parsed = []
+    parse = config_loader._parse
+    monkeypatch.setattr(config_loader, "_parse", lambda *args: parsed.append(args[0]) or parse(*args))
+    return tmp_path, parsed
+
+
+def test_cache_hit_and_miss(config_dir, monkeypatch):
+    path, parsed = config_dir
+    (path / "devices.yaml").write_text("inverters:\n  - {id: 1, installed_at: 2025-10-20T00:00:00Z}\n")
+
+    first = config_loader.load_yaml_file("devices.yaml")
+    assert config_loader.load_yaml_file("devices.yaml") is first
+    assert parsed == ["devices.yaml"]
+
+    # Khởi động lại: đọc từ file cache, giữ kiểu datetime
+    monkeypatch.setattr(config_loader, "_cache", None)
+    assert config_loader.load_yaml_file("devices.yaml") == first
+    assert parsed == ["devices.yaml"]
+
+    # Nội dung đổi: parse lại
+    (path / "devices.yaml").write_text("inverters:\n  - {id: 2}\n")
+    assert config_loader.load_yaml_file("devices.yaml")["inverters"] == [{"id": 2}]
+    assert parsed == ["devices.yaml"] * 2
+
+
+def test_cache_keyed_by_jinja_context(config_dir):
+    path, parsed = config_dir
+    (path / "mppt.yaml").write_text("name: {{ name }}\n")
+
+    assert config_loader.load_yaml_file("mppt.yaml", {"name": "A"}) == {"name": "A"}
+    assert config_loader.load_yaml_file("mppt.yaml", {"name": "A"}) == {"name": "A"}
+    assert config_loader.load_yaml_file("mppt.yaml", {"name": "B"}) == {"name": "B"}
+    assert parsed == ["mppt.yaml"] * 2
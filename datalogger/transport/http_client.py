@@ -0,0 +1,211 @@
+"""
+HTTP uploader - Đẩy dữ liệu từ local DB lên server theo lô
+- Lấy mẫu chưa upload theo cursor, mỗi request giới hạn số mẫu
+- Nén gzip JSON lines, giữ kết nối keep-alive giữa các request
+- Lỗi mạng: backoff tăng dần, lần sau tiếp tục từ cursor đã được xác nhận
+- Sau khi mất kết nối lâu: dữ liệu mới gửi trước, dữ liệu cũ được backfill dần
+"""
+import asyncio
+import gzip
+import http.client
+import json
+import ssl
+import time
+from typing import Any, Dict, List, Optional
+from urllib.parse import urlsplit
+
+from storage.local_db import LocalDB
+
+CURSOR = "http"
+LIVE_FLOOR = "http.live_floor"  # Dữ liệu <= mốc này thuộc phần backfill
+LIVE_HIGH = "http.live_high"    # Dữ liệu mới đã gửi đến mốc này
+
+
+class UploadError(Exception):
+    """Server từ chối hoặc không trả lời"""
+
+
+class HttpUploader:
+    """Upload mẫu từ LocalDB lên endpoint HTTP"""
+
+    def __init__(self, db: LocalDB, endpoint: str, token: Optional[str] = None, interval: float = 60,
+                 batch_size: int = 500, backfill_batches: int = 2, timeout: float = 30,
+                 max_backoff: float = 900, compress_level: int = 6):
+        self.db = db
+        self.endpoint = endpoint
+        self.token = token
+        self.interval = interval
+        self.batch_size = batch_size
+        self.backfill_batches = backfill_batches  # Số lô dữ liệu cũ mỗi vòng
+        self.timeout = timeout
+        self.max_backoff = max_backoff
+        self.compress_level = compress_level
+
+        url = urlsplit(endpoint)
+        self._scheme = url.scheme
+        self._host = url.hostname
+        self._port = url.port
+        self._path = url.path or "/"
+        if url.query:
+            self._path += "?" + url.query
+        self._conn: Optional[http.client.HTTPConnection] = None
+
+        # Đăng ký cursor để retention không xóa dữ liệu chưa upload
+        self.db.ack(CURSOR, 0)
+
+        # Thống kê
+        self.requests = 0
+        self.failures = 0
+        self.samples_sent = 0
+        self.bytes_sent = 0
+        self.last_upload: Optional[float] = None
+
+    # ------------------------------------------------------------------
+    # HTTP
+    # ------------------------------------------------------------------
+    def _connection(self) -> http.client.HTTPConnection:
+        """Kết nối keep-alive (tạo lại khi bị đóng hoặc lỗi)"""
+        if self._conn is None:
+            if self._scheme == "https":
+                self._conn = http.client.HTTPSConnection(
+                    self._host, self._port, timeout=self.timeout, context=ssl.create_default_context())
+            else:
+                self._conn = http.client.HTTPConnection(self._host, self._port, timeout=self.timeout)
+        return self._conn
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def encode(self, samples: List[Dict[str, Any]]) -> bytes:
+        """Mỗi mẫu một dòng JSON gọn, nén gzip"""
+        lines = "\n".join(json.dumps(s, separators=(",", ":"), allow_nan=False) for s in samples)
+        return gzip.compress(lines.encode("utf-8"), compresslevel=self.compress_level)
+
+    def post(self, samples: List[Dict[str, Any]]):
+        """Gửi một lô; raise UploadError nếu không thành công"""
+        body = self.encode(samples)
+        headers = {
+            "Content-Type": "application/x-ndjson",
+            "Content-Encoding": "gzip",
+            "Connection": "keep-alive",
+        }
+        if self.token:
+            headers["Authorization"] = f"Bearer {self.token}"
+
+        self.requests += 1
+        try:
+            conn = self._connection()
+            conn.request("POST", self._path, body=body, headers=headers)
+            response = conn.getresponse()
+            response.read()  # Đọc hết để tái sử dụng kết nối
+        except (OSError, http.client.HTTPException) as e:
+            self._close()
+            raise UploadError(f"Lỗi kết nối: {e}") from e
+
+        if response.will_close:
+            self._close()
+        if not 200 <= response.status < 300:
+            raise UploadError(f"HTTP {response.status} {response.reason}")
+
+        self.samples_sent += len(samples)
+        self.bytes_sent += len(body)
+        self.last_upload = time.time()
+
+    # ------------------------------------------------------------------
+    # Vòng upload
+    # ------------------------------------------------------------------
+    def _send_range(self, after_id: int, until_id: Optional[int], max_batches: int, cursor: str) -> int:
+        """Gửi tối đa max_batches lô trong (after_id, until_id], lưu cursor sau mỗi lô thành công"""
+        for _ in range(max_batches):
+            samples = self.db.fetch_range(after_id, until_id, self.batch_size)
+            if not samples:
+                break
+            self.post(samples)
+            after_id = samples[-1]["id"]
+            self.db.set_cursor(cursor, after_id)
+        return after_id
+
+    def upload_round(self) -> int:
+        """
+        Một vòng upload (blocking). Trạng thái lưu trong DB:
+        - CURSOR: mọi mẫu <= mốc này đã gửi
+        - (LIVE_FLOOR, LIVE_HIGH]: cửa sổ dữ liệu mới đã gửi trước trong lúc backfill
+        """
+        self.db.flush()
+        sent_before = self.samples_sent
+
+        acked = self.db.get_cursor(CURSOR)
+        floor = max(self.db.get_cursor(LIVE_FLOOR), acked)
+        high = max(self.db.get_cursor(LIVE_HIGH), floor)
+        last = self.db.last_id()
+
+        try:
+            # Backlog lớn (vừa mất kết nối lâu): mở cửa sổ live ở gần cuối, phần cũ để backfill
+            if last - high > self.batch_size * 2:
+                floor = high = last - self.batch_size
+                self.db.set_cursor(LIVE_FLOOR, floor)
+                print(f"[HTTP] ⏪ Backlog {last - acked} mẫu, backfill dần từ id {acked}")
+            self.db.set_cursor(LIVE_HIGH, high)
+
+            # Dữ liệu mới trước
+            self._send_range(high, None, 3, LIVE_HIGH)
+
+            # Backfill dữ liệu cũ, giới hạn số lô mỗi vòng để không chiếm hết băng thông
+            if acked < floor:
+                self._send_range(acked, floor, self.backfill_batches, CURSOR)
+        finally:
+            # Backfill xong: gộp cửa sổ live vào cursor chính
+            acked = self.db.get_cursor(CURSOR)
+            high = self.db.get_cursor(LIVE_HIGH)
+            if acked >= floor and high > acked:
+                self.db.set_cursor(CURSOR, high)
+                self.db.set_cursor(LIVE_FLOOR, high)
+
+        return self.samples_sent - sent_before
+
+    async def run(self):
+        """Vòng lặp upload định kỳ với backoff khi lỗi"""
+        delay = self.interval
+        try:
+            while True:
+                await asyncio.sleep(delay)
+                try:
+                    count = await asyncio.to_thread(self.upload_round)
+                    if count:
+                        print(f"[HTTP] ⬆️ Đã upload {count} mẫu")
+                    delay = self.interval
+                except Exception as e:
+                    # Lỗi HTTP hoặc lỗi phía DB (flush/đọc cursor): cùng backoff, không dừng vòng upload
+                    self.failures += 1
+                    delay = min(max(delay, self.interval) * 2, self.max_backoff)
+                    print(f"[HTTP] ❌ Upload thất bại: {e} (thử lại sau {delay:.0f}s)")
+        finally:
+            self._close()
+
+    def pending(self) -> Dict[str, int]:
+        """Số mẫu chưa gửi: phần backfill (CURSOR, LIVE_FLOOR] và phần mới sau LIVE_HIGH"""
+        acked = self.db.get_cursor(CURSOR)
+        floor = max(self.db.get_cursor(LIVE_FLOOR), acked)
+        high = max(self.db.get_cursor(LIVE_HIGH), floor)
+        return {
+            "backfill": self.db.count_range(acked, floor) if floor > acked else 0,
+            "live": self.db.count_range(high)
+        }
+
+    def get_stats(self) -> Dict:
+        """Thống kê upload"""
+        pending = self.pending()
+        return {
+            "endpoint": self.endpoint,
+            "requests": self.requests,
+            "failures": self.failures,
+            "samples_sent": self.samples_sent,
+            "bytes_sent": self.bytes_sent,
+            "bytes_per_sample": round(self.bytes_sent / self.samples_sent, 1) if self.samples_sent else None,
+            "pending": pending["backfill"] + pending["live"],
+            "pending_backfill": pending["backfill"],
+            "pending_live": pending["live"],
+            "last_upload": self.last_upload
+        }
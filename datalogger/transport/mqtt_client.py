@@ -0,0 +1,250 @@
+"""
+MQTT client - Publish dữ liệu theo kiểu report-by-exception
+- Mỗi trường có deadband (tuyệt đối / phần trăm), khai báo trong register map theo trường hoặc cả nhóm
+- Chỉ gửi các trường thay đổi vượt deadband (delta), snapshot đầy đủ được retain
+- Quá max_silence giây không gửi thì phát lại snapshot đầy đủ (chỉ từ mẫu realtime)
+- Mất kết nối: message được giữ trong hàng đợi có giới hạn, gửi lại QoS 1 khi kết nối lại
+- Snapshot nhà máy publish nguyên bản (retain) dưới <prefix>/plant/<project_id>,
+  thay đổi trạng thái alert dưới <prefix>/alert/<inverter_id>
+"""
+import json
+import threading
+import time
+from collections import deque
+from dataclasses import asdict, dataclass
+from typing import Any, Callable, Deque, Dict, Optional, Tuple
+
+from storage.cache import Sample
+
+try:
+    import paho.mqtt.client as mqtt
+except ImportError:  # paho-mqtt là tùy chọn
+    mqtt = None
+
+MQTT_ERR_NO_CONN = 4  # paho.mqtt.client.MQTT_ERR_NO_CONN (client có thể được truyền vào khi chưa cài paho)
+
+
+@dataclass
+class Deadband:
+    """Ngưỡng thay đổi tối thiểu để gửi lại một trường"""
+    abs: float = 0.0   # Thay đổi tuyệt đối
+    pct: float = 0.0   # Thay đổi theo % giá trị đã gửi trước đó
+
+    def exceeded(self, old: Any, new: Any) -> bool:
+        if old is None or new is None or isinstance(new, bool):
+            return old != new
+        if not isinstance(new, (int, float)) or not isinstance(old, (int, float)):
+            return old != new
+        threshold = max(self.abs, abs(old) * self.pct / 100)
+        delta = abs(new - old)
+        return delta > threshold if threshold > 0 else delta != 0
+
+
+def field_key(key: str) -> str:
+    """Key dùng để tra deadband: bỏ chỉ số MPPT/string ("mppt.3.voltage" -> "mppt.voltage")"""
+    return ".".join(p for p in key.split(".") if not p.isdigit())
+
+
+class DeadbandFilter:
+    """Lưu giá trị đã gửi gần nhất của từng inverter và lọc theo deadband"""
+
+    def __init__(self, default: Optional[Deadband] = None, max_silence: float = 900):
+        self.default = default or Deadband()
+        self.max_silence = max_silence
+        self.deadbands: Dict[int, Dict[str, Deadband]] = {}
+        self._bands: Dict[int, Dict[str, Deadband]] = {}  # Deadband theo key phẳng (tra một lần)
+        self.reported: Dict[int, Dict[str, Any]] = {}
+        self.last_snapshot: Dict[int, float] = {}
+
+        # Thống kê
+        self.fields_seen = 0
+        self.fields_sent = 0
+
+    def set_deadbands(self, inverter_id: int, deadbands: Dict[str, Deadband]):
+        """Deadband theo trường cho một inverter (key dạng "ac.power")"""
+        self.deadbands[inverter_id] = deadbands
+        self._bands.pop(inverter_id, None)
+
+    def needs_snapshot(self, inverter_id: int, now: float) -> bool:
+        return now - self.last_snapshot.get(inverter_id, -self.max_silence) >= self.max_silence
+
+    def snapshot(self, inverter_id: int, flat: Dict[str, Any], now: float):
+        """Ghi nhận snapshot đầy đủ làm mốc so sánh mới"""
+        reported = self.reported.setdefault(inverter_id, {})
+        reported.update(flat)
+        self.last_snapshot[inverter_id] = now
+        self.fields_seen += len(flat)
+        self.fields_sent += len(flat)
+
+    def delta(self, inverter_id: int, flat: Dict[str, Any]) -> Dict[str, Any]:
+        """Các trường thay đổi vượt deadband so với lần gửi trước"""
+        reported = self.reported.setdefault(inverter_id, {})
+        deadbands = self.deadbands.get(inverter_id, {})
+        bands = self._bands.setdefault(inverter_id, {})
+        changed = {}
+        for key, value in flat.items():
+            if key not in reported:
+                changed[key] = value
+                continue
+            band = bands.get(key)
+            if band is None:
+                band = bands[key] = deadbands.get(field_key(key), self.default)
+            if band.exceeded(reported[key], value):
+                changed[key] = value
+        reported.update(changed)
+        self.fields_seen += len(flat)
+        self.fields_sent += len(changed)
+        return changed
+
+
+class MqttPublisher:
+    """Publish snapshot/delta của từng inverter lên MQTT broker"""
+
+    def __init__(self, host: str = "localhost", port: int = 1883, topic_prefix: str = "datalogger",
+                 qos: int = 1, username: Optional[str] = None, password: Optional[str] = None,
+                 client_id: str = "", max_silence: float = 900, queue_size: int = 10000,
+                 default_deadband: Optional[Deadband] = None, client=None):
+        self.host = host
+        self.port = port
+        self.topic_prefix = topic_prefix.rstrip("/")
+        self.qos = qos
+        self.filter = DeadbandFilter(default_deadband, max_silence)
+
+        # Hàng đợi khi offline: bỏ message cũ nhất khi đầy
+        self._queue: Deque[Tuple[str, bytes, bool]] = deque(maxlen=queue_size)
+        self._lock = threading.Lock()
+        self.connected = False
+        self._subscriptions: Dict[str, int] = {}  # topic -> qos, đăng ký lại khi reconnect
+
+        if client is None:
+            if mqtt is None:
+                raise RuntimeError("Chưa cài paho-mqtt (pip install paho-mqtt)")
+            if hasattr(mqtt, "CallbackAPIVersion"):  # paho-mqtt >= 2.0
+                client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, client_id=client_id)
+            else:
+                client = mqtt.Client(client_id=client_id)
+            if username:
+                client.username_pw_set(username, password)
+        self.client = client
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+
+        # Thống kê
+        self.published = 0
+        self.bytes_sent = 0
+        self.dropped = 0
+
+    # ------------------------------------------------------------------
+    # Kết nối (callback chạy trên thread network của paho)
+    # ------------------------------------------------------------------
+    def _on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            self.connected = True
+            print(f"[MQTT] ✅ Đã kết nối {self.host}:{self.port}")
+            for topic, qos in self._subscriptions.items():
+                client.subscribe(topic, qos)
+            self._drain()
+        else:
+            print(f"[MQTT] ❌ Kết nối bị từ chối (rc={rc})")
+
+    def _on_disconnect(self, client, userdata, rc):
+        self.connected = False
+        if rc != 0:
+            print(f"[MQTT] ⚠️ Mất kết nối (rc={rc}), message sẽ được giữ trong hàng đợi")
+
+    def start(self):
+        """Kết nối bất đồng bộ, paho tự reconnect trên thread riêng"""
+        self.client.connect_async(self.host, self.port, keepalive=60)
+        self.client.loop_start()
+
+    def stop(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+    def subscribe(self, topic: str, callback: Callable[[str, bytes], None], qos: int = 1):
+        """Nhận message của topic; callback(topic, payload) chạy trên thread network của paho"""
+        self.client.message_callback_add(topic, lambda client, userdata, msg: callback(msg.topic, msg.payload))
+        self._subscriptions[topic] = qos
+        if self.connected:
+            self.client.subscribe(topic, qos)
+
+    # ------------------------------------------------------------------
+    # Publish
+    # ------------------------------------------------------------------
+    def _send(self, topic: str, payload: bytes, retain: bool) -> bool:
+        info = self.client.publish(topic, payload, qos=self.qos, retain=retain)
+        # QoS > 0: paho vẫn giữ message khi chưa kết nối (rc NO_CONN) và tự gửi khi kết nối lại,
+        # coi như đã nhận để không gửi lại lần nữa từ hàng đợi của mình
+        if info.rc != 0 and not (info.rc == MQTT_ERR_NO_CONN and self.qos > 0):
+            return False
+        self.published += 1
+        self.bytes_sent += len(payload)
+        return True
+
+    def _drain(self):
+        """Gửi các message đang chờ theo thứ tự"""
+        with self._lock:
+            while self._queue and self.connected:
+                topic, payload, retain = self._queue[0]
+                if not self._send(topic, payload, retain):
+                    break
+                self._queue.popleft()
+
+    def _enqueue(self, topic: str, payload: bytes, retain: bool = False):
+        with self._lock:
+            if len(self._queue) == self._queue.maxlen:
+                self.dropped += 1
+            self._queue.append((topic, payload, retain))
+        if self.connected:
+            self._drain()
+
+    def publish_sample(self, inverter_id: int, ts: float, sample: Sample):
+        """Lọc mẫu theo deadband và publish snapshot (retain) hoặc delta"""
+        # Key phẳng dạng "ac.power", "mppt.3.voltage" để so sánh từng trường
+        flat = sample.flat()
+        now = time.monotonic()
+        base = f"{self.topic_prefix}/{inverter_id}"
+
+        # Mẫu chỉ có sản lượng luôn gửi dạng delta: retain nó sẽ ghi đè snapshot đầy đủ
+        realtime = "ac" in sample or "mppt" in sample
+        if realtime and self.filter.needs_snapshot(inverter_id, now):
+            self.filter.snapshot(inverter_id, flat, now)
+            payload = json.dumps({"ts": ts, "data": sample.to_dict()}, separators=(",", ":")).encode()
+            self._enqueue(f"{base}/snapshot", payload, retain=True)
+            return
+
+        changed = self.filter.delta(inverter_id, flat)
+        if changed:
+            payload = json.dumps({"ts": ts, "values": changed}, separators=(",", ":")).encode()
+            self._enqueue(f"{base}/delta", payload)
+
+    def publish(self, topic: str, payload: Dict[str, Any], retain: bool = False):
+        """Publish một message JSON dưới topic_prefix (qua hàng đợi offline)"""
+        body = json.dumps(payload, separators=(",", ":")).encode()
+        self._enqueue(f"{self.topic_prefix}/{topic}", body, retain)
+
+    async def on_sample(self, inverter_id: int, ts: float, sample: Sample):
+        """Callback cho collector"""
+        self.publish_sample(inverter_id, ts, sample)
+
+    async def on_plant(self, snapshot):
+        """Callback cho PlantAggregator: mỗi chu kỳ một message nhỏ cho cả nhà máy"""
+        self.publish(f"plant/{snapshot.project_id}", snapshot.to_dict(), retain=True)
+
+    async def on_alert(self, alert):
+        """Callback cho topic alert: mỗi lần đổi trạng thái string/MPPT một message"""
+        self.publish(f"alert/{alert.inverter_id}", asdict(alert))
+
+    def get_stats(self) -> Dict:
+        """Thống kê publish"""
+        seen = self.filter.fields_seen
+        return {
+            "connected": self.connected,
+            "published": self.published,
+            "bytes_sent": self.bytes_sent,
+            "queued": len(self._queue),
+            "dropped": self.dropped,
+            "fields_seen": seen,
+            "fields_sent": self.filter.fields_sent,
+            "suppression_ratio": round(1 - self.filter.fields_sent / seen, 3) if seen else None
+        }
@@ -1,43 +1,196 @@
-import yaml
+"""
+Config loader - Đọc cấu hình YAML (có Jinja2), biên dịch một lần rồi cache
+- Mỗi file được render/parse một lần, kết quả lưu trong data/config.cache theo hash nội dung
+  (và context Jinja): khởi động lại khi cấu hình không đổi không import/chạy Jinja2 lẫn YAML
+- Cache là JSON (kiểu YAML không có trong JSON được gắn nhãn): đọc file cache không thể chạy code
+- Cấu hình sau khi load được kiểm tra schema (utils/validator.py) và dựng index
+  theo inverter / MPPT, consumer không phải quét tuyến tính danh sách strings
+- ConfigWatcher: phát hiện file thay đổi và nạp lại nóng, không dừng polling
+"""
+import asyncio
+import base64
+import hashlib
+import json
 import os
-from jinja2 import Environment, FileSystemLoader
+import threading
+from datetime import date, datetime
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from utils.validator import ConfigError, validate_config
 
 # Đường dẫn đến thư mục chứa các file cấu hình
 CONFIG_DIR = os.path.join(os.path.dirname(__file__), "..", "config")
+CACHE_PATH = os.path.join(os.path.dirname(__file__), "..", "data", "config.cache")
+CACHE_VERSION = 2
+TYPE_KEY = "$type"  # Nhãn kiểu trong cache JSON
+
+# File -> khóa trong config
+SECTIONS = {
+    "projects.yaml": "projects",
+    "devices.yaml": "inverters",
+    "mppt.yaml": "mppt_channels",
+    "strings.yaml": "strings",
+    "server.yaml": "server",
+}
+
+_environment = None
+_cache: Optional[Dict[str, Tuple[str, Any]]] = None  # filename -> (digest, dữ liệu đã parse)
+_cache_lock = threading.Lock()  # load_config chạy ở thread khi nạp lại nóng
+
+
+def _jinja_environment():
+    """Environment Jinja2 dùng chung (chỉ import khi có file cần render)"""
+    global _environment
+    if _environment is None:
+        from jinja2 import Environment, FileSystemLoader
+        _environment = Environment(loader=FileSystemLoader(CONFIG_DIR), keep_trailing_newline=True)
+    return _environment
 
-def render_yaml_template(filename, context=None):
-    """Render Jinja2 template từ file YAML"""
-    path = os.path.join(CONFIG_DIR, filename)
-    with open(path, "r", encoding="utf-8") as f:
-        content = f.read()
 
-    env = Environment(loader=FileSystemLoader(CONFIG_DIR), keep_trailing_newline=True)
-    template = env.from_string(content)
+def render_yaml_template(filename, context=None, content=None):
+    """Render Jinja2 template từ file YAML (content: nội dung đã đọc sẵn)"""
+    if content is None:
+        with open(os.path.join(CONFIG_DIR, filename), "r", encoding="utf-8") as f:
+            content = f.read()
+    template = _jinja_environment().from_string(content)
     return template.render(**(context or {}))
 
-def load_yaml_file(filename, context=None):
-    """Load YAML, tự động render nếu có Jinja2"""
-    path = os.path.join(CONFIG_DIR, filename)
-    with open(path, "r", encoding="utf-8") as f:
-        content = f.read()
+
+def _parse(filename, content, context=None):
+    """Render (nếu có Jinja2) và parse YAML"""
+    import yaml
 
     has_jinja = "{%" in content or "{{" in content
-    if has_jinja:
-        rendered = render_yaml_template(filename, context)
-        try:
-            return yaml.safe_load(rendered)
-        except yaml.YAMLError as e:
-            print(f"❌ YAML parse error in {filename}: {e}")
-            print("🔍 Nội dung sau khi render:")
-            print("=" * 60)
-            print(rendered)
-            print("=" * 60)
-            raise
-    else:
+    if not has_jinja:
         return yaml.safe_load(content)
+    rendered = render_yaml_template(filename, context, content)
+    try:
+        return yaml.safe_load(rendered)
+    except yaml.YAMLError as e:
+        print(f"❌ YAML parse error in {filename}: {e}")
+        print("🔍 Nội dung sau khi render:")
+        print("=" * 60)
+        print(rendered)
+        print("=" * 60)
+        raise
+
+
+def _encode(value: Any) -> Any:
+    """Dữ liệu YAML -> JSON: datetime, date, set, bytes và dict có khóa không phải chuỗi được gắn nhãn"""
+    if isinstance(value, dict):
+        if TYPE_KEY not in value and all(isinstance(k, str) for k in value):
+            return {k: _encode(v) for k, v in value.items()}
+        return {TYPE_KEY: "dict", "value": [[_encode(k), _encode(v)] for k, v in value.items()]}
+    if isinstance(value, list):
+        return [_encode(v) for v in value]
+    if isinstance(value, datetime):
+        return {TYPE_KEY: "datetime", "value": value.isoformat()}
+    if isinstance(value, date):
+        return {TYPE_KEY: "date", "value": value.isoformat()}
+    if isinstance(value, (set, frozenset)):
+        return {TYPE_KEY: "set", "value": [_encode(v) for v in value]}
+    if isinstance(value, tuple):
+        return {TYPE_KEY: "tuple", "value": [_encode(v) for v in value]}
+    if isinstance(value, bytes):
+        return {TYPE_KEY: "bytes", "value": base64.b64encode(value).decode("ascii")}
+    return value
+
+
+def _decode(obj: Dict[str, Any]) -> Any:
+    """object_hook của json.loads: dựng lại kiểu đã gắn nhãn (nhãn lạ: cache hỏng)"""
+    kind = obj.get(TYPE_KEY)
+    if kind is None:
+        return obj
+    value = obj["value"]
+    if kind == "dict":
+        return {k: v for k, v in value}
+    if kind == "datetime":
+        return datetime.fromisoformat(value)
+    if kind == "date":
+        return date.fromisoformat(value)
+    if kind == "set":
+        return set(value)
+    if kind == "tuple":
+        return tuple(value)
+    if kind == "bytes":
+        return base64.b64decode(value)
+    raise ValueError(f"kiểu không hỗ trợ {kind!r}")
+
+
+def _load_cache() -> Dict[str, Tuple[str, Any]]:
+    """Cache trong process, đọc từ file lần đầu (gọi khi giữ _cache_lock)"""
+    global _cache
+    if _cache is None:
+        _cache = {}
+        try:
+            with open(CACHE_PATH, "r", encoding="utf-8") as f:
+                stored = json.load(f, object_hook=_decode)
+            if stored.get("version") == CACHE_VERSION:
+                _cache = {name: (digest, data) for name, (digest, data) in stored["entries"].items()}
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"[Config] ⚠️ Bỏ qua config cache hỏng: {e}")
+    return _cache
+
+
+def _save_cache():
+    """Ghi cache (gọi khi giữ _cache_lock; file tạm + rename: process khác không đọc phải file ghi dở)"""
+    try:
+        os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+        tmp = f"{CACHE_PATH}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"version": CACHE_VERSION,
+                       "entries": {name: [digest, _encode(data)] for name, (digest, data) in _cache.items()}},
+                      f, separators=(",", ":"))
+        os.replace(tmp, CACHE_PATH)
+    except (OSError, TypeError, ValueError) as e:
+        print(f"[Config] ⚠️ Không ghi được config cache: {e}")
+
+
+def load_yaml_file(filename, context=None):
+    """Load YAML, tự động render nếu có Jinja2; dùng lại kết quả đã cache nếu nội dung không đổi
+
+    Kết quả cache được dùng chung trong process: không sửa trực tiếp dữ liệu trả về.
+    """
+    with open(os.path.join(CONFIG_DIR, filename), "rb") as f:
+        raw = f.read()
+    digest = hashlib.sha1(raw)
+    if context:
+        digest.update(json.dumps(context, sort_keys=True, default=str).encode())
+    digest = digest.hexdigest()
+
+    with _cache_lock:
+        entry = _load_cache().get(filename)
+    if entry is not None and entry[0] == digest:
+        return entry[1]
+    data = _parse(filename, raw.decode("utf-8"), context)
+    with _cache_lock:
+        _cache[filename] = (digest, data)
+        _save_cache()
+    return data
+
+
+def build_index(config: Dict[str, Any]) -> Dict[str, Dict]:
+    """Index tra cứu theo id: inverter, project, MPPT; MPPT/string theo inverter và string theo MPPT"""
+    index: Dict[str, Dict] = {
+        "inverters": {inv["id"]: inv for inv in config.get("inverters", [])},
+        "projects": {p["id"]: p for p in config.get("projects", {}).get("projects", [])},
+        "mppt": {m["id"]: m for m in config.get("mppt_channels", [])},
+        "mppt_by_inverter": {},
+        "strings_by_inverter": {},
+        "strings_by_mppt": {},
+    }
+    for m in sorted(config.get("mppt_channels", []), key=lambda m: m["mppt_index"]):
+        index["mppt_by_inverter"].setdefault(m["inverter_id"], []).append(m)
+    for s in config.get("strings", []):
+        index["strings_by_inverter"].setdefault(s["inverter_id"], []).append(s)
+        index["strings_by_mppt"].setdefault(s["mppt_id"], []).append(s)
+    return index
+
 
 def load_config():
-    """Load toàn bộ cấu hình từ các file YAML"""
+    """Load toàn bộ cấu hình từ các file YAML, kiểm tra schema và dựng index (ConfigError nếu sai)"""
     config = {}
 
     # Load project trước để dùng làm context nếu cần
@@ -50,4 +203,83 @@ def load_config():
     config["strings"] = load_yaml_file("strings.yaml", context=project).get("strings", [])
     config["server"] = load_yaml_file("server.yaml").get("server", {})
 
+    errors = validate_config(config)
+    if errors:
+        raise ConfigError(errors)
+    config["index"] = build_index(config)
     return config
+
+
+class ConfigWatcher:
+    """Theo dõi thư mục config và nạp lại khi file thay đổi"""
+
+    def __init__(self, interval: float = 5):
+        self.interval = interval
+        self.callbacks: List[Callable[[Dict[str, Any], Set[str]], None]] = []
+        self._stamps = self._scan()
+
+        # Thống kê
+        self.reloads = 0
+        self.failures = 0
+        self.last_error: Optional[str] = None
+
+    def subscribe(self, callback: Callable[[Dict[str, Any], Set[str]], None]):
+        """callback(config mới, phần đã đổi) gọi trên event loop sau mỗi lần nạp lại thành công
+
+        Phần đã đổi là khóa trong config ("server", "strings"...) hoặc đường dẫn file khác
+        (vd "register_maps/sungrow_sg.yaml").
+        """
+        self.callbacks.append(callback)
+
+    def _scan(self) -> Dict[str, Tuple[int, int]]:
+        """mtime/kích thước của mọi file YAML trong thư mục config (kể cả register_maps)"""
+        stamps = {}
+        for root, _, files in os.walk(CONFIG_DIR):
+            for name in files:
+                if name.endswith((".yaml", ".yml")):
+                    path = os.path.join(root, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    stamps[os.path.relpath(path, CONFIG_DIR).replace(os.sep, "/")] = (st.st_mtime_ns, st.st_size)
+        return stamps
+
+    async def check(self) -> Optional[Dict[str, Any]]:
+        """Nạp lại nếu có file đổi; cấu hình lỗi thì giữ cấu hình đang chạy"""
+        stamps = await asyncio.to_thread(self._scan)
+        changed = {name for name in stamps.keys() | self._stamps.keys()
+                   if stamps.get(name) != self._stamps.get(name)}
+        if not changed:
+            return None
+        self._stamps = stamps
+        try:
+            config = await asyncio.to_thread(load_config)
+        except Exception as e:
+            self.failures += 1
+            self.last_error = str(e)
+            print(f"[Config] ❌ Không nạp lại được cấu hình ({', '.join(sorted(changed))}), giữ cấu hình cũ:\n{e}")
+            return None
+        self.reloads += 1
+        self.last_error = None
+        print(f"[Config] 🔄 Đã nạp lại: {', '.join(sorted(changed))}")
+        sections = {SECTIONS.get(name, name) for name in changed}
+        for callback in self.callbacks:
+            try:
+                callback(config, sections)
+            except Exception as e:
+                print(f"[Config] ❌ Lỗi áp dụng cấu hình mới ({callback.__qualname__}): {e}")
+        return config
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.check()
+
+    def get_stats(self) -> Dict:
+        return {
+            "files": len(self._stamps),
+            "reloads": self.reloads,
+            "failures": self.failures,
+            "last_error": self.last_error
+        }
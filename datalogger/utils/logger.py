@@ -0,0 +1,353 @@
+"""
+Logger & metrics - Lớp đo đạc (instrumentation) cho datalogger
+- Mức log debug/info/warning/error: payload từng chu kỳ chỉ in ở mức debug
+- Registry counter / gauge / histogram có nhãn, xuất theo định dạng text của Prometheus
+- Hot path (frame Modbus, lateness, loop lag) chỉ tăng bộ đếm trong bucket cố định;
+  số liệu sẵn có của các thành phần (hàng đợi, throughput) được đọc lúc scrape qua callback
+- HTTP endpoint cục bộ GET /metrics (asyncio, không cần thư viện ngoài)
+- Đo độ trễ event loop (loop lag)
+"""
+import asyncio
+import math
+import threading
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+# ----------------------------------------------------------------------
+# Mức log
+# ----------------------------------------------------------------------
+LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+_level = LEVELS["info"]
+
+def set_level(level: str):
+    """Đặt mức log toàn cục"""
+    global _level
+    if level not in LEVELS:
+        raise ValueError(f"Mức log không hợp lệ: {level} (chọn {', '.join(LEVELS)})")
+    _level = LEVELS[level]
+
+def is_enabled(level: str) -> bool:
+    """Mức log có được in không (kiểm tra trước khi format chuỗi tốn kém)"""
+    return LEVELS[level] >= _level
+
+def is_debug() -> bool:
+    return _level <= LEVELS["debug"]
+
+
+# ----------------------------------------------------------------------
+# Metrics
+# ----------------------------------------------------------------------
+# Bucket mặc định (giây)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+LabelValues = Tuple[str, ...]
+
+
+class _Value:
+    """Giá trị của một counter/gauge với một bộ nhãn"""
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def set(self, value: float):
+        self.value = value
+
+
+class _HistogramValue:
+    """Histogram với một bộ nhãn: đếm theo bucket cố định, không lưu mẫu"""
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Phần tử cuối: +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Ước lượng phân vị bằng cận trên của bucket chứa nó (None nếu chưa có mẫu)"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return self.buckets[index] if index < len(self.buckets) else math.inf
+        return math.inf
+
+
+class Metric:
+    """
+    Một metric có nhãn. labels(...) trả về giá trị của bộ nhãn (tạo khi cần);
+    nên giữ lại kết quả ở hot path thay vì gọi labels() mỗi lần.
+    Mỗi bộ nhãn chỉ nên được ghi từ một thread (vd thread của bus sở hữu nó).
+    """
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[LabelValues, object] = {}
+        self._lock = threading.Lock()
+
+    def _new_child(self):
+        return _Value()
+
+    def labels(self, *values):
+        key = tuple(str(v) for v in values)
+        child = self._children.get(key)
+        if child is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError(f"{self.name}: cần nhãn {self.labelnames}, nhận {key}")
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def samples(self) -> List[Tuple[str, LabelValues, Tuple, float]]:
+        """(hậu tố tên, nhãn, nhãn phụ, giá trị) của tất cả bộ nhãn"""
+        with self._lock:
+            children = list(self._children.items())
+        return [("", key, (), child.value) for key, child in children]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = (),
+                 buckets: Iterable[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def samples(self):
+        with self._lock:
+            children = list(self._children.items())
+        result = []
+        for key, child in children:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), list(child.counts)):
+                cumulative += count
+                result.append(("_bucket", key, (("le", bound),), cumulative))
+            result.append(("_sum", key, (), child.sum))
+            result.append(("_count", key, (), child.count))
+        return result
+
+
+class FuncMetric(Metric):
+    """
+    Metric đọc lúc scrape từ số liệu sẵn có của thành phần (không tốn gì ở hot path).
+    fn trả về một số (không nhãn) hoặc dict {bộ nhãn: giá trị}.
+    """
+
+    def __init__(self, name: str, help: str, type: str,
+                 fn: Callable[[], Union[float, Dict[LabelValues, float]]], labelnames: Iterable[str] = ()):
+        super().__init__(name, help, labelnames)
+        self.type = type
+        self.fn = fn
+
+    def samples(self):
+        values = self.fn()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [("", tuple(str(v) for v in key), (), value)
+                for key, value in values.items() if value is not None]
+
+
+def _format_value(value) -> str:
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, int):
+        return str(value)
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if math.isnan(value):
+        return "NaN"
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class MetricsRegistry:
+    """Tập hợp metrics, tạo theo tên (gọi lại với cùng tên trả về metric đã có)"""
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name: str, *args, **kwargs) -> Metric:
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"Metric {name} đã được đăng ký với loại {metric.type}")
+            return metric
+
+    def counter(self, name: str, help: str, labelnames: Iterable[str] = ()) -> Counter:
+        return self._get_or_create(Counter, name, help, labelnames)
+
+    def gauge(self, name: str, help: str, labelnames: Iterable[str] = ()) -> Gauge:
+        return self._get_or_create(Gauge, name, help, labelnames)
+
+    def histogram(self, name: str, help: str, labelnames: Iterable[str] = (),
+                  buckets: Iterable[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, help, labelnames, buckets)
+
+    def gauge_func(self, name: str, help: str, fn: Callable, labelnames: Iterable[str] = ()) -> FuncMetric:
+        """Gauge đọc lúc scrape (thay thế callback cũ cùng tên)"""
+        return self._register_func(FuncMetric(name, help, "gauge", fn, labelnames))
+
+    def counter_func(self, name: str, help: str, fn: Callable, labelnames: Iterable[str] = ()) -> FuncMetric:
+        """Counter đọc lúc scrape từ bộ đếm sẵn có của thành phần"""
+        return self._register_func(FuncMetric(name, help, "counter", fn, labelnames))
+
+    def _register_func(self, metric: FuncMetric) -> FuncMetric:
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def get(self, name: str) -> Optional[Metric]:
+        return self._metrics.get(name)
+
+    def render(self) -> str:
+        """Xuất tất cả metrics theo định dạng text của Prometheus (version 0.0.4)"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            try:
+                samples = metric.samples()
+            except Exception as e:
+                print(f"[Metrics] ❌ Lỗi đọc {metric.name}: {e}")
+                continue
+            lines.append(f"# HELP {metric.name} {_escape(metric.help)}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for suffix, key, extra, value in samples:
+                pairs = list(zip(metric.labelnames, key)) + [(k, _format_value(v)) for k, v in extra]
+                labels = ",".join(f'{k}="{_escape(v)}"' for k, v in pairs)
+                lines.append(f"{metric.name}{suffix}{{{labels}}} {_format_value(value)}" if labels
+                             else f"{metric.name}{suffix} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+# ----------------------------------------------------------------------
+# HTTP endpoint
+# ----------------------------------------------------------------------
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class MetricsServer:
+    """HTTP server tối giản trả lời GET /metrics cho Prometheus (hoặc curl tại hiện trường)"""
+
+    def __init__(self, registry: Optional[MetricsRegistry] = None, host: str = "127.0.0.1", port: int = 9108):
+        self.registry = registry or get_metrics()
+        self.host = host
+        self.port = port
+        self._server: Optional[asyncio.AbstractServer] = None
+        self.scrapes = 0
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 5)
+            while (await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""):
+                pass  # Bỏ qua header
+            parts = request.decode("latin-1").split()
+            method, path = (parts[0], parts[1].split("?")[0]) if len(parts) >= 2 else ("", "")
+
+            if method == "GET" and path in ("/metrics", "/"):
+                self.scrapes += 1
+                status, body = "200 OK", self.registry.render().encode()
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {CONTENT_TYPE}\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (ConnectionError, asyncio.TimeoutError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_client, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        print(f"[Metrics] 🚀 http://{self.host}:{self.port}/metrics")
+
+    async def serve_forever(self):
+        if self._server is None:
+            await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    def get_stats(self) -> Dict:
+        return {"host": self.host, "port": self.port, "scrapes": self.scrapes}
+
+
+# ----------------------------------------------------------------------
+# Độ trễ event loop
+# ----------------------------------------------------------------------
+LOOP_LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+class LoopLagMonitor:
+    """Ngủ một khoảng cố định và đo thời gian thức dậy trễ (callback nào đó chặn event loop)"""
+
+    def __init__(self, registry: Optional[MetricsRegistry] = None, interval: float = 0.5):
+        registry = registry or get_metrics()
+        self.interval = interval
+        self.histogram = registry.histogram(
+            "datalogger_event_loop_lag_seconds", "Độ trễ thức dậy của event loop", buckets=LOOP_LAG_BUCKETS)
+        self.max_lag = registry.gauge(
+            "datalogger_event_loop_lag_max_seconds", "Độ trễ event loop lớn nhất từ khi khởi động")
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        lag_hist, max_lag = self.histogram.labels(), self.max_lag.labels()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - start - self.interval)
+            lag_hist.observe(lag)
+            if lag > max_lag.value:
+                max_lag.set(lag)
+
+
+# Singleton instance
+_metrics_instance: Optional[MetricsRegistry] = None
+
+def get_metrics() -> MetricsRegistry:
+    """Lấy singleton metrics registry"""
+    global _metrics_instance
+    if _metrics_instance is None:
+        _metrics_instance = MetricsRegistry()
+    return _metrics_instance
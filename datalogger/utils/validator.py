@@ -0,0 +1,241 @@
+"""
+Validator - Kiểm tra schema cấu hình sau khi render
+- Mỗi loại mục (project, inverter, MPPT, string) khai báo trường bắt buộc / kiểu / khoảng giá trị
+- Kiểm tra tham chiếu chéo: project -> inverter, MPPT -> inverter, string -> MPPT cùng inverter
+- Unit id Modbus TCP (inverter, nhà máy) nằm trong 1-247 và không trùng nhau
+- Hai inverter không được dùng chung (port, slave_id)
+- Gom toàn bộ lỗi rồi báo một lần (ConfigError), không dừng ở lỗi đầu tiên
+"""
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+NUMBER = (int, float)
+
+# Giá trị mặc định khi devices.yaml bỏ trống (main.build_inverter_configs dùng chung)
+DEFAULT_PORT = "COM3"
+DEFAULT_SLAVE_ID = 1
+
+
+class ConfigError(ValueError):
+    """Cấu hình không hợp lệ; `errors` là danh sách lỗi dạng 'file: mục: mô tả'"""
+
+    def __init__(self, errors: List[str]):
+        self.errors = errors
+        super().__init__("\n".join(errors))
+
+
+@dataclass
+class Field:
+    """Ràng buộc của một trường"""
+    types: Tuple[type, ...] = NUMBER
+    required: bool = False
+    min: Optional[float] = None
+    max: Optional[float] = None
+
+
+PROJECT_SCHEMA = {
+    "id": Field((int,), required=True, min=1),
+    "name": Field((str,)),
+    "capacity_kwp": Field(min=0),
+    "ac_capacity_kw": Field(min=0),
+    "inverters": Field((list,)),
+}
+
+INVERTER_SCHEMA = {
+    "id": Field((int,), required=True, min=1),
+    "project_id": Field((int,)),
+    "port": Field((str,)),
+    "slave_id": Field((int,), min=1, max=247),
+    "baudrate": Field((int,), min=1),
+    "mppt_count": Field((int,), min=0),
+    "string_count": Field((int,), min=0),
+    "max_gap": Field((int,), min=0),
+    "register_map": Field((str,)),
+    "phase": Field(min=0),
+}
+
+MPPT_SCHEMA = {
+    "id": Field((int,), required=True),
+    "inverter_id": Field((int,), required=True),
+    "mppt_index": Field((int,), required=True, min=1),
+    "string_on_mppt": Field((int,), min=1),
+    "Max_I": Field(min=0),
+    "Max_V": Field(min=0),
+    "Max_P": Field(min=0),
+}
+
+STRING_SCHEMA = {
+    "id": Field((int,), required=True),
+    "inverter_id": Field((int,), required=True),
+    "mppt_id": Field((int,), required=True),
+    "string_index": Field((int,), min=1),
+    "string_on_mppt": Field((int,), min=1),
+    "Max_I": Field(min=0),
+    "Max_V": Field(min=0),
+    "Max_P": Field(min=0),
+    "Max_P_string": Field(min=0),
+}
+
+# server.yaml: section -> schema (chỉ các trường số ảnh hưởng tới polling / lưu trữ)
+SERVER_SCHEMA = {
+    "polling": {
+        "realtime_interval": Field(min=0.1),
+        "energy_interval": Field(min=1),
+        "night_interval": Field(min=0.1),
+        "fault_interval": Field(min=0.1),
+        "fault_burst": Field(min=0),
+        "offline_after": Field((int,), min=1),
+        "offline_max_interval": Field(min=0.1),
+    },
+    "modbus_tcp": {
+        "port": Field((int,), min=1, max=65535),
+        "slave_id": Field((int,), min=1, max=247),
+        "plant_unit_base": Field((int,), min=0, max=246),
+        "register_map": Field((dict,)),
+    },
+    "storage": {
+        "batch_size": Field((int,), min=1),
+        "flush_interval": Field(min=0.1),
+        "retention_days": Field(min=0),
+        "max_buffered": Field((int,), min=1),
+    },
+    "cache": {"hours": Field(min=0)},
+    "rtu": {
+        "timeout": Field(min=0.01),
+        "timeout_min": Field(min=0.01),
+        "timeout_factor": Field(min=1),
+        "latency_window": Field((int,), min=1),
+        "block_retries": Field((int,), min=0),
+        "retry_budget": Field(min=0, max=1),
+        "retry_burst": Field(min=0),
+        "breaker_failures": Field((int,), min=1),
+        "breaker_cooldown": Field(min=0),
+        "breaker_max_cooldown": Field(min=0),
+    },
+    "plant": {"stale_after": Field(min=0)},
+    "workers": {"queue_size": Field((int,), min=1), "restart_delay": Field(min=0)},
+    "metrics": {"port": Field((int,), min=1, max=65535)},
+}
+
+
+def check_entry(entry: Any, schema: Dict[str, Field], where: str) -> List[str]:
+    """Lỗi của một mục theo schema"""
+    if not isinstance(entry, dict):
+        return [f"{where}: phải là mapping, nhận {type(entry).__name__}"]
+    errors = []
+    for name, spec in schema.items():
+        value = entry.get(name)
+        if value is None:
+            if spec.required:
+                errors.append(f"{where}: thiếu trường '{name}'")
+            continue
+        # bool là lớp con của int trong Python: không chấp nhận true/false cho trường số
+        if isinstance(value, bool) or not isinstance(value, spec.types):
+            expected = "/".join(t.__name__ for t in spec.types)
+            errors.append(f"{where}: '{name}' phải là {expected}, nhận {value!r}")
+            continue
+        if spec.min is not None and value < spec.min:
+            errors.append(f"{where}: '{name}' = {value} nhỏ hơn {spec.min}")
+        if spec.max is not None and value > spec.max:
+            errors.append(f"{where}: '{name}' = {value} lớn hơn {spec.max}")
+    return errors
+
+
+def _check_list(entries: Any, schema: Dict[str, Field], where: str, errors: List[str]) -> Dict[Any, Dict]:
+    """Kiểm tra danh sách mục, trả về {id: mục} của các mục hợp lệ (id trùng bị báo lỗi)"""
+    if not isinstance(entries, list):
+        errors.append(f"{where}: phải là danh sách")
+        return {}
+    by_id = {}
+    for i, entry in enumerate(entries):
+        label = f"{where}[{i}]" if not isinstance(entry, dict) or "id" not in entry else f"{where} id={entry['id']}"
+        entry_errors = check_entry(entry, schema, label)
+        errors.extend(entry_errors)
+        if entry_errors:
+            continue
+        if entry["id"] in by_id:
+            errors.append(f"{label}: id bị trùng")
+            continue
+        by_id[entry["id"]] = entry
+    return by_id
+
+
+def validate_config(config: Dict[str, Any]) -> List[str]:
+    """Toàn bộ lỗi của cấu hình đã render (rỗng nếu hợp lệ)"""
+    errors: List[str] = []
+    projects = _check_list(config.get("projects", {}).get("projects", []), PROJECT_SCHEMA,
+                           "projects.yaml: project", errors)
+    inverters = _check_list(config.get("inverters", []), INVERTER_SCHEMA, "devices.yaml: inverter", errors)
+    mppts = _check_list(config.get("mppt_channels", []), MPPT_SCHEMA, "mppt.yaml: mppt", errors)
+    strings = _check_list(config.get("strings", []), STRING_SCHEMA, "strings.yaml: string", errors)
+
+    for project in projects.values():
+        for inverter_id in project.get("inverters") or []:
+            if inverter_id not in inverters:
+                errors.append(f"projects.yaml: project id={project['id']}: inverter {inverter_id} không có trong devices.yaml")
+    addresses: Dict[Tuple[str, int], int] = {}
+    for inverter in inverters.values():
+        if inverter.get("project_id") is not None and projects and inverter["project_id"] not in projects:
+            errors.append(f"devices.yaml: inverter id={inverter['id']}: project {inverter['project_id']} không tồn tại")
+        # Cùng port + slave_id: hai inverter đọc cùng một thiết bị trên bus
+        address = (inverter.get("port", DEFAULT_PORT), inverter.get("slave_id", DEFAULT_SLAVE_ID))
+        if address in addresses:
+            errors.append(f"devices.yaml: inverter id={inverter['id']}: port {address[0]} slave_id {address[1]} "
+                          f"trùng inverter {addresses[address]}")
+        else:
+            addresses[address] = inverter["id"]
+
+    for mppt in mppts.values():
+        inverter = inverters.get(mppt["inverter_id"])
+        if inverter is None:
+            errors.append(f"mppt.yaml: mppt id={mppt['id']}: inverter {mppt['inverter_id']} không có trong devices.yaml")
+        elif mppt["mppt_index"] > inverter.get("mppt_count", 9):
+            errors.append(f"mppt.yaml: mppt id={mppt['id']}: mppt_index {mppt['mppt_index']} "
+                          f"vượt mppt_count {inverter.get('mppt_count', 9)} của inverter {inverter['id']}")
+
+    for string in strings.values():
+        if string["inverter_id"] not in inverters:
+            errors.append(f"strings.yaml: string id={string['id']}: inverter {string['inverter_id']} không có trong devices.yaml")
+            continue
+        mppt = mppts.get(string["mppt_id"])
+        if mppts and mppt is None:
+            errors.append(f"strings.yaml: string id={string['id']}: mppt {string['mppt_id']} không có trong mppt.yaml")
+        elif mppt is not None and mppt["inverter_id"] != string["inverter_id"]:
+            errors.append(f"strings.yaml: string id={string['id']}: mppt {string['mppt_id']} "
+                          f"thuộc inverter {mppt['inverter_id']}, không phải {string['inverter_id']}")
+
+    server = config.get("server", {})
+    if not isinstance(server, dict):
+        errors.append("server.yaml: server phải là mapping")
+        return errors
+    for section, schema in SERVER_SCHEMA.items():
+        if section in server:
+            errors.extend(check_entry(server[section], schema, f"server.yaml: {section}"))
+    errors.extend(_check_tcp_units(server, inverters, projects))
+    return errors
+
+
+def _check_tcp_units(server: Dict[str, Any], inverters: Dict[Any, Dict], projects: Dict[Any, Dict]) -> List[str]:
+    """Unit id Modbus TCP: inverter dùng id của nó, nhà máy dùng plant_unit_base + id project;
+    tất cả phải nằm trong 1-247 và không trùng nhau"""
+    modbus_tcp = server.get("modbus_tcp")
+    if not isinstance(modbus_tcp, dict) or not modbus_tcp.get("enabled"):
+        return []
+    errors = []
+    for inverter_id in inverters:
+        if not 1 <= inverter_id <= 247:
+            errors.append(f"devices.yaml: inverter id={inverter_id}: id dùng làm unit Modbus TCP, phải trong 1-247")
+
+    base = modbus_tcp.get("plant_unit_base")
+    plant = server.get("plant") or {}
+    if not isinstance(base, int) or isinstance(base, bool) or not plant.get("enabled", True):
+        return errors
+    for project_id in projects:
+        unit = base + project_id
+        if not 1 <= unit <= 247:
+            errors.append(f"server.yaml: modbus_tcp: unit nhà máy {unit} (plant_unit_base + project {project_id}) "
+                          f"ngoài 1-247")
+        elif unit in inverters:
+            errors.append(f"server.yaml: modbus_tcp: unit nhà máy {unit} (plant_unit_base + project {project_id}) "
+                          f"trùng id inverter")
+    return errors